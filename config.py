@@ -2,17 +2,51 @@ import logging
 
 
 class SinglePointMissionConfig:
+    # Set to 'fake://' to fly a simulated drone instead (see fake_drone.py), e.g. to check the mission's timing without
+    # PX4; add '?time_scale=10' to fly 10 times faster than real time
     system_address = "udp://:14540"
     target_altitude_meters = 20
     altitude_error_threshold_meters = 0.5
     altitude_arrival_timeout_seconds = 30
+
+    # Checkpoint the heatmap while it's being captured (see HeatmapConfig.checkpoint_enabled), so that if the script gets
+    # restarted partway through the scan, e.g. after the companion computer browned out, it tops up the heatmap it already
+    # had rather than starting over. The checkpoint gets deleted once the heatmap has been saved.
+    checkpoint_enabled = False
+    checkpoint_filename = 'heatmap_single_point.ckpt'
     log_level = logging.DEBUG
     log_file = 'heatmap_single_point.log'
 
 
 class MultiPointMissionConfig:
+    # Set to 'fake://' to fly a simulated drone instead (see fake_drone.py), e.g. to check the mission's timing without
+    # PX4; add '?time_scale=10' to fly 10 times faster than real time
     system_address = "udp://:14540"
-    waypoint_stabilization_time_seconds = 2
+
+    # Heatmaps get rendered and saved, along with their hotspots and mosaic tiles, by this many worker processes while
+    # the drone flies on to the next waypoint. If this many heatmaps are already waiting to be saved, the drone holds at
+    # its waypoint until one of them is done.
+    postprocessing_workers = 1
+    postprocessing_max_pending = 4
+
+    # Before each scan, the drone used to hover for a fixed waypoint_stabilization_time_seconds; it now waits until the
+    # camera has settled (see HeatmapConfig.session_stability_*). If this is set, it caps that wait instead of
+    # HeatmapConfig.session_stability_timeout_seconds, so configs that still set it keep their maximum hover time.
+    waypoint_stabilization_time_seconds = None
+
+    # Also project each waypoint's heatmap onto a shared, georeferenced mosaic of the whole mission (see
+    # heatmap_mosaic.py), stored as tiles of mosaic_tile_size pixels. Missions that use the same directory add to the
+    # same mosaic.
+    mosaic_enabled = False
+    mosaic_directory = 'heatmap_mosaic'
+    mosaic_metres_per_pixel = 0.1
+    mosaic_tile_size = 256
+
+    # Checkpoint each waypoint's heatmap while it's being captured (see HeatmapConfig.checkpoint_enabled), so that if the
+    # script gets restarted partway through the mission, a waypoint that was partly captured gets topped up rather than
+    # scanned all over again. Checkpoints are named after their waypoint, e.g. checkpoint_2_of_5.ckpt, and get deleted
+    # once the waypoint's heatmap has been saved.
+    checkpoint_enabled = False
     log_level = logging.DEBUG
     log_file = 'heatmap_multi_point.log'
 
@@ -30,14 +64,77 @@ class HeatmapConfig:
     video_capture_input_filename = '/Users/mansoor.siddiqui/Workspace/drone/data/stanford_dataset/videos/gates5.mov'
     video_capture_gstreamer_pipeline = 'v4l2src ! video/x-raw,width=640,height=480 ! decodebin ! videoconvert ! appsink'
 
+    # Index of the camera to read from in 'CAMERA_DIRECT' mode
+    video_capture_camera_index = 0
+
     # Grab camera frames only every x milliseconds; if simulating using input video
     frame_sampling_enabled = True
     frame_sampling_interval_millis = 200
 
+    # How frames get skipped when sampling from a video file. Valid values are:
+    #   'REALTIME' - skip however many frames a live camera would have produced while we were busy (the original
+    #                behavior), advancing with grab() so that skipped frames are never decoded
+    #   'STRIDE'   - sample frames at fixed stream-time intervals computed once up front, advancing with grab()
+    #   'SEEK'     - sample the same frames as 'STRIDE', but jump straight to each one; faster for long intervals as
+    #                long as the container supports frame-accurate seeking
+    frame_sampling_file_strategy = 'REALTIME'
+
     # Down-sample the image to the target dimensions
     down_sampling_enabled = False
     down_sampling_size = (640, 480)
 
+    # How the target dimensions get picked. Valid values are:
+    #   'FIXED' - always down-sample to down_sampling_size
+    #   'GSD'   - down-sample so that the ground gets covered at down_sampling_target_pixels_per_metre (i.e. the ground
+    #             sample distance), based on camera_altitude_meters and the camera's field of view, so that people
+    #             always cover about the same number of pixels. The noise reduction kernel sizes are then taken to be
+    #             at that resolution, and shrink to match if the camera can't resolve the ground that finely.
+    down_sampling_mode = 'FIXED'
+    down_sampling_target_pixels_per_metre = 10
+
+    # Decode (and down-sample) frames on a background thread into a bounded ring buffer of preallocated frame buffers,
+    # so that the camera keeps streaming while the analysis loop is busy with the previous frame. The buffer has to hold
+    # at least 1 frame.
+    capture_threaded_enabled = False
+    capture_buffer_size = 4
+
+    # What the reader thread does when the ring buffer is full. Valid values are 'DROP_OLDEST' or 'BLOCK'. Reading from
+    # a file always blocks, since dropping frames there would only make the output non-deterministic. With 'DROP_OLDEST'
+    # and frame sampling enabled, each sample also skips straight to the newest frame, counting the rest as dropped.
+    capture_buffer_drop_policy = 'DROP_OLDEST'
+
+    # Frames from a live stream that are older than this by the time they get processed are counted as late
+    capture_late_frame_threshold_millis = 500
+
+    # Before each scan of a long-lived capture session (see heatmap.HeatmapSession), wait for the camera to hold still:
+    # the global shift between consecutive frames, measured on frames scaled down to session_stability_frame_width pixels
+    # wide, has to stay within session_stability_max_shift_pixels for session_stability_duration_millis. If the camera
+    # still hasn't settled after session_stability_timeout_seconds, the scan goes ahead anyway.
+    session_stability_frame_width = 160
+    session_stability_max_shift_pixels = 0.5
+    session_stability_duration_millis = 1000
+    session_stability_timeout_seconds = 10
+
+    # Split a video file into this many chunks and analyse each one in its own worker process. Set to 1 to disable.
+    file_parallel_workers = 1
+
+    # Seconds of video each worker feeds into its background model before its chunk starts, without counting any
+    # foreground, so that the model has converged by the time it does. Longer warm-ups bring the result closer to that of
+    # a serial run, at the cost of extra work per worker (see heatmap._generate_heatmap_parallel for the exact bound).
+    file_parallel_warmup_seconds = 30
+
+    ###########################################################################
+    # CAMERA CONFIGS
+    ###########################################################################
+
+    # Horizontal field of view of the camera. The camera is assumed to point straight down, with the top of the image
+    # facing the front of the drone.
+    camera_horizontal_fov_degrees = 78.0
+
+    # Height of the camera above the ground. The mission scripts set this for each scan; if it isn't known, 'GSD'
+    # down-sampling falls back to down_sampling_size.
+    camera_altitude_meters = None
+
     ###########################################################################
     # ALGO CONFIGS
     ###########################################################################
@@ -45,11 +142,105 @@ class HeatmapConfig:
     # Valid values are 'KNN' or 'MOG2'
     bg_subtraction_algo = 'KNN'
 
+    # Reconstruct the background image every x frames; set to 0 to only reconstruct it when it's needed (e.g. at the end
+    # of the scan)
+    bg_snapshot_interval_frames = 0
+
     # Reduce noise in the computed foreground mask
     noise_reduction_enabled = True
     noise_reduction_erosion_kernel_size = (8, 8)
     noise_reduction_dilation_kernel_size = (20, 20)
 
+    # How the dilation gets carried out. Valid values are:
+    #   'ELLIPSE'   - a single elliptical kernel of noise_reduction_dilation_kernel_size
+    #   'SEPARABLE' - a rectangular kernel of the same size; much cheaper, but dilates blobs into boxes
+    #   'ITERATED'  - a rectangle followed by repeated 3x3 crosses, which approximates the ellipse with an octagon at a
+    #                 fraction of the cost
+    noise_reduction_dilation_mode = 'ELLIPSE'
+
+    # Only analyse the part of the frame inside this polygon, given as a list of (x, y) points in fractions of the frame's
+    # width and height, e.g. [(0, 0.5), (1, 0.5), (1, 1), (0, 1)] for the bottom half. Background subtraction, noise
+    # reduction and accumulation only run on the tiles of analysis_tile_size pixels that the polygon's bounding box
+    # overlaps. Set to None to analyse the whole frame.
+    roi_polygon = None
+    analysis_tile_size = 64
+
+    # Stop running noise reduction and accumulation on tiles that haven't had any foreground for
+    # tile_skipping_idle_frames frames, and go back over all of them every tile_skipping_recheck_frames frames. Tiles
+    # next to ones with foreground are always kept going, so that people walking into a quiet area wake it up as they
+    # go; anything that shows up in the middle of a quiet area gets missed until the next recheck.
+    tile_skipping_enabled = False
+    tile_skipping_idle_frames = 30
+    tile_skipping_recheck_frames = 30
+
+    # How the heatmap gets built up. Valid values are:
+    #   'PIXELS' - count the frames in which each pixel was part of the foreground
+    #   'BLOBS'  - find the people in each frame as connected blobs of foreground, merging blobs whose centres are within
+    #              blob_merge_distance_pixels of each other (one person often breaks up into several), and add a Gaussian
+    #              footprint of blob_footprint_sigma_pixels at each person's position. Gives a per-person occupancy
+    #              heatmap, along with a head count for each frame (see heatmap.HeatmapGenerator.head_counts). Heatmap
+    #              windows aren't supported in this mode.
+    # Blobs smaller than blob_min_area_pixels are ignored. Blob sizes are taken to be at the same resolution as the noise
+    # reduction kernel sizes.
+    heatmap_accumulation_mode = 'PIXELS'
+    blob_min_area_pixels = 50
+    blob_merge_distance_pixels = 24
+    blob_footprint_sigma_pixels = 8
+
+    # Also keep track of the heatmap over a recent window of time, which can be pulled at any point during a scan (see
+    # heatmap.HeatmapGenerator.window()). Memory use depends on the window, not on how long the scan runs. Valid values
+    # are:
+    #   None      - don't keep a window
+    #   'SLIDING' - counts over the last heatmap_window_seconds (or any shorter window), in steps of
+    #               heatmap_window_interval_seconds; the window can hold up to 65535 frames
+    #   'DECAY'   - an exponentially decaying average, in which each frame's weight halves every
+    #               heatmap_window_half_life_seconds
+    heatmap_window_mode = None
+    heatmap_window_seconds = 60
+    heatmap_window_interval_seconds = 5
+    heatmap_window_half_life_seconds = 30
+
+    ###########################################################################
+    # MASK RECORDING CONFIGS
+    ###########################################################################
+
+    # Record the foreground mask of every frame, bit-packed and compressed in chunks of mask_recording_chunk_frames, so
+    # that heatmaps can be rebuilt and re-rendered with heatmap_replay.py without rerunning background subtraction. Takes
+    # at most a bit per pixel per frame, and usually a lot less.
+    mask_recording_enabled = False
+    mask_recording_filename = 'masks.hmm'
+    mask_recording_chunk_frames = 32
+
+    # A chunk also gets written once its frames span this many seconds, even if it isn't full yet. Frames in a chunk that
+    # hasn't been written get lost if the process dies, so this bounds how much of the recording that can cost.
+    mask_recording_max_chunk_seconds = 5
+
+    # Which masks get recorded. Valid values are:
+    #   'RAW'     - masks straight out of background subtraction, so that noise reduction can be re-tuned on replay
+    #   'CLEANED' - masks after noise reduction, so that replay doesn't have to redo it
+    mask_recording_stage = 'RAW'
+
+    ###########################################################################
+    # CHECKPOINT CONFIGS
+    ###########################################################################
+
+    # Checkpoint the heatmap counts and frame count to checkpoint_filename every checkpoint_interval_seconds of the scan,
+    # so that a scan cut short by a crash or a power cut doesn't lose everything captured so far. The analysis loop only
+    # copies the counts; the file gets written on a background thread. Checkpoints taken during the scan only include
+    # the background image if bg_snapshot_interval_frames keeps one on hand, since reconstructing it would stall the
+    # loop; the final checkpoint, written once the scan is over, always includes it. Each checkpoint replaces the
+    # previous one atomically, so the file always holds a complete checkpoint.
+    checkpoint_enabled = False
+    checkpoint_filename = 'heatmap.ckpt'
+    checkpoint_interval_seconds = 10
+
+    # If there's already a checkpoint when a scan starts, pick up where it left off and only capture the rest of the
+    # scan's video_capture_time_seconds, rather than starting over. If the checkpoint is the final one of a scan that
+    # already finished, its results get restored without capturing anything. The checkpoint has to come from a scan at
+    # the same resolution and heatmap_accumulation_mode, or it gets ignored. Heatmap windows and head counts only cover
+    # what gets captured after the resume.
+    checkpoint_resume_enabled = True
+
     ###########################################################################
     # RENDERING CONFIGS
     ###########################################################################
@@ -62,12 +253,47 @@ class HeatmapConfig:
     render_video_filename = 'output.avi'
     render_video_fps = 5
 
+    # Render on a separate worker thread that always picks up the latest heatmap, so that the analysis loop never waits
+    # on rendering
+    render_threaded_enabled = False
+
+    # Render at most this many times per second of video (i.e. per second of real time for live streams); set to 0 to
+    # render every processed frame
+    render_max_fps = 0
+
     # Flatten heatmap values in the bottom x percent (represented as a decimal) to zero to clean up the output
     render_cutoff_percent = 0.0
 
     # Scale all values in the heatmap so that they fall between this value and 255; set to zero for no scaling
     render_brighten_threshold = 0
 
+    ###########################################################################
+    # HOTSPOT CONFIGS
+    ###########################################################################
+
+    # Have the mission scripts save the hotspot_count busiest zones of each heatmap, as non-overlapping squares
+    # hotspot_window_meters wide, next to the heatmap images (see heatmap_hotspots.py). If the camera's altitude isn't
+    # known, the squares are hotspot_window_pixels wide instead.
+    hotspots_enabled = False
+    hotspot_count = 10
+    hotspot_window_meters = 5
+    hotspot_window_pixels = 50
+
+    ###########################################################################
+    # METRICS CONFIGS
+    ###########################################################################
+
+    # Time each stage of the pipeline, and keep track of the achieved sampling rate, dropped frames and memory usage
+    metrics_enabled = False
+
+    # How often the metrics get logged and written to the output file
+    metrics_interval_seconds = 10
+
+    # File the metrics get written to for scraping; set to None to only log them. Valid formats are 'JSON' or
+    # 'PROMETHEUS' (i.e. the Prometheus text exposition format).
+    metrics_output_file = 'heatmap_metrics.json'
+    metrics_output_format = 'JSON'
+
     ###########################################################################
     # LOGGING CONFIGS
     ###########################################################################
@@ -0,0 +1,262 @@
+import asyncio
+import collections
+import math
+import time
+import urllib.parse
+
+"""
+fake_drone.py
+
+This module provides a stand-in for mavsdk.System that simulates a drone well
+enough to run the mission scripts against, so that their timing can be
+benchmarked and their logic tested without PX4 or a simulator. Set
+system_address to 'fake://' in config.py to use it, optionally with a time
+scale to fly faster than real time, e.g. 'fake://?time_scale=10'.
+
+The drone flies in a straight line towards its target, climbing and moving
+horizontally at constant speeds, and every telemetry stream yields a value
+straight away and then at telemetry_rate_hz, just like MAVSDK's. Values are
+named tuples with the same field names as the MAVSDK types the mission
+scripts use. Mission items only need latitude_deg, longitude_deg and
+relative_altitude_m.
+"""
+
+EARTH_RADIUS_METERS = 6378137
+
+ConnectionState = collections.namedtuple('ConnectionState', ['uuid', 'is_connected'])
+Health = collections.namedtuple('Health', ['is_global_position_ok', 'is_home_position_ok', 'is_local_position_ok'])
+Position = collections.namedtuple('Position', ['latitude_deg', 'longitude_deg', 'absolute_altitude_m', 'relative_altitude_m'])
+EulerAngle = collections.namedtuple('EulerAngle', ['roll_deg', 'pitch_deg', 'yaw_deg', 'timestamp_us'])
+MissionItem = collections.namedtuple('MissionItem', ['latitude_deg', 'longitude_deg', 'relative_altitude_m'])
+MissionPlan = collections.namedtuple('MissionPlan', ['mission_items'])
+MissionProgress = collections.namedtuple('MissionProgress', ['current', 'total'])
+
+
+class MissionError(Exception):
+    # Stands in for mavsdk.mission.MissionError, so that the mission scripts can catch the same errors whichever drone
+    # they're flying; the fake drone never actually raises it
+    pass
+
+
+class FakeSystem:
+    # The simulation is advanced lazily, whenever something reads the drone's state, by however much simulated time has
+    # passed since the last read, so it doesn't need a task of its own
+    TAKEOFF_ALTITUDE_METERS = 2.5
+
+    def __init__(self, home_latitude_deg=47.397742, home_longitude_deg=8.545594, home_absolute_altitude_m=488.0, mission_items=None, telemetry_rate_hz=10,
+                 climb_rate_m_s=2.5, speed_m_s=5.0, time_scale=1.0):
+        self.home = Position(home_latitude_deg, home_longitude_deg, home_absolute_altitude_m, 0.0)
+        if mission_items is None:
+            # A square with 40 m sides around the launch point, at 20 m
+            mission_items = [MissionItem(*self._offset(home_latitude_deg, home_longitude_deg, east, north), 20.0) for east, north in ((20, 20), (20, -20), (-20, -20), (-20, 20))]
+        self.mission_items = list(mission_items)
+        self.telemetry_rate_hz = telemetry_rate_hz
+        self.climb_rate_m_s = climb_rate_m_s
+        self.speed_m_s = speed_m_s
+        self.time_scale = time_scale
+        self.num_subscriptions = 0  # Number of telemetry subscriptions opened so far, for benchmarking
+
+        self.latitude_deg, self.longitude_deg, self.relative_altitude_m = home_latitude_deg, home_longitude_deg, 0.0
+        self.yaw_deg = 0.0
+        self.armed = False
+        self.in_air = False
+        self._targets = []  # (latitude_deg, longitude_deg, relative_altitude_m) waypoints to fly through, in order
+        self._landing = False  # Whether to touch down once the last target is reached
+        self._mission_active = False
+        self._mission_index = 0  # Index of the next mission item to fly to
+        self._connected = False
+        self._last_update_time = None
+
+        self.core = _FakeCore(self)
+        self.telemetry = _FakeTelemetry(self)
+        self.action = _FakeAction(self)
+        self.mission = _FakeMission(self)
+
+    async def connect(self, system_address=None):
+        # Accepts a 'fake://' address, optionally with a time_scale query parameter
+        if system_address:
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(system_address).query)
+            if 'time_scale' in query:
+                self.time_scale = float(query['time_scale'][0])
+        self._connected = True
+        self._last_update_time = time.monotonic()
+
+    @staticmethod
+    def _offset(latitude_deg, longitude_deg, east_meters, north_meters):
+        return (latitude_deg + math.degrees(north_meters / EARTH_RADIUS_METERS),
+                longitude_deg + math.degrees(east_meters / (EARTH_RADIUS_METERS * math.cos(math.radians(latitude_deg)))))
+
+    def _update(self):
+        # Flies the drone towards its targets for however much simulated time has passed since the last update
+        now = time.monotonic()
+        remaining_seconds = (now - self._last_update_time) * self.time_scale if self._last_update_time is not None else 0.0
+        self._last_update_time = now
+        while self._targets and remaining_seconds > 0:
+            target_latitude_deg, target_longitude_deg, target_altitude_m = self._targets[0]
+            north_meters = EARTH_RADIUS_METERS * math.radians(target_latitude_deg - self.latitude_deg)
+            east_meters = EARTH_RADIUS_METERS * math.radians(target_longitude_deg - self.longitude_deg) * math.cos(math.radians(self.latitude_deg))
+            distance_meters = math.hypot(east_meters, north_meters)
+            climb_meters = target_altitude_m - self.relative_altitude_m
+            seconds_to_target = max(distance_meters / self.speed_m_s, abs(climb_meters) / self.climb_rate_m_s)
+            if remaining_seconds < seconds_to_target:
+                fraction = remaining_seconds / seconds_to_target
+                self.latitude_deg, self.longitude_deg = self._offset(self.latitude_deg, self.longitude_deg, fraction * east_meters, fraction * north_meters)
+                self.relative_altitude_m += fraction * climb_meters
+                break
+            self.latitude_deg, self.longitude_deg, self.relative_altitude_m = self._targets.pop(0)
+            remaining_seconds -= seconds_to_target
+            self._reach_target()
+
+    def _reach_target(self):
+        if self._mission_active and not self._targets:
+            self._mission_index += 1
+            if self._mission_index < len(self.mission_items):
+                self._fly_to_mission_item()
+            else:
+                self._mission_active = False
+        if self._landing and not self._targets:
+            self._landing = False
+            self.relative_altitude_m = 0.0
+            self.in_air = False
+            self.armed = False
+
+    def _fly_to_mission_item(self):
+        item = self.mission_items[self._mission_index]
+        self._targets = [(item.latitude_deg, item.longitude_deg, item.relative_altitude_m)]
+
+    def _require_armed(self):
+        if not self.armed:
+            raise RuntimeError("Fake drone isn't armed")
+
+    def _position(self):
+        self._update()
+        return Position(self.latitude_deg, self.longitude_deg, self.home.absolute_altitude_m + self.relative_altitude_m, self.relative_altitude_m)
+
+    def _in_air(self):
+        self._update()
+        return self.in_air
+
+    def _mission_progress(self):
+        # current is the number of mission items reached so far, as the mission scripts expect
+        self._update()
+        return MissionProgress(self._mission_index, len(self.mission_items))
+
+    async def _stream(self, get_value, only_changes=False):
+        # Yields get_value() straight away and then at the telemetry rate, or only when it changes if only_changes is set
+        self.num_subscriptions += 1
+        last_value = None
+        while True:
+            value = get_value()
+            if not only_changes or value != last_value:
+                yield value
+            last_value = value
+            await asyncio.sleep(1 / self.telemetry_rate_hz / self.time_scale)
+
+
+class _FakeCore:
+    def __init__(self, drone):
+        self._drone = drone
+
+    def connection_state(self):
+        return self._drone._stream(lambda: ConnectionState('fake', self._drone._connected))
+
+
+class _FakeTelemetry:
+    def __init__(self, drone):
+        self._drone = drone
+
+    def health(self):
+        return self._drone._stream(lambda: Health(self._drone._connected, self._drone._connected, self._drone._connected))
+
+    def home(self):
+        return self._drone._stream(lambda: self._drone.home)
+
+    def position(self):
+        return self._drone._stream(self._drone._position)
+
+    def in_air(self):
+        return self._drone._stream(self._drone._in_air)
+
+    def attitude_euler(self):
+        return self._drone._stream(lambda: EulerAngle(0.0, 0.0, self._drone.yaw_deg, round(1e6 * time.monotonic())))
+
+
+class _FakeAction:
+    def __init__(self, drone):
+        self._drone = drone
+
+    async def arm(self):
+        self._drone.armed = True
+
+    async def get_takeoff_altitude(self):
+        return self._drone.TAKEOFF_ALTITUDE_METERS
+
+    async def takeoff(self):
+        drone = self._drone
+        drone._require_armed()
+        drone._update()
+        drone.in_air = True
+        drone._targets = [(drone.latitude_deg, drone.longitude_deg, drone.TAKEOFF_ALTITUDE_METERS)]
+
+    async def goto_location(self, latitude_deg, longitude_deg, absolute_altitude_m, yaw_deg):
+        drone = self._drone
+        drone._require_armed()
+        drone._update()
+        drone.in_air = True
+        drone._mission_active = False
+        drone.yaw_deg = yaw_deg
+        drone._targets = [(latitude_deg, longitude_deg, absolute_altitude_m - drone.home.absolute_altitude_m)]
+
+    async def land(self):
+        drone = self._drone
+        drone._update()
+        drone._mission_active = False
+        drone._targets = [(drone.latitude_deg, drone.longitude_deg, 0.0)]
+        drone._landing = True
+
+    async def return_to_launch(self):
+        drone = self._drone
+        drone._update()
+        drone._mission_active = False
+        drone._targets = [(drone.home.latitude_deg, drone.home.longitude_deg, drone.relative_altitude_m), (drone.home.latitude_deg, drone.home.longitude_deg, 0.0)]
+        drone._landing = True
+
+    async def terminate(self):
+        drone = self._drone
+        drone._update()
+        drone._targets = []
+        drone._mission_active = False
+        drone.relative_altitude_m = 0.0
+        drone.in_air = False
+        drone.armed = False
+
+
+class _FakeMission:
+    def __init__(self, drone):
+        self._drone = drone
+
+    async def download_mission(self):
+        return MissionPlan(list(self._drone.mission_items))
+
+    async def upload_mission(self, mission_plan):
+        self._drone.mission_items = list(mission_plan.mission_items)
+        self._drone._mission_index = 0
+
+    async def start_mission(self):
+        drone = self._drone
+        drone._require_armed()
+        drone._update()
+        if drone._mission_index < len(drone.mission_items):
+            drone.in_air = True
+            drone._mission_active = True
+            drone._fly_to_mission_item()
+
+    async def pause_mission(self):
+        # Holds position until the mission gets started again
+        drone = self._drone
+        drone._update()
+        drone._mission_active = False
+        drone._targets = []
+
+    def mission_progress(self):
+        return self._drone._stream(self._drone._mission_progress, only_changes=True)
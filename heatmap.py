@@ -1,17 +1,31 @@
 #!/usr/bin/env python3
 
+import bisect
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import json
 import logging
 import math
+import mmap
 import os
+import struct
 import sys
 import threading
 import time
+import zlib
 
 import cv2
 import numpy as np
 
 from config import HeatmapConfig as config
 
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
 """
 heatmap.py
 
@@ -24,52 +38,468 @@ The script can be invoked directly, or can be called indirectly via the
 generate_heatmap() function. The config.HeatmapConfig class provides a rich
 set of configs to support various algorithm options, rendering options, and
 performance-related options (e.g. frame sampling and down-sampling).
+
+To analyse several streams at once, or to feed in frames from elsewhere,
+create a HeatmapGenerator per stream instead, each with its own config
+overrides, and run them with run_heatmap_generators().
 """
 
 
+class _Metrics:
+    # Per-stage timers and counters for a heatmap scan. Timing a stage costs a couple of perf_counter_ns() calls and a
+    # dict update, and everything else only happens once every metrics_interval_seconds, when the metrics get logged as
+    # a JSON line and written to metrics_output_file for scraping. If metrics are disabled, nothing gets recorded.
+    SLEEP_BUCKETS_MILLIS = (1, 5, 10, 50, 100, 500, 1000, math.inf)
+    MAX_FRAME_LATENCIES = 10000  # Latency percentiles are computed over this many of the most recent frames
+
+    def __init__(self, config=config):
+        self._config = config
+        self.enabled = self._config.metrics_enabled
+        self.stage_time_ns = collections.defaultdict(int)
+        self.stage_counts = collections.defaultdict(int)
+        self.sleep_histogram = [0] * len(self.SLEEP_BUCKETS_MILLIS)
+        self.sleep_time_ns = 0
+        self.frame_latencies_ns = collections.deque(maxlen=self.MAX_FRAME_LATENCIES)
+        self.num_frames_processed = 0
+        self.num_frames_dropped = 0
+        self.num_frames_late = 0
+        self.num_pixels = 0
+        self.num_pixels_skipped = 0
+        self._start_time_ns = time.time_ns()
+        self._first_frame_timestamp_ns = None
+        self._last_frame_timestamp_ns = None
+        self._next_emit_time_ns = self._start_time_ns + 1e9 * self._config.metrics_interval_seconds
+
+    def add_time(self, stage, start_time_ns):
+        # Records the time elapsed since start_time_ns, which should come from time.perf_counter_ns()
+        if self.enabled:
+            self.stage_time_ns[stage] += time.perf_counter_ns() - start_time_ns
+            self.stage_counts[stage] += 1
+
+    def add_sleep(self, start_time_ns):
+        # Records time spent sleeping or skipping frames while waiting for the next sample
+        if self.enabled:
+            elapsed_ns = time.perf_counter_ns() - start_time_ns
+            self.sleep_time_ns += elapsed_ns
+            self.sleep_histogram[bisect.bisect_left(self.SLEEP_BUCKETS_MILLIS, 1e-6 * elapsed_ns)] += 1
+
+    def add_frame(self, capture_context, start_time_ns):
+        # Records a processed frame, and the time it took to process it since start_time_ns (from time.perf_counter_ns())
+        if self.enabled:
+            self.frame_latencies_ns.append(time.perf_counter_ns() - start_time_ns)
+            self.num_frames_processed += 1
+            if self._first_frame_timestamp_ns is None:
+                self._first_frame_timestamp_ns = capture_context.frame_timestamp_ns
+            self._last_frame_timestamp_ns = capture_context.frame_timestamp_ns
+            self.num_frames_dropped = capture_context.num_dropped_frames
+            self.num_frames_late = capture_context.num_late_frames
+            if time.time_ns() >= self._next_emit_time_ns:
+                self.emit()
+
+    def add_skipped_pixels(self, num_pixels, num_skipped_pixels):
+        # Records how many of a frame's pixels were left out of noise reduction and accumulation, i.e. those outside the
+        # ROI or in idle tiles
+        if self.enabled:
+            self.num_pixels += num_pixels
+            self.num_pixels_skipped += num_skipped_pixels
+
+    def snapshot(self):
+        if self.num_frames_processed > 1 and self._last_frame_timestamp_ns > self._first_frame_timestamp_ns:
+            achieved_sampling_rate = 1e9 * (self.num_frames_processed - 1) / (self._last_frame_timestamp_ns - self._first_frame_timestamp_ns)
+        else:
+            achieved_sampling_rate = 0.0
+        peak_rss_bytes = None
+        if resource is not None:
+            # ru_maxrss is reported in kilobytes on Linux, but in bytes on macOS
+            peak_rss_bytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        return {
+            'elapsed_seconds': 1e-9 * (time.time_ns() - self._start_time_ns),
+            'frames_processed': self.num_frames_processed,
+            'frames_dropped': self.num_frames_dropped,
+            'frames_late': self.num_frames_late,
+            'pixels_skipped_fraction': self.num_pixels_skipped / self.num_pixels if self.num_pixels else 0.0,
+            'sampling_rate_configured_hz': 1e3 / self._config.frame_sampling_interval_millis if self._config.frame_sampling_enabled else None,
+            'sampling_rate_achieved_hz': achieved_sampling_rate,
+            'frame_latency_millis': {f'p{percentile}': float(1e-6 * np.percentile(self.frame_latencies_ns, percentile)) if self.frame_latencies_ns else None for percentile in (50, 90, 99)},
+            'stages': {stage: {'seconds_total': 1e-9 * self.stage_time_ns[stage], 'count': self.stage_counts[stage], 'mean_millis': 1e-6 * self.stage_time_ns[stage] / self.stage_counts[stage]} for stage in self.stage_time_ns},
+            'sleep_seconds_total': 1e-9 * self.sleep_time_ns,
+            'sleep_histogram_millis': {str(bucket): count for bucket, count in zip(self.SLEEP_BUCKETS_MILLIS, self.sleep_histogram)},
+            'peak_rss_bytes': peak_rss_bytes,
+        }
+
+    def emit(self):
+        # Logs the metrics and writes them to the output file, replacing it atomically so that scrapers never see a
+        # partially written file
+        if not self.enabled:
+            return
+        self._next_emit_time_ns = time.time_ns() + 1e9 * self._config.metrics_interval_seconds
+        snapshot = self.snapshot()
+        logging.info(f"Heatmap metrics: {json.dumps(snapshot)}")
+        if self._config.metrics_output_file:
+            contents = self._format_prometheus(snapshot) if self._config.metrics_output_format == 'PROMETHEUS' else json.dumps(snapshot, indent=2)
+            temp_file = f'{self._config.metrics_output_file}.tmp'
+            with open(temp_file, 'w') as f:
+                f.write(contents)
+            os.replace(temp_file, self._config.metrics_output_file)
+
+    @staticmethod
+    def _format_prometheus(snapshot):
+        lines = [
+            f"heatmap_elapsed_seconds {snapshot['elapsed_seconds']}",
+            f"heatmap_frames_processed_total {snapshot['frames_processed']}",
+            f"heatmap_frames_dropped_total {snapshot['frames_dropped']}",
+            f"heatmap_frames_late_total {snapshot['frames_late']}",
+            f"heatmap_pixels_skipped_ratio {snapshot['pixels_skipped_fraction']}",
+            f"heatmap_sampling_rate_achieved_hz {snapshot['sampling_rate_achieved_hz']}",
+        ]
+        if snapshot['sampling_rate_configured_hz'] is not None:
+            lines.append(f"heatmap_sampling_rate_configured_hz {snapshot['sampling_rate_configured_hz']}")
+        if snapshot['peak_rss_bytes'] is not None:
+            lines.append(f"heatmap_peak_rss_bytes {snapshot['peak_rss_bytes']}")
+        for percentile, millis in snapshot['frame_latency_millis'].items():
+            if millis is not None:
+                lines.append(f'heatmap_frame_latency_seconds{{quantile="{int(percentile[1:]) / 100}"}} {1e-3 * millis}')
+        for stage, stats in snapshot['stages'].items():
+            lines.append(f'heatmap_stage_seconds_total{{stage="{stage}"}} {stats["seconds_total"]}')
+            lines.append(f'heatmap_stage_count_total{{stage="{stage}"}} {stats["count"]}')
+        cumulative_count = 0
+        for bucket, count in snapshot['sleep_histogram_millis'].items():
+            cumulative_count += count
+            upper_bound = '+Inf' if bucket == 'inf' else 1e-3 * float(bucket)
+            lines.append(f'heatmap_sleep_seconds_bucket{{le="{upper_bound}"}} {cumulative_count}')
+        lines.append(f"heatmap_sleep_seconds_sum {snapshot['sleep_seconds_total']}")
+        lines.append(f"heatmap_sleep_seconds_count {cumulative_count}")
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics of the most recent heatmap scan, so that save_images() can add the time spent writing its output
+_latest_metrics: _Metrics = None
+
+# Names of all the options in config.HeatmapConfig
+_CONFIG_OPTIONS = [name for name in vars(config) if not name.startswith('__')]
+
+
+class _FrameRingBuffer:
+    # A bounded ring of preallocated frame buffers shared by a single producer (the reader thread) and a single consumer
+    # (the analysis loop). The buffer handed out to the consumer is left alone until the consumer asks for the next
+    # frame, so one more buffer than the configured capacity gets allocated.
+    buffers: list
+    num_dropped = 0
+    _filled: collections.deque  # Indices of buffers holding unread frames, oldest first
+    _free: collections.deque
+    _held = None  # Index of the buffer currently owned by the consumer
+    _closed = False
+
+    def __init__(self, capacity, drop_oldest):
+        self.buffers = [None] * (capacity + 1)
+        self._timestamps_ns = [0] * (capacity + 1)
+        self._filled = collections.deque()
+        self._free = collections.deque(range(capacity + 1))
+        self.drop_oldest = drop_oldest
+        self._condition = threading.Condition()
+
+    def allocate(self, shape, dtype):
+        for i in range(len(self.buffers)):
+            self.buffers[i] = np.empty(shape, dtype)
+
+    def acquire(self):
+        # Returns the index of a buffer the producer can write the next frame into, or None once the ring is closed. If
+        # the ring is full, either evict the oldest unread frame or wait for the consumer, depending on the drop policy.
+        with self._condition:
+            while not self._free and not self._closed:
+                if self.drop_oldest:
+                    self.num_dropped += 1
+                    return self._filled.popleft()
+                self._condition.wait()
+            if self._closed:
+                return None
+            return self._free.popleft()
+
+    def publish(self, index, timestamp_ns):
+        with self._condition:
+            self._timestamps_ns[index] = timestamp_ns
+            self._filled.append(index)
+            self._condition.notify_all()
+
+    def take(self, newest=False):
+        # Blocks until a frame is available and returns it along with its capture timestamp. Returns (None, 0) once the
+        # ring has been closed and drained. If newest is True, every unread frame but the most recent one gets thrown
+        # away and counted as dropped.
+        with self._condition:
+            if self._held is not None:
+                self._free.append(self._held)
+                self._held = None
+                self._condition.notify_all()
+            while not self._filled and not self._closed:
+                self._condition.wait()
+            if not self._filled:
+                return None, 0
+            if newest and len(self._filled) > 1:
+                self.num_dropped += len(self._filled) - 1
+                self._free.extend(self._filled.popleft() for _ in range(len(self._filled) - 1))
+                self._condition.notify_all()
+            self._held = self._filled.popleft()
+            return self.buffers[self._held], self._timestamps_ns[self._held]
+
+    def discard_unread(self):
+        # Throws away every frame the consumer hasn't read yet, e.g. stale frames left over from before a scan started
+        with self._condition:
+            self._free.extend(self._filled)
+            self._filled.clear()
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
 class _CaptureContext:
     capture: cv2.VideoCapture
     is_live: bool
-    _cutoff_time_ns: int  # Used only if is_live is True
-    _cutoff_frame: int  # Used only if is_live is False
+    frame_timestamp_ns = 0  # Capture time of the last frame read if is_live is True, or its position in the file if not
+    num_late_frames = 0
+    _cutoff_time_ns = 0  # End of the current scan; used only if is_live is True
+    _cutoff_frame = 0  # End of the current scan; used only if is_live is False
+    _last_frame: float  # End of the frame range being read; used only if is_live is False
+    _fps: float
+    _sample_frames: list = None  # Frame indices to sample; used only for the 'STRIDE' and 'SEEK' file strategies
     _num_frames_read = 0
     _last_capture_time_ns = 0
+    _ring_buffer: _FrameRingBuffer = None  # Used only if config.capture_threaded_enabled is True
+    _reader_thread: threading.Thread = None
+    frame_size: tuple  # (width, height) of the frames handed out by read(), after any down-sampling
+    down_sampling_size: tuple = None  # (width, height) to down-sample frames to, or None to leave them as they are
+    kernel_scale = 1.0  # How much to scale the noise reduction kernels by for the resolution frames are analysed at
+    _dropped_frames_base = 0  # Frames the ring buffer had already dropped when the current scan started
 
-    def __init__(self):
+    def __init__(self, config=config, first_frame=0, last_frame=None, metrics=None, persistent=False):
+        # first_frame and last_frame restrict a FILE capture to the frame range [first_frame, last_frame). A persistent
+        # capture stays open for several scans (see HeatmapSession): it reads up to the end of the file rather than
+        # stopping after video_capture_time_seconds, and each scan has to be started with start_scan().
+        self._config = config
+        self._metrics = metrics if metrics is not None else _Metrics(config)
+        if self._config.capture_threaded_enabled and self._config.capture_buffer_size < 1:
+            raise ValueError(f"capture_buffer_size has to be at least 1, not {self._config.capture_buffer_size}")
 
         # Initialize the video stream
-        if config.video_capture_mode == 'FILE':
-            logging.info(f"Initializing video stream from file: {config.video_capture_input_filename}")
-            self.capture = cv2.VideoCapture(config.video_capture_input_filename)
+        if self._config.video_capture_mode == 'FILE':
+            logging.info(f"Initializing video stream from file: {self._config.video_capture_input_filename}")
+            self.capture = cv2.VideoCapture(self._config.video_capture_input_filename)
             self.is_live = False
-        elif config.video_capture_mode == 'CAMERA_GSTREAMER':
-            logging.info(f"Initializing live video stream from camera via gstreamer pipeline: {config.video_capture_gstreamer_pipeline}")
-            self.capture = cv2.VideoCapture(config.video_capture_gstreamer_pipeline, cv2.CAP_GSTREAMER)
+        elif self._config.video_capture_mode == 'CAMERA_GSTREAMER':
+            logging.info(f"Initializing live video stream from camera via gstreamer pipeline: {self._config.video_capture_gstreamer_pipeline}")
+            self.capture = cv2.VideoCapture(self._config.video_capture_gstreamer_pipeline, cv2.CAP_GSTREAMER)
             self.is_live = True
         else:
-            logging.info("Initializing live video stream directly from camera")
-            self.capture = cv2.VideoCapture(0)
+            logging.info(f"Initializing live video stream directly from camera {self._config.video_capture_camera_index}")
+            self.capture = cv2.VideoCapture(self._config.video_capture_camera_index)
             self.is_live = True
         if not self.capture.isOpened():
             logging.error("Unable to open video capture")
             raise IOError
 
-        # If capturing a live stream, stop capturing after the configured amount of time has passed. If capturing from
-        # a video file, stop capturing after hitting the appropriate frame.
-        logging.info(f"Heatmap scan scheduled to last {config.video_capture_time_seconds} for seconds")
+        self._sensor_size = (int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        self._update_down_sampling()
+
+        # If capturing a video file, stop reading after hitting the appropriate frame
+        self._fps = self.capture.get(cv2.CAP_PROP_FPS)
+        if not self.is_live:
+            self._last_frame = math.inf if persistent else self._fps * self._config.video_capture_time_seconds
+            frame_count = self.capture.get(cv2.CAP_PROP_FRAME_COUNT)
+            if frame_count > 0:
+                self._last_frame = min(self._last_frame, frame_count)
+            if last_frame is not None:
+                self._last_frame = min(self._last_frame, last_frame)
+            if first_frame > 0:
+                self.capture.set(cv2.CAP_PROP_POS_FRAMES, first_frame)
+                self._num_frames_read = first_frame
+
+        # Work out which frames to sample ahead of time, so that skipping to the next one doesn't depend on how long
+        # the analysis of the previous one took
+        if not self.is_live and self._config.frame_sampling_enabled and self._config.frame_sampling_file_strategy != 'REALTIME':
+            if self._last_frame < math.inf:
+                self._sample_frames = _get_sample_frames(self._fps, self._last_frame, self._config)
+                logging.info(f"Sampling {len(self._sample_frames)} frames from file using the {self._config.frame_sampling_file_strategy} strategy")
+            else:
+                logging.warning("Video file doesn't report its frame count; falling back to the REALTIME sampling strategy")
+
+        if self._config.capture_threaded_enabled:
+            self._start_reader()
+        if not persistent:
+            self.start_scan()
+
+    @property
+    def fps(self):
+        return self._fps
+
+    @property
+    def num_frames_read(self):
+        return self._num_frames_read
+
+    @property
+    def seconds_left(self):
+        # Seconds of video left before the end of a file capture, or infinity for a live stream
+        if self.is_live:
+            return math.inf
+        return (self._last_frame - self._num_frames_read) / self._fps
+
+    @property
+    def num_dropped_frames(self):
+        # Frames dropped since the current scan started
+        return self._ring_buffer.num_dropped - self._dropped_frames_base if self._ring_buffer is not None else 0
+
+    def _update_down_sampling(self):
+        down_sampling_size, kernel_scale = _get_down_sampling(self._config, *self._sensor_size)
+        if down_sampling_size != self.down_sampling_size or kernel_scale != self.kernel_scale:
+            logging.info(f"Analysing frames at {down_sampling_size or self._sensor_size} with noise reduction kernels scaled by {kernel_scale:.2f}")
+        self.down_sampling_size, self.kernel_scale = down_sampling_size, kernel_scale
+        self.frame_size = down_sampling_size if down_sampling_size is not None else self._sensor_size
+
+    def set_config(self, config):
+        # Switches a persistent capture over to the config of the next scan, e.g. one at a different altitude. Only the
+        # down-sampling gets worked out again; nothing else about the capture itself changes.
+        self._config = config
+        self._update_down_sampling()
+
+    def start_scan(self, metrics=None, config=None, seconds_captured=0):
+        # Starts a scan from the current position in the stream. If capturing a live stream, the scan stops after the
+        # configured amount of time has passed. If capturing from a video file, it stops after hitting the appropriate
+        # frame. If seconds_captured of the scan were already captured before it got cut off (see
+        # config.checkpoint_resume_enabled), only the rest of it gets captured.
+        if config is not None:
+            self.set_config(config)
+        scan_seconds = max(0, self._config.video_capture_time_seconds - seconds_captured)
+        if seconds_captured:
+            logging.info(f"Heatmap scan resumed with {scan_seconds:.1f} of its {self._config.video_capture_time_seconds} seconds left")
+        else:
+            logging.info(f"Heatmap scan scheduled to last {self._config.video_capture_time_seconds} for seconds")
+        if metrics is not None:
+            self._metrics = metrics
         if self.is_live:
-            self._cutoff_time_ns = time.time_ns() + 1e9 * config.video_capture_time_seconds
+            if self._ring_buffer is not None:
+                self._ring_buffer.discard_unread()
+            self._cutoff_time_ns = time.time_ns() + 1e9 * scan_seconds
         else:
-            fps = self.capture.get(cv2.CAP_PROP_FPS)
-            self._cutoff_frame = fps * config.video_capture_time_seconds
+            self._cutoff_frame = min(self._last_frame, self._num_frames_read + self._fps * scan_seconds)
+        self._dropped_frames_base = self._ring_buffer.num_dropped if self._ring_buffer is not None else 0
+        self.num_late_frames = 0
+
+    def seek(self, frame):
+        # Moves a file capture on to the given frame, or to the first one after it that's due to be sampled, e.g. to pick
+        # a scan back up where it left off. The reader thread, if there is one, gets restarted from there.
+        if self._reader_thread is not None:
+            self._ring_buffer.close()
+            self._reader_thread.join()
+        self.capture.set(cv2.CAP_PROP_POS_FRAMES, frame)
+        self._num_frames_read = frame
+        if self._reader_thread is not None:
+            self._start_reader()
+        elif self._sample_frames is not None:
+            self._num_frames_read = self._advance_to_next_sample(frame)
+
+    def _start_reader(self):
+        drop_oldest = self._config.capture_buffer_drop_policy == 'DROP_OLDEST'
+        if drop_oldest and not self.is_live:
+            logging.info("Reading from a file; the capture reader thread will block rather than drop frames")
+            drop_oldest = False
+        logging.info(f"Starting capture reader thread with a buffer of {self._config.capture_buffer_size} frames")
+        self._ring_buffer = _FrameRingBuffer(self._config.capture_buffer_size, drop_oldest)
+        self._reader_thread = threading.Thread(target=self._run_reader, name='capture-reader', daemon=True)
+        self._reader_thread.start()
+
+    def _run_reader(self):
+        # Decode into a scratch buffer, then either down-sample straight into a ring buffer slot or swap the scratch
+        # buffer with the slot, so that steady-state reading doesn't allocate any frame-sized arrays.
+        decode_buffer = None
+        position = self._num_frames_read
+        try:
+            while True:
+                if self._sample_frames is not None:
+                    position = self._advance_to_next_sample(position)
+                if not self.is_live and position >= self._last_frame:
+                    break
+                start_time_ns = time.perf_counter_ns()
+                success, decode_buffer = self.capture.read(decode_buffer)
+                if not success:
+                    break
+                self._metrics.add_time('decode', start_time_ns)
+                timestamp_ns = time.time_ns() if self.is_live else round(1e9 * position / self._fps)
+                position += 1
+                down_sampling_size = self.down_sampling_size
+                if self._ring_buffer.buffers[0] is None:
+                    width, height = down_sampling_size if down_sampling_size is not None else (decode_buffer.shape[1], decode_buffer.shape[0])
+                    self._ring_buffer.allocate((height, width) + decode_buffer.shape[2:], decode_buffer.dtype)
+                index = self._ring_buffer.acquire()
+                if index is None:
+                    break
+                if down_sampling_size is not None:
+                    start_time_ns = time.perf_counter_ns()
+                    if self._ring_buffer.buffers[index].shape[1::-1] != down_sampling_size:
+                        # The down-sampling changed between scans, so this slot needs reallocating
+                        self._ring_buffer.buffers[index] = np.empty(down_sampling_size[::-1] + decode_buffer.shape[2:], decode_buffer.dtype)
+                    cv2.resize(decode_buffer, down_sampling_size, dst=self._ring_buffer.buffers[index], interpolation=cv2.INTER_AREA)
+                    self._metrics.add_time('resize', start_time_ns)
+                else:
+                    self._ring_buffer.buffers[index], decode_buffer = decode_buffer, self._ring_buffer.buffers[index]
+                self._ring_buffer.publish(index, timestamp_ns)
+        finally:
+            self._ring_buffer.close()
 
     def read(self):
-        success, frame = self.capture.read()
+        # Returns the next frame, already down-sampled if configured
+        if self._ring_buffer is not None:
+            # When sampling a live stream that drops frames anyway, go straight to the newest one, so that samples follow
+            # the wall clock rather than lagging a buffer's worth of frames behind it
+            newest = self._ring_buffer.drop_oldest and self._config.frame_sampling_enabled
+            frame, timestamp_ns = self._ring_buffer.take(newest)
+            while frame is not None and frame.shape[1::-1] != self.frame_size:
+                # Left over from before the down-sampling changed
+                frame, timestamp_ns = self._ring_buffer.take(newest)
+            success = frame is not None
+            if success and self.is_live and time.time_ns() - timestamp_ns > 1e6 * self._config.capture_late_frame_threshold_millis:
+                self.num_late_frames += 1
+        else:
+            start_time_ns = time.perf_counter_ns()
+            success, frame = self.capture.read()
+            self._metrics.add_time('decode', start_time_ns)
+            timestamp_ns = time.time_ns() if self.is_live else round(1e9 * self._num_frames_read / self._fps)
+            if success and self.down_sampling_size is not None:
+                start_time_ns = time.perf_counter_ns()
+                frame = cv2.resize(frame, self.down_sampling_size, interpolation=cv2.INTER_AREA)
+                self._metrics.add_time('resize', start_time_ns)
         if success:
-            self._num_frames_read += 1
-            self._last_capture_time_ns = time.time_ns()
+            # The reader thread may have skipped frames, so for files work out where in the stream this one came from
+            self._num_frames_read = self._num_frames_read + 1 if self.is_live or self._ring_buffer is None else round(1e-9 * timestamp_ns * self._fps) + 1
+            self._last_capture_time_ns = timestamp_ns if self.is_live else time.time_ns()
+            self.frame_timestamp_ns = timestamp_ns
         return success, frame
 
+    def _skip(self):
+        # Discards the next frame without decoding it (or, if the reader thread already decoded it, without using it)
+        if self._ring_buffer is not None:
+            success = self._ring_buffer.take()[0] is not None
+        else:
+            success = self.capture.grab()
+        if success:
+            self._num_frames_read += 1
+        return success
+
+    def _advance_to_next_sample(self, position):
+        # Moves the file capture from the given frame index to the next frame in _sample_frames, and returns the new
+        # frame index. Returns the last frame once every sample has been read.
+        next_sample = bisect.bisect_left(self._sample_frames, position)
+        if next_sample == len(self._sample_frames):
+            return self._last_frame
+        target = self._sample_frames[next_sample]
+        if self._config.frame_sampling_file_strategy == 'SEEK':
+            if target > position:
+                self.capture.set(cv2.CAP_PROP_POS_FRAMES, target)
+            return target
+        while position < target and self.capture.grab():
+            position += 1
+        return position
+
     def is_expired(self):
         if not self.capture.isOpened():
             logging.warning("Video capture is no longer open; signaling to end heatmap scan")
@@ -80,125 +510,1648 @@ class _CaptureContext:
             return self._num_frames_read >= self._cutoff_frame
 
     def sleep_until_time_to_read(self):
-        if not config.frame_sampling_enabled:
+        if not self._config.frame_sampling_enabled:
             return
-        next_sample_time_ns = self._last_capture_time_ns + 1e6 * config.frame_sampling_interval_millis
+        start_time_ns = time.perf_counter_ns()
+        if self._sample_frames is not None:
+            # The reader thread, if there is one, already skips ahead on its own
+            if self._ring_buffer is None:
+                self._num_frames_read = self._advance_to_next_sample(self._num_frames_read)
+                self._metrics.add_sleep(start_time_ns)
+            return
+        next_sample_time_ns = self._last_capture_time_ns + 1e6 * self._config.frame_sampling_interval_millis
         time_to_sleep_seconds = 1e-9 * (next_sample_time_ns - time.time_ns())
         if time_to_sleep_seconds <= 0:
             return
         if self.is_live:
             time.sleep(time_to_sleep_seconds)
         else:
-            fps = self.capture.get(cv2.CAP_PROP_FPS)
-            frames_to_skip = math.ceil(fps * time_to_sleep_seconds)
+            frames_to_skip = math.ceil(self._fps * time_to_sleep_seconds)
             for x in range(0, frames_to_skip):
-                self.read()
+                if not self._skip():
+                    break
+        self._metrics.add_sleep(start_time_ns)
 
     def close(self):
+        if self._reader_thread is not None:
+            self._ring_buffer.close()
+            self._reader_thread.join()
+            logging.info(f"Capture reader stopped; frames read: {self._num_frames_read}, dropped: {self.num_dropped_frames}, late: {self.num_late_frames}")
         if self.capture.isOpened():
             logging.info("Closing video capture stream")
             self.capture.release()
 
 
+def _get_down_sampling(config, frame_width, frame_height):
+    # Returns the (width, height) to down-sample frames of the given size to, or None to leave them as they are, along
+    # with how much to scale the noise reduction kernels by. In 'GSD' mode, the size is picked so that the ground gets
+    # covered at down_sampling_target_pixels_per_metre from camera_altitude_meters, and the kernel sizes are taken to
+    # be at that resolution. If the camera can't resolve the ground that finely, frames are left alone and the kernels
+    # shrink to match.
+    if not config.down_sampling_enabled:
+        return None, 1.0
+    if config.down_sampling_mode != 'GSD':
+        return tuple(config.down_sampling_size), 1.0
+    if not config.camera_altitude_meters or frame_width <= 0 or frame_height <= 0:
+        logging.warning(f"Camera altitude or frame size unknown; down-sampling to the fixed size of {config.down_sampling_size} instead")
+        return tuple(config.down_sampling_size), 1.0
+    ground_width_meters = 2 * config.camera_altitude_meters * math.tan(math.radians(config.camera_horizontal_fov_degrees) / 2)
+    width = round(ground_width_meters * config.down_sampling_target_pixels_per_metre)
+    if width >= frame_width:
+        kernel_scale = frame_width / ground_width_meters / config.down_sampling_target_pixels_per_metre
+        logging.debug(f"Camera resolves {frame_width / ground_width_meters:.1f} pixels per metre at {config.camera_altitude_meters}m; not down-sampling")
+        return None, kernel_scale
+    size = (width, max(1, round(width * frame_height / frame_width)))
+    logging.debug(f"Down-sampling to {size} for {config.down_sampling_target_pixels_per_metre} pixels per metre at {config.camera_altitude_meters}m")
+    return size, 1.0
+
+
+def _get_sample_frames(fps, cutoff_frame, config=config):
+    # Returns the indices of the frames to sample from a video file, spaced frame_sampling_interval_millis apart in
+    # stream time
+    frames_per_sample = max(1.0, 1e-3 * fps * config.frame_sampling_interval_millis)
+    return sorted({round(i * frames_per_sample) for i in range(math.ceil(cutoff_frame / frames_per_sample))})
+
+
+class _HeatmapAccumulator:
+    # Counts the number of frames in which each pixel was part of the foreground. Since the foreground mask is binary,
+    # a uint16 counter is enough to start with; it gets promoted to int32 (OpenCV has no unsigned 32-bit type) before it
+    # could saturate. Masks are added in place, without converting them or allocating any temporaries.
+    #
+    # Once value_range() has been asked for, the (min, max) of the counts gets kept up to date as masks are added, by
+    # looking only at the pixels that went up, so that rendering every frame doesn't mean scanning the counts every
+    # frame. Since counts only ever go up, the max follows from the pixels that went up, and the min only changes once
+    # every pixel at the min went up, which gets noticed by keeping track of how many pixels are at the min. Only then,
+    # or after a merge, do the counts get scanned again.
+    counts: np.ndarray = None
+    num_frames = 0
+    _value_range: tuple = None  # Tracked (min, max) of counts, or None if they need scanning again
+    _num_at_min = 0  # Number of pixels at the tracked min
+    _scratch: np.ndarray = None  # Preallocated comparison mask for keeping track of the pixels at the min
+
+    def add(self, fg_mask, regions=None):
+        # If given, only the (x0, y0, x1, y1) regions of the mask get added; the mask has to be empty everywhere else
+        if self.counts is None:
+            self.counts = np.zeros(fg_mask.shape, 'uint16')
+        elif self.num_frames == np.iinfo(self.counts.dtype).max:
+            self._promote()
+        if regions is None:
+            cv2.add(self.counts, 1, dst=self.counts, mask=fg_mask)
+            self._track_added(self.counts, fg_mask, self._scratch)
+        else:
+            for x0, y0, x1, y1 in regions:
+                counts = self.counts[y0:y1, x0:x1]
+                cv2.add(counts, 1, dst=counts, mask=fg_mask[y0:y1, x0:x1])
+                self._track_added(counts, fg_mask[y0:y1, x0:x1], self._scratch[y0:y1, x0:x1] if self._scratch is not None else None)
+        self.num_frames += 1
+        self._check_min()
+
+    def _track_added(self, counts, mask, scratch):
+        # Updates the tracked (min, max) after the masked pixels of counts went up by 1. The pixels that were at the min
+        # are now at min + 1, and counting them only takes a pass over counts if any of them were in the mask.
+        if self._value_range is None:
+            return
+        min_value, max_value = self._value_range
+        added_min, added_max = cv2.minMaxLoc(counts, mask)[:2]
+        if added_max == 0:
+            # Nothing was added
+            return
+        if added_min == min_value + 1:
+            cv2.compare(counts, min_value + 1, cv2.CMP_EQ, dst=scratch)
+            cv2.bitwise_and(scratch, mask, dst=scratch)
+            self._num_at_min -= cv2.countNonZero(scratch)
+        self._value_range = (min_value, max(max_value, added_max))
+
+    def _check_min(self):
+        # Once no pixel is left at the tracked min, the min has gone up, and the counts need scanning again to find out
+        # by how much
+        if self._value_range is not None and self._num_at_min == 0:
+            self._value_range = None
+
+    def merge(self, other):
+        if other.counts is None:
+            return
+        if self.counts is None:
+            self.counts = np.zeros(other.counts.shape, other.counts.dtype)
+        if self.num_frames + other.num_frames > np.iinfo(self.counts.dtype).max:
+            self._promote()
+        cv2.add(self.counts, other.counts, dst=self.counts, dtype=cv2.CV_16U if self.counts.dtype == np.uint16 else cv2.CV_32S)
+        self.num_frames += other.num_frames
+        self._value_range = None
+
+    def _promote(self):
+        if self.counts.dtype == np.uint16:
+            logging.debug("Promoting heatmap accumulator from uint16 to int32")
+            self.counts = self.counts.astype('int32')
+
+    def value_range(self):
+        # Returns the (min, max) of the counts, scanning them only if they can't be tracked from the last scan
+        if self._value_range is None:
+            self._value_range = cv2.minMaxLoc(self.counts)[:2]
+            if self._scratch is None or self._scratch.shape != self.counts.shape:
+                self._scratch = np.empty(self.counts.shape, 'uint8')
+            cv2.compare(self.counts, self._value_range[0], cv2.CMP_EQ, dst=self._scratch)
+            self._num_at_min = cv2.countNonZero(self._scratch)
+        return self._value_range
+
+    @property
+    def nbytes(self):
+        return self.counts.nbytes if self.counts is not None else 0
+
+
+class _WindowedHeatmapAccumulator(_HeatmapAccumulator):
+    # Also keeps track of the heatmap over a recent window of time, with constant work per frame and in memory that
+    # doesn't grow with the length of the scan. In 'SLIDING' mode, the counts get snapshotted at every interval boundary
+    # into a bounded ring of uint16's. Since uint16 arithmetic wraps around, the counts over any window covered by the
+    # ring are just the current counts minus the snapshot at the start of the window, modulo 2^16, which is exact as long
+    # as the window holds fewer than 2^16 frames. In 'DECAY' mode, an exponentially decaying average of the foreground
+    # masks is kept instead. Windows can be queried from another thread while frames are being added.
+    MAX_SLIDING_WINDOW_FRAMES = np.iinfo('uint16').max
+    _snapshots: collections.deque  # (timestamp_ns, num_frames, counts modulo 2^16) at each interval boundary, oldest first
+    _next_snapshot_time_ns = 0
+    _decayed: np.ndarray = None
+    _last_timestamp_ns = None
+
+    def __init__(self, config=config):
+        self._mode = config.heatmap_window_mode
+        self._window_seconds = config.heatmap_window_seconds
+        self._interval_ns = round(1e9 * config.heatmap_window_interval_seconds)
+        self._half_life_ns = 1e9 * config.heatmap_window_half_life_seconds
+        self._snapshots = collections.deque(maxlen=math.ceil(config.heatmap_window_seconds / config.heatmap_window_interval_seconds) + 1)
+        self._lock = threading.Lock()
+
+    def add(self, fg_mask, timestamp_ns=None, regions=None):
+        timestamp_ns = timestamp_ns if timestamp_ns is not None else time.time_ns()
+        with self._lock:
+            if self._mode == 'SLIDING':
+                self._take_snapshots(fg_mask.shape, timestamp_ns)
+                super().add(fg_mask, regions)
+            else:
+                super().add(fg_mask, regions)
+                self._decay(fg_mask, timestamp_ns)
+            self._last_timestamp_ns = timestamp_ns
+
+    def _take_snapshots(self, shape, timestamp_ns):
+        # Snapshots the counts (as they were before the frame at timestamp_ns) at every interval boundary crossed since
+        # the previous frame, reusing the oldest snapshot's buffer once the ring is full. The first snapshot holds whatever
+        # counts were there to begin with, e.g. those restored from a checkpoint, so that windows only cover new frames.
+        if not self._snapshots:
+            self._snapshots.append((timestamp_ns, self.num_frames, np.zeros(shape, 'uint16') if self.counts is None else self.counts.astype('uint16')))
+            self._next_snapshot_time_ns = timestamp_ns + self._interval_ns
+            return
+        num_boundaries = (timestamp_ns - self._next_snapshot_time_ns) // self._interval_ns + 1
+        if num_boundaries > self._snapshots.maxlen:
+            # Boundaries that would get pushed straight back out of the ring don't need snapshotting
+            self._next_snapshot_time_ns += (num_boundaries - self._snapshots.maxlen) * self._interval_ns
+        while timestamp_ns >= self._next_snapshot_time_ns:
+            snapshot = self._snapshots[0][2] if len(self._snapshots) == self._snapshots.maxlen else np.empty(shape, 'uint16')
+            np.copyto(snapshot, self.counts, casting='unsafe')
+            self._snapshots.append((self._next_snapshot_time_ns, self.num_frames, snapshot))
+            self._next_snapshot_time_ns += self._interval_ns
+
+    def _decay(self, fg_mask, timestamp_ns):
+        # Decays the average according to the time since the previous frame, so that each frame's weight halves every
+        # half-life no matter how irregularly frames arrive. The average ends up on the same 0-255 scale as the masks.
+        if self._decayed is None:
+            self._decayed = np.zeros(fg_mask.shape, 'float32')
+            alpha = 1.0
+        else:
+            alpha = 1 - 0.5 ** (max(0, timestamp_ns - self._last_timestamp_ns) / self._half_life_ns)
+        cv2.accumulateWeighted(fg_mask, self._decayed, alpha)
+
+    def merge(self, other):
+        with self._lock:
+            super().merge(other)
+
+    def window(self, seconds=None):
+        # Returns the counts over the most recent `seconds` of the scan (heatmap_window_seconds by default), rounded out
+        # to whole intervals, or the decayed average in 'DECAY' mode. Returns None if nothing has been added yet.
+        seconds = seconds if seconds is not None else self._window_seconds
+        with self._lock:
+            if self._mode == 'DECAY':
+                return self._decayed.copy() if self._decayed is not None else None
+            if not self._snapshots:
+                return None
+            window_start_ns = self._last_timestamp_ns - 1e9 * seconds
+            start = self._snapshots[0]
+            for snapshot in self._snapshots:
+                if snapshot[0] > window_start_ns:
+                    break
+                start = snapshot
+            if self.num_frames - start[1] > self.MAX_SLIDING_WINDOW_FRAMES:
+                raise ValueError(f"Heatmap window holds more than {self.MAX_SLIDING_WINDOW_FRAMES} frames; use a shorter window or a lower sampling rate")
+            counts = self.counts if self.counts.dtype == np.uint16 else self.counts.astype('uint16')
+            return np.subtract(counts, start[2])
+
+    @property
+    def nbytes(self):
+        window_nbytes = sum(snapshot[2].nbytes for snapshot in self._snapshots)
+        window_nbytes += self._decayed.nbytes if self._decayed is not None else 0
+        return super().nbytes + window_nbytes
+
+
+class _OccupancyAccumulator(_HeatmapAccumulator):
+    # Counts people rather than foreground pixels. Each frame's mask gets split into connected blobs, blobs whose
+    # centroids are close enough to belong to the same person get merged, and a Gaussian footprint peaking at 1 gets
+    # added at each person's position, so the counts come out as the number of frames someone was standing at each pixel,
+    # blurred out over about a person's size. The number of people found in each frame is kept in head_counts. All of
+    # this takes time linear in the number of pixels and blobs. The blob sizes get multiplied by kernel_scale, just like
+    # the noise reduction kernel sizes.
+    _labels: np.ndarray = None  # Preallocated output of the connected component labelling
+
+    def __init__(self, config=config, metrics=None, kernel_scale=1.0):
+        self._config = config
+        self._metrics = metrics if metrics is not None else _Metrics(config)
+        self.head_counts = []
+        self.set_kernel_scale(kernel_scale)
+
+    def set_kernel_scale(self, kernel_scale):
+        self.kernel_scale = kernel_scale
+        self._min_area = self._config.blob_min_area_pixels * kernel_scale ** 2
+        self._merge_distance = max(1.0, self._config.blob_merge_distance_pixels * kernel_scale)
+        self._footprint = _get_blob_footprint(self._config.blob_footprint_sigma_pixels * kernel_scale)
+
+    def add(self, fg_mask, regions=None):
+        if self.counts is None:
+            self.counts = np.zeros(fg_mask.shape, 'float32')
+        start_time_ns = time.perf_counter_ns()
+        centroids = self._find_people(fg_mask, regions)
+        self._metrics.add_time('blob_detection', start_time_ns)
+
+        radius = self._footprint.shape[0] // 2
+        height, width = fg_mask.shape
+        for x, y in np.round(centroids).astype('int64').tolist():
+            x0, y0, x1, y1 = _grow_region((x, y, x + 1, y + 1), radius, width, height)
+            counts = self.counts[y0:y1, x0:x1]
+            if self._value_range is not None:
+                # The footprint is positive all over, so every pixel under it that's at the min goes up
+                self._num_at_min -= np.count_nonzero(counts == self._value_range[0])
+            cv2.add(counts, self._footprint[y0 - y + radius:y1 - y + radius, x0 - x + radius:x1 - x + radius], dst=counts)
+            if self._value_range is not None:
+                self._value_range = (self._value_range[0], max(self._value_range[1], cv2.minMaxLoc(counts)[1]))
+        self.head_counts.append(len(centroids))
+        self.num_frames += 1
+        self._check_min()
+
+    def _find_people(self, fg_mask, regions):
+        # Returns the (x, y) position of each person in the mask. Only the bounding box of the regions gets labelled,
+        # since the mask is empty everywhere else.
+        x0, y0 = 0, 0
+        if regions:
+            x0, y0 = min(region[0] for region in regions), min(region[1] for region in regions)
+            x1, y1 = max(region[2] for region in regions), max(region[3] for region in regions)
+            fg_mask = fg_mask[y0:y1, x0:x1]
+        if self._labels is None or self._labels.shape != self.counts.shape:
+            self._labels = np.empty(self.counts.shape, 'int32')
+        labels = self._labels[:fg_mask.shape[0], :fg_mask.shape[1]]
+        # Grana's block-based algorithm labels 2x2 blocks of pixels at a time, which makes it a few times faster than
+        # OpenCV's default on the large, solid blobs that noise reduction leaves behind
+        num_labels, _, stats, centroids = cv2.connectedComponentsWithStatsWithAlgorithm(fg_mask, 8, cv2.CV_32S, cv2.CCL_BBDT, labels=labels)
+
+        # Label 0 is the background
+        areas = stats[1:num_labels, cv2.CC_STAT_AREA].astype('float64')
+        centroids = centroids[1:num_labels]
+        large_enough = areas >= self._min_area
+        return _merge_blobs(centroids[large_enough], areas[large_enough], self._merge_distance) + (x0, y0)
+
+    def merge(self, other):
+        if other.counts is None:
+            return
+        if self.counts is None:
+            self.counts = np.zeros(other.counts.shape, 'float32')
+        cv2.add(self.counts, other.counts, dst=self.counts)
+        self.num_frames += other.num_frames
+        self.head_counts.extend(other.head_counts)
+        self._value_range = None
+
+
+@functools.lru_cache()
+def _get_blob_footprint(sigma):
+    # Returns a Gaussian footprint of the given standard deviation that peaks at 1, cut off at 3 standard deviations
+    radius = max(1, math.ceil(3 * sigma))
+    kernel = cv2.getGaussianKernel(2 * radius + 1, sigma, cv2.CV_32F)
+    footprint = kernel @ kernel.T
+    return footprint / footprint[radius, radius]
+
+
+def _merge_blobs(centroids, areas, distance):
+    # Merges blobs whose centroids lie within distance of each other, directly or through a chain of other blobs, and
+    # returns the area-weighted centroids of the merged blobs. Blobs get hashed into a grid of cells `distance` wide, so
+    # each one only gets compared against the blobs in its own cell and the eight around it.
+    parents = list(range(len(centroids)))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    cells = collections.defaultdict(list)
+    distance_squared = distance ** 2
+    points = centroids.tolist()
+    for i, (cell_x, cell_y) in enumerate(np.floor(centroids / distance).astype('int64').tolist()):
+        x, y = points[i]
+        for neighbour_x in (cell_x - 1, cell_x, cell_x + 1):
+            for neighbour_y in (cell_y - 1, cell_y, cell_y + 1):
+                for j in cells.get((neighbour_x, neighbour_y), ()):
+                    if (x - points[j][0]) ** 2 + (y - points[j][1]) ** 2 <= distance_squared:
+                        parents[find(i)] = find(j)
+        cells[cell_x, cell_y].append(i)
+
+    _, groups = np.unique([find(i) for i in range(len(parents))], return_inverse=True)
+    if len(groups) == 0:
+        return np.empty((0, 2))
+    weights = np.bincount(groups, areas)
+    return np.stack([np.bincount(groups, areas * centroids[:, 0]), np.bincount(groups, areas * centroids[:, 1])], axis=1) / weights[:, None]
+
+
+def _create_heatmap_accumulator(config=config, metrics=None, windowed=True):
+    # Returns the accumulator for config.heatmap_accumulation_mode, keeping a heatmap window if one is configured and
+    # wanted
+    if config.heatmap_accumulation_mode == 'BLOBS':
+        if windowed and config.heatmap_window_mode:
+            logging.warning("Heatmap windows aren't supported with blob occupancy heatmaps; not keeping one")
+        return _OccupancyAccumulator(config, metrics)
+    if windowed and config.heatmap_window_mode:
+        return _WindowedHeatmapAccumulator(config)
+    return _HeatmapAccumulator()
+
+
 class _RenderContext:
     output: cv2.VideoWriter = None
+    _render_to_screen: bool
+    _render_to_video: bool
+    _last_render_ns: int = None  # Frame timestamp of the last render, used for rate limiting
+    _last_video_image: np.ndarray = None
+    _next_video_frame_ns = 0
+    _worker_thread: threading.Thread = None  # Used only if config.render_threaded_enabled is True
+    _pending_frame: np.ndarray = None  # Latest snapshot waiting to be picked up by the worker thread
+    _pending_heatmap: np.ndarray = None
+    _pending_value_range: tuple = None
+    _pending_timestamp_ns = 0
+    _has_pending = False
+    _latest_image: np.ndarray = None  # Latest render from the worker thread waiting to be shown on screen
+    _closed = False
 
-    def __init__(self, capture: cv2.VideoCapture):
-        if config.render_to_video:
-            logging.info(f"Writing video output to file: {config.render_video_filename}")
-            width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)) if not config.down_sampling_enabled else config.down_sampling_size[0]
-            height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)) if not config.down_sampling_enabled else config.down_sampling_size[1]
+    def __init__(self, frame_size, config=config):
+        self._config = config
+        if self._config.render_to_video:
+            logging.info(f"Writing video output to file: {self._config.render_video_filename}")
             fourcc = cv2.VideoWriter_fourcc(*'XVID')
-            self.output = cv2.VideoWriter(config.render_video_filename, fourcc, config.render_video_fps, (width, height))
+            self.output = cv2.VideoWriter(self._config.render_video_filename, fourcc, self._config.render_video_fps, frame_size)
             if not self.output.isOpened():
-                logging.warning(f"Unable to open video file for writing: {config.render_video_filename}")
-
-    def render(self, frame, heatmap):
-        frame_with_heatmap = None
-        render_to_screen = config.render_to_screen and threading.current_thread() is threading.main_thread()
-        render_to_video = config.render_to_video and self.output.isOpened()
-        if render_to_screen or render_to_video:
-            rendered_heatmap = _scale_heatmap_for_rendering(heatmap)
-            frame_with_heatmap = cv2.add(rendered_heatmap, frame)
-        if render_to_screen:
+                logging.warning(f"Unable to open video file for writing: {self._config.render_video_filename}")
+        self._render_to_screen = self._config.render_to_screen and threading.current_thread() is threading.main_thread()
+        self._render_to_video = self._config.render_to_video and self.output.isOpened()
+        if self._config.render_threaded_enabled and (self._render_to_screen or self._render_to_video):
+            logging.info("Starting render worker thread")
+            self._condition = threading.Condition()
+            self._worker_thread = threading.Thread(target=self._run_worker, name='renderer', daemon=True)
+            self._worker_thread.start()
+
+    def render(self, frame, heatmap, timestamp_ns):
+        # Renders the heatmap accumulator's counts over the frame, at most render_max_fps times per second of video,
+        # scaled by the (min, max) the accumulator keeps track of. The timestamp is the frame's capture time for live
+        # streams, or its position in the video file.
+        if not self._render_to_screen and not self._render_to_video:
+            return
+        if self._worker_thread is not None:
+            self._show_latest_image()
+        if self._last_render_ns is not None and self._config.render_max_fps > 0 and timestamp_ns - self._last_render_ns < 1e9 / self._config.render_max_fps:
+            return
+        self._last_render_ns = timestamp_ns
+        if self._worker_thread is not None:
+            self._submit(frame, heatmap, timestamp_ns)
+            return
+        frame_with_heatmap = cv2.add(_scale_heatmap_for_rendering(heatmap.counts, heatmap.value_range(), self._config), frame)
+        if self._render_to_screen:
             cv2.imshow("Frame with heatmap", frame_with_heatmap)
             cv2.waitKey(1)
-        if render_to_video:
-            self.output.write(frame_with_heatmap)
+        if self._render_to_video:
+            self._write_video(frame_with_heatmap, timestamp_ns)
+
+    def _submit(self, frame, heatmap, timestamp_ns):
+        # Copies the frame and heatmap into the pending snapshot, replacing one that the worker hasn't picked up yet
+        counts = heatmap.counts
+        with self._condition:
+            if self._pending_frame is None or self._pending_frame.shape != frame.shape:
+                self._pending_frame = np.empty_like(frame)
+            if self._pending_heatmap is None or self._pending_heatmap.shape != counts.shape or self._pending_heatmap.dtype != counts.dtype:
+                self._pending_heatmap = np.empty_like(counts)
+            np.copyto(self._pending_frame, frame)
+            np.copyto(self._pending_heatmap, counts)
+            self._pending_value_range = heatmap.value_range()
+            self._pending_timestamp_ns = timestamp_ns
+            self._has_pending = True
+            self._condition.notify()
+
+    def _run_worker(self):
+        # Renders the latest snapshot whenever there is one. The snapshot buffers are swapped rather than copied, so the
+        # analysis loop can fill in the next snapshot while this one is being rendered.
+        frame = None
+        heatmap = None
+        while True:
+            with self._condition:
+                while not self._has_pending and not self._closed:
+                    self._condition.wait()
+                if not self._has_pending:
+                    return
+                frame, self._pending_frame = self._pending_frame, frame
+                heatmap, self._pending_heatmap = self._pending_heatmap, heatmap
+                value_range = self._pending_value_range
+                timestamp_ns = self._pending_timestamp_ns
+                self._has_pending = False
+            frame_with_heatmap = cv2.add(_scale_heatmap_for_rendering(heatmap, value_range, self._config), frame)
+            if self._render_to_video:
+                self._write_video(frame_with_heatmap, timestamp_ns)
+            if self._render_to_screen:
+                with self._condition:
+                    self._latest_image = frame_with_heatmap
+
+    def _show_latest_image(self):
+        # Windows can only be updated from the main thread, so renders from the worker thread get shown from here
+        with self._condition:
+            image, self._latest_image = self._latest_image, None
+        if image is not None:
+            cv2.imshow("Frame with heatmap", image)
+            cv2.waitKey(1)
+
+    def _write_video(self, frame_with_heatmap, timestamp_ns):
+        # Keeps the output video in step with the input by writing the previous render once for every video frame that
+        # falls before this render, which repeats renders if analysis is slower than render_video_fps and drops them if
+        # it's faster
+        if self._last_video_image is None:
+            self._next_video_frame_ns = timestamp_ns
+        while self._last_video_image is not None and self._next_video_frame_ns < timestamp_ns:
+            self.output.write(self._last_video_image)
+            self._next_video_frame_ns += 1e9 / self._config.render_video_fps
+        self._last_video_image = frame_with_heatmap
 
     def close(self):
-        cv2.destroyAllWindows()
+        if self._worker_thread is not None:
+            with self._condition:
+                self._closed = True
+                self._condition.notify()
+            self._worker_thread.join()
+            if self._render_to_screen:
+                self._show_latest_image()
+        if self._last_video_image is not None:
+            self.output.write(self._last_video_image)
+        if self._render_to_screen:
+            cv2.destroyAllWindows()
         if self.output is not None and self.output.isOpened():
             self.output.release()
 
 
-def _scale_heatmap_for_rendering(heatmap):
-    # The heatmap values are float64's. Scale the values appropriately to uint8's to make it suitable for rendering.
-    rendered_heatmap = heatmap.copy()
-    rendered_heatmap -= rendered_heatmap.min()
-    if rendered_heatmap.max() > 0:
-        rendered_heatmap = rendered_heatmap / rendered_heatmap.max()
-        rendered_heatmap[rendered_heatmap < config.render_cutoff_percent] = 0
-        rendered_heatmap = (255 - config.render_brighten_threshold) * rendered_heatmap
-        rendered_heatmap[rendered_heatmap > 0] += config.render_brighten_threshold
-    rendered_heatmap = rendered_heatmap.astype('uint8')
-    rendered_heatmap = cv2.applyColorMap(rendered_heatmap, cv2.COLORMAP_HOT)
-    return rendered_heatmap
+@functools.lru_cache(maxsize=4)
+def _create_render_lut(cutoff_percent, brighten_threshold):
+    # Builds a 256-entry colour map that applies the cutoff and brightening to each scaled heatmap value, followed by
+    # COLORMAP_HOT, so that all of those steps happen in a single lookup
+    values = np.arange(256, dtype='float64')
+    values[values / 255 < cutoff_percent] = 0
+    values = (255 - brighten_threshold) * values / 255
+    values[values > 0] += brighten_threshold
+    return cv2.applyColorMap(values.astype('uint8').reshape(256, 1), cv2.COLORMAP_HOT)
 
 
-def generate_heatmap():
-    config_string = ','.join("%s=%s" % item for item in vars(config).items() if not item[0].endswith('__'))
-    logging.info(f"Starting heatmap generator with config: {config_string}")
+def _scale_heatmap_for_rendering(heatmap, value_range=None, config=config):
+    # The heatmap values are per-pixel hit counts. Scale them to uint8's in a single pass, then colour them in with a
+    # second pass through the render LUT. The (min, max) of the heatmap can be passed in if it's already known. Raises
+    # ValueError if there's no heatmap to scale, rather than letting OpenCV crash the process (which, in a worker
+    # process, would break the whole pool).
+    if heatmap is None or heatmap.size == 0:
+        raise ValueError("No heatmap to render; was anything captured?")
+    min_value, max_value = value_range if value_range is not None else cv2.minMaxLoc(heatmap)[:2]
+    alpha = 255 / (max_value - min_value) if max_value > min_value else 0
+    rendered_heatmap = cv2.convertScaleAbs(heatmap, alpha=alpha, beta=-min_value * alpha)
+    return cv2.applyColorMap(rendered_heatmap, _create_render_lut(config.render_cutoff_percent, config.render_brighten_threshold))
+
+
+def _create_bg_subtractor(config=config):
+    return cv2.createBackgroundSubtractorMOG2() if config.bg_subtraction_algo == 'MOG2' else cv2.createBackgroundSubtractorKNN()
+
+
+def _get_roi(config, frame_width, frame_height):
+    # Returns the part of the frame covered by config.roi_polygon as an (x0, y0, x1, y1) rectangle, rounded out to whole
+    # tiles of analysis_tile_size, along with the polygon's mask within that rectangle, or None if the polygon fills it.
+    # Returns None if no ROI is configured.
+    if config.roi_polygon is None:
+        return None
+    points = np.round(np.array(config.roi_polygon, 'float64') * (frame_width, frame_height)).astype('int32')
+    polygon_mask = np.zeros((frame_height, frame_width), 'uint8')
+    cv2.fillPoly(polygon_mask, [points], 255)
+    x, y, width, height = cv2.boundingRect(polygon_mask)
+    if width == 0 or height == 0:
+        raise ValueError(f"ROI polygon doesn't cover any of the {frame_width}x{frame_height} frame: {config.roi_polygon}")
+    tile_size = config.analysis_tile_size
+    x0, y0 = x // tile_size * tile_size, y // tile_size * tile_size
+    x1 = min(frame_width, math.ceil((x + width) / tile_size) * tile_size)
+    y1 = min(frame_height, math.ceil((y + height) / tile_size) * tile_size)
+    roi_mask = polygon_mask[y0:y1, x0:x1]
+    return (x0, y0, x1, y1), (roi_mask if cv2.countNonZero(roi_mask) < roi_mask.size else None)
+
+
+class _BackgroundModel:
+    # Wraps the background subtractor so that the background image is only reconstructed when something actually needs
+    # it, rather than after every frame. For KNN in particular, getBackgroundImage() is a full-frame reconstruction. If
+    # config.bg_snapshot_interval_frames is set, a snapshot is also taken periodically so that an up-to-date background
+    # is always on hand without having to pay for one on demand. If an ROI is configured, the subtractor only ever sees
+    # the ROI, and the first frame stands in for the background everywhere else.
+    subtractor: cv2.BackgroundSubtractor
+    num_frames = 0
+    _snapshot: np.ndarray = None
+    _snapshot_frame = 0  # Value of num_frames when the snapshot was taken
+    _roi: tuple = None  # (x0, y0, x1, y1) rectangle the subtractor runs on, once the frame size is known
+    _roi_mask: np.ndarray = None  # Polygon mask within the ROI rectangle, if the polygon doesn't fill it
+    _outside_roi: np.ndarray = None  # First frame, which fills in the background outside the ROI
+    _fg_mask: np.ndarray = None
+
+    def __init__(self, config=config):
+        self._config = config
+        self.subtractor = _create_bg_subtractor(config)
+
+    def apply(self, frame, fg_mask=None):
+        if self._config.roi_polygon is None:
+            fg_mask = self.subtractor.apply(frame, fgmask=fg_mask)
+        else:
+            fg_mask = self._apply_to_roi(frame, fg_mask)
+        self.num_frames += 1
+        if 0 < self._config.bg_snapshot_interval_frames <= self.num_frames - self._snapshot_frame:
+            self.background()
+        return fg_mask
+
+    def _apply_to_roi(self, frame, fg_mask):
+        # Runs the subtractor on the ROI rectangle, writing its mask straight into the frame-sized one, which stays empty
+        # everywhere else
+        if self._outside_roi is None or self._outside_roi.shape != frame.shape:
+            self._roi, self._roi_mask = _get_roi(self._config, frame.shape[1], frame.shape[0])
+            self._outside_roi = frame.copy()
+            logging.info(f"Analysing a {self._roi[2] - self._roi[0]}x{self._roi[3] - self._roi[1]} ROI at ({self._roi[0]}, {self._roi[1]}) of the {frame.shape[1]}x{frame.shape[0]} frame")
+        if fg_mask is None:
+            if self._fg_mask is None or self._fg_mask.shape != frame.shape[:2]:
+                self._fg_mask = np.empty(frame.shape[:2], 'uint8')
+            fg_mask = self._fg_mask
+        x0, y0, x1, y1 = self._roi
+        fg_mask.fill(0)
+        roi_fg_mask = fg_mask[y0:y1, x0:x1]
+        self.subtractor.apply(frame[y0:y1, x0:x1], fgmask=roi_fg_mask)
+        if self._roi_mask is not None:
+            cv2.bitwise_and(roi_fg_mask, self._roi_mask, dst=roi_fg_mask)
+        return fg_mask
+
+    def background(self):
+        # Returns the current background image, reconstructing it only if frames were applied since the last snapshot
+        if self._snapshot_frame != self.num_frames:
+            self._snapshot = self.subtractor.getBackgroundImage()
+            if self._roi is not None:
+                x0, y0, x1, y1 = self._roi
+                roi_background, self._snapshot = self._snapshot, self._outside_roi.copy()
+                self._snapshot[y0:y1, x0:x1] = roi_background
+            self._snapshot_frame = self.num_frames
+        return self._snapshot
+
+    def latest_snapshot(self):
+        # Returns the most recent snapshot without taking a new one; may lag behind by up to the snapshot interval
+        return self._snapshot
+
+
+class _MaskProcessor:
+    # Computes the foreground mask for each frame and cleans it up. The structuring elements are built once up front, and
+    # every step writes into a preallocated buffer, so that no frame-sized arrays get allocated once the first frame has
+    # been processed. The returned mask is only valid until the next call to process(). The kernel sizes get multiplied
+    # by kernel_scale, e.g. when frames end up at a lower resolution than the kernel sizes were configured for.
+    _raw_mask: np.ndarray = None
+    _eroded_mask: np.ndarray = None
+    _dilated_mask: np.ndarray = None
+    _region_mask: np.ndarray = None  # Scratch buffer for dilating one region at a time
+    _padded_mask: np.ndarray = None  # Cleaned-up mask padded out to whole tiles, which _dilated_mask is a view of
+    _roi_regions: list = None
+    _tiles: '_ActiveTiles' = None
+    regions: list = None  # (x0, y0, x1, y1) regions of the frame the last cleaned-up mask covers, or None for all of it
+
+    def __init__(self, config=config, metrics=None, kernel_scale=1.0):
+        self._config = config
+        self._metrics = metrics if metrics is not None else _Metrics(config)
+        self.kernel_scale = kernel_scale
+        erosion_size = tuple(max(1, round(kernel_scale * size)) for size in self._config.noise_reduction_erosion_kernel_size)
+        self._erosion_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, erosion_size)
+        width, height = (max(1, round(kernel_scale * size)) for size in self._config.noise_reduction_dilation_kernel_size)
+        if self._config.noise_reduction_dilation_mode == 'SEPARABLE':
+            # OpenCV applies rectangular kernels as a row pass followed by a column pass
+            self._dilation_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (width, height))
+            self._dilation_iterations = 0
+        elif self._config.noise_reduction_dilation_mode == 'ITERATED':
+            # Dilating by a rectangle and then by a diamond gives an octagon. A diamond radius of (2 - sqrt(2)) times the
+            # ellipse radius makes the octagon's axis and diagonal extents both match the ellipse. The diamond is built up
+            # out of repeated 3x3 cross dilations.
+            self._dilation_iterations = round((2 - math.sqrt(2)) * min(width, height) / 2)
+            rect_size = (max(1, width - 2 * self._dilation_iterations), max(1, height - 2 * self._dilation_iterations))
+            self._dilation_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, rect_size)
+            self._cross_kernel = cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3))
+        else:
+            self._dilation_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (width, height))
+            self._dilation_iterations = 0
 
-    capture_context = _CaptureContext()
-    render_context = _RenderContext(capture_context.capture)
+        # How far outside a region each step has to look for the region to come out the same as it would as part of the
+        # whole frame
+        self._erosion_halo = max(self._erosion_kernel.shape) // 2
+        self._dilation_halo = max(self._dilation_kernel.shape) // 2 + self._dilation_iterations
 
-    bg_subtractor = cv2.createBackgroundSubtractorMOG2() if config.bg_subtraction_algo == 'MOG2' else cv2.createBackgroundSubtractorKNN()
-    bg = None
-    heatmap = None
+    def process(self, bg_model, frame):
+        return self.clean(self.subtract(bg_model, frame))
 
+    def subtract(self, bg_model, frame):
+        # Returns the binary foreground mask for the frame, before any noise reduction
+        if self._raw_mask is None or self._raw_mask.shape != frame.shape[:2]:
+            self._raw_mask = np.empty(frame.shape[:2], 'uint8')
+
+        # Incorporate the current frame into our averaged background and get the updated foreground mask. People often
+        # seem to get detected as shadows (i.e. 127), so round up to 255.
+        start_time_ns = time.perf_counter_ns()
+        fg_mask = bg_model.apply(frame, self._raw_mask)
+        cv2.threshold(fg_mask, 0, 255, cv2.THRESH_BINARY, dst=fg_mask)
+        self._metrics.add_time('bg_subtraction', start_time_ns)
+        return fg_mask
+
+    def _allocate(self, shape):
+        self._eroded_mask = np.empty(shape, 'uint8')
+        roi = _get_roi(self._config, shape[1], shape[0])
+        self._roi_regions = [roi[0]] if roi is not None else None
+        if roi is not None or self._config.tile_skipping_enabled:
+            # Parts of the frame outside the regions never get written, so they have to start out empty
+            self._region_mask = np.empty(shape, 'uint8')
+            tile_size = self._config.analysis_tile_size
+            self._padded_mask = np.zeros(tuple(math.ceil(size / tile_size) * tile_size for size in shape), 'uint8')
+            self._dilated_mask = self._padded_mask[:shape[0], :shape[1]]
+        else:
+            self._dilated_mask = np.empty(shape, 'uint8')
+        self._tiles = _ActiveTiles(self._config, shape, roi[0] if roi is not None else None) if self._config.tile_skipping_enabled else None
+
+    def clean(self, fg_mask):
+        # Returns the foreground mask with noise reduction applied, if configured. If only some regions of the frame get
+        # processed (see self.regions), the returned mask is empty everywhere else.
+        if self._eroded_mask is None or self._eroded_mask.shape != fg_mask.shape:
+            self._allocate(fg_mask.shape)
+        if self._tiles is not None:
+            self.regions = self._tiles.next_frame()
+            self._padded_mask.fill(0)
+        else:
+            self.regions = self._roi_regions
+        if self.regions is not None:
+            num_region_pixels = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in self.regions)
+            self._metrics.add_skipped_pixels(fg_mask.size, fg_mask.size - num_region_pixels)
+
+        # We do this to reduce noise and merge/emphasize the relevant parts of the foreground mask. See:
+        # https://opencv-python-tutroals.readthedocs.io/en/latest/py_tutorials/py_imgproc/py_morphological_ops/py_morphological_ops.html
+        if self._config.noise_reduction_enabled:
+            start_time_ns = time.perf_counter_ns()
+            if self.regions is None:
+                cv2.erode(fg_mask, self._erosion_kernel, dst=self._eroded_mask)
+                fg_mask = cv2.dilate(self._eroded_mask, self._dilation_kernel, dst=self._dilated_mask)
+                if self._dilation_iterations > 0:
+                    cv2.dilate(fg_mask, self._cross_kernel, dst=fg_mask, iterations=self._dilation_iterations)
+            else:
+                for region in self.regions:
+                    self._clean_region(fg_mask, region)
+                fg_mask = self._dilated_mask
+            self._metrics.add_time('morphology', start_time_ns)
+        elif self._tiles is not None:
+            # Skipped tiles still have to come out empty
+            for x0, y0, x1, y1 in self.regions:
+                self._dilated_mask[y0:y1, x0:x1] = fg_mask[y0:y1, x0:x1]
+            fg_mask = self._dilated_mask
+
+        if self._tiles is not None:
+            self._tiles.update(self._padded_mask)
+        return fg_mask
+
+    def _clean_region(self, fg_mask, region):
+        # Cleans up a single region of the mask. The dilation works on the region plus a halo of the dilation's reach, and
+        # the erosion on that plus a halo of its own reach, so that nothing along the region's edges depends on where the
+        # region happens to end. Everything outside the region is left alone.
+        x0, y0, x1, y1 = region
+        height, width = fg_mask.shape
+        dilation_window = _grow_region(region, self._dilation_halo, width, height)
+        erosion_window = _grow_region(dilation_window, self._erosion_halo, width, height)
+        eroded = cv2.erode(fg_mask[erosion_window[1]:erosion_window[3], erosion_window[0]:erosion_window[2]], self._erosion_kernel, dst=self._eroded_mask[erosion_window[1]:erosion_window[3], erosion_window[0]:erosion_window[2]])
+        eroded = eroded[dilation_window[1] - erosion_window[1]:dilation_window[3] - erosion_window[1], dilation_window[0] - erosion_window[0]:dilation_window[2] - erosion_window[0]]
+        dilated = cv2.dilate(eroded, self._dilation_kernel, dst=self._region_mask[dilation_window[1]:dilation_window[3], dilation_window[0]:dilation_window[2]])
+        if self._dilation_iterations > 0:
+            cv2.dilate(dilated, self._cross_kernel, dst=dilated, iterations=self._dilation_iterations)
+        self._dilated_mask[y0:y1, x0:x1] = dilated[y0 - dilation_window[1]:y1 - dilation_window[1], x0 - dilation_window[0]:x1 - dilation_window[0]]
+
+
+def _grow_region(region, margin, width, height):
+    # Grows an (x0, y0, x1, y1) region by margin pixels on each side, without going past the edges of the frame
+    x0, y0, x1, y1 = region
+    return max(0, x0 - margin), max(0, y0 - margin), min(width, x1 + margin), min(height, y1 + margin)
+
+
+class _ActiveTiles:
+    # Keeps track of which tiles of analysis_tile_size pixels have had foreground lately, for tile skipping. A tile goes
+    # idle once it has had no foreground for tile_skipping_idle_frames frames, as long as none of its eight neighbours is
+    # still active, and every tile within the ROI gets processed again every tile_skipping_recheck_frames frames. Active
+    # tiles get handed out as rectangular regions: runs of active tiles along each row of tiles, with identical runs on
+    # consecutive rows merged together, so that a frame that's entirely active comes out as a single region. Since each
+    # region gets processed along with a margin around it, splitting up a frame that's mostly active costs more than it
+    # saves, so once more than MAX_ACTIVE_FRACTION of the tiles are active, all of them get processed.
+    MAX_ACTIVE_FRACTION = 0.5
+
+    def __init__(self, config, frame_shape, roi=None):
+        self._config = config
+        self._tile_size = config.analysis_tile_size
+        self._frame_shape = frame_shape
+        self._grid_shape = tuple(math.ceil(size / self._tile_size) for size in frame_shape)
+        self._idle_frames = np.zeros(self._grid_shape, 'int32')
+        self._in_roi = np.ones(self._grid_shape, 'uint8')
+        if roi is not None:
+            x0, y0, x1, y1 = roi
+            self._in_roi[:] = 0
+            self._in_roi[y0 // self._tile_size:math.ceil(y1 / self._tile_size), x0 // self._tile_size:math.ceil(x1 / self._tile_size)] = 1
+        self._num_tiles_in_roi = cv2.countNonZero(self._in_roi)
+        self._neighbourhood = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+        self._tile_regions = []  # Regions handed out for the current frame, in tiles
+        self._num_frames = 0
+
+    def next_frame(self):
+        # Picks the tiles to process for the next frame, and returns them as (x0, y0, x1, y1) regions in pixels
+        self._num_frames += 1
+        if self._num_frames % self._config.tile_skipping_recheck_frames == 0:
+            active = self._in_roi
+        else:
+            active = cv2.dilate((self._idle_frames < self._config.tile_skipping_idle_frames).view('uint8'), self._neighbourhood)
+            cv2.bitwise_and(active, self._in_roi, dst=active)
+            if cv2.countNonZero(active) > self.MAX_ACTIVE_FRACTION * self._num_tiles_in_roi:
+                active = self._in_roi
+
+        # Runs start where a row steps up from 0 to 1 and end where it steps back down, both of which come out of the
+        # difference between neighbouring tiles in row-major order
+        steps = np.diff(active.view('int8'), axis=1, prepend=0, append=0)
+        starts, ends = np.nonzero(steps == 1), np.nonzero(steps == -1)[1]
+        self._tile_regions = []
+        open_runs = {}  # (first column, last column + 1) of each run that ended on the previous row -> index of its region
+        runs = {}
+        previous_row = -1
+        for row, first_column, end_column in zip(starts[0].tolist(), starts[1].tolist(), ends.tolist()):
+            if row != previous_row:
+                open_runs, runs = (runs if row == previous_row + 1 else {}), {}
+                previous_row = row
+            run = (first_column, end_column)
+            index = open_runs.get(run)
+            if index is None:
+                index = len(self._tile_regions)
+                self._tile_regions.append([first_column, row, end_column, row + 1])
+            else:
+                self._tile_regions[index][3] = row + 1
+            runs[run] = index
+        height, width = self._frame_shape
+        return [(x0 * self._tile_size, y0 * self._tile_size, min(width, x1 * self._tile_size), min(height, y1 * self._tile_size)) for x0, y0, x1, y1 in self._tile_regions]
+
+    def update(self, padded_mask):
+        # Records which of the tiles processed for the current frame had foreground in their cleaned-up mask, given padded
+        # out to whole tiles
+        self._idle_frames += 1
+        tile_size = self._tile_size
+        for x0, y0, x1, y1 in self._tile_regions:
+            tiles = padded_mask[y0 * tile_size:y1 * tile_size, x0 * tile_size:x1 * tile_size].reshape(y1 - y0, tile_size, x1 - x0, tile_size)
+            self._idle_frames[y0:y1, x0:x1][tiles.any(axis=(1, 3))] = 0
+
+
+# Layout of a mask recording: a file header, followed by any number of chunks. Each chunk starts with a chunk header,
+# followed by the capture timestamp of each of its frames, then the zlib-compressed, bit-packed masks of those frames.
+_MASK_RECORDING_MAGIC = b'HMMASKS2'
+_MASK_RECORDING_HEADER = struct.Struct('<8sII8sd')  # Magic, height, width, stage ('RAW' or 'CLEANED'), kernel scale
+_MASK_RECORDING_CHUNK_HEADER = struct.Struct('<II')  # Number of frames, compressed size
+
+
+class _MaskRecorder:
+    # Streams foreground masks to a file at about a bit per pixel per frame, before compression, so that heatmaps can be
+    # rebuilt from them later without rerunning background subtraction (see heatmap_replay.py). Masks are bit-packed
+    # into a preallocated chunk, which gets compressed and written once it's full (or spans
+    # mask_recording_max_chunk_seconds). The file is memory-mapped and grown ahead of the chunks, doubling in size each
+    # time, then trimmed to its contents once the recording is closed. A chunk's header only gets written once the rest
+    # of the chunk has been flushed to disk, so if the process dies, the recording is still readable up to its last
+    # complete chunk; the reader stops at the unused, zeroed out space after it.
+    MIN_FILE_SIZE = 1 << 20
+    _file = None
+    _mmap: mmap.mmap = None
+    _size = 0  # Number of bytes of the file in use
+    _chunk: np.ndarray = None
+    _num_chunk_frames = 0
+    num_frames = 0
+    kernel_scale = 1.0  # Scale of the noise reduction kernels the masks were (or, for raw masks, would be) cleaned up with
+
+    def __init__(self, config=config, metrics=None):
+        self._config = config
+        self._metrics = metrics if metrics is not None else _Metrics(config)
+        self._timestamps_ns = np.empty(self._config.mask_recording_chunk_frames, 'int64')
+
+    def write(self, fg_mask, timestamp_ns):
+        start_time_ns = time.perf_counter_ns()
+        if self._file is None:
+            self._open(fg_mask.shape)
+        self._chunk[self._num_chunk_frames] = np.packbits(fg_mask, axis=None)
+        self._timestamps_ns[self._num_chunk_frames] = timestamp_ns
+        self._num_chunk_frames += 1
+        self.num_frames += 1
+        if self._num_chunk_frames == len(self._chunk) or timestamp_ns - self._timestamps_ns[0] >= 1e9 * self._config.mask_recording_max_chunk_seconds:
+            self._flush()
+        self._metrics.add_time('recording', start_time_ns)
+
+    def _open(self, shape):
+        logging.info(f"Recording {self._config.mask_recording_stage.lower()} foreground masks to: {self._config.mask_recording_filename}")
+        self._file = open(self._config.mask_recording_filename, 'w+b')
+        self._file.truncate(self.MIN_FILE_SIZE)
+        self._mmap = mmap.mmap(self._file.fileno(), self.MIN_FILE_SIZE)
+        header = _MASK_RECORDING_HEADER.pack(_MASK_RECORDING_MAGIC, shape[0], shape[1], self._config.mask_recording_stage.encode(), self.kernel_scale)
+        self._mmap[:len(header)] = header
+        self._mmap.flush(0, len(header))
+        self._size = len(header)
+        self._chunk = np.empty((self._config.mask_recording_chunk_frames, (shape[0] * shape[1] + 7) // 8), 'uint8')
+
+    def _grow(self, size):
+        # Makes sure the file has room for at least size bytes
+        if size <= len(self._mmap):
+            return
+        file_size = max(size, 2 * len(self._mmap))
+        file_size = -(-file_size // mmap.ALLOCATIONGRANULARITY) * mmap.ALLOCATIONGRANULARITY
+        self._mmap.close()
+        self._file.truncate(file_size)
+        self._mmap = mmap.mmap(self._file.fileno(), file_size)
+
+    def _flush(self):
+        if self._num_chunk_frames == 0:
+            return
+        compressed = zlib.compress(self._chunk[:self._num_chunk_frames], 1)
+        header_offset = self._size
+        data_offset = header_offset + _MASK_RECORDING_CHUNK_HEADER.size
+        timestamps = self._timestamps_ns[:self._num_chunk_frames].tobytes()
+        end_offset = data_offset + len(timestamps) + len(compressed)
+        self._grow(end_offset)
+        self._mmap[data_offset:data_offset + len(timestamps)] = timestamps
+        self._mmap[data_offset + len(timestamps):end_offset] = compressed
+        flush_offset = header_offset - header_offset % mmap.PAGESIZE
+        self._mmap.flush(flush_offset, end_offset - flush_offset)
+        self._mmap[header_offset:data_offset] = _MASK_RECORDING_CHUNK_HEADER.pack(self._num_chunk_frames, len(compressed))
+        self._mmap.flush(flush_offset, data_offset - flush_offset)
+        self._size = end_offset
+        self._num_chunk_frames = 0
+
+    def close(self):
+        if self._file is not None:
+            self._flush()
+            self._mmap.close()
+            self._file.truncate(self._size)
+            self._file.close()
+            self._file = None
+            logging.info(f"Recorded {self.num_frames} foreground masks to: {self._config.mask_recording_filename}")
+
+
+class _MaskRecording:
+    # Reads back a recording made by _MaskRecorder. The file is memory-mapped, so chunks get decompressed straight out
+    # of the page cache without being read into intermediate buffers first.
+    height: int
+    width: int
+    stage: str
+    kernel_scale: float  # Scale of the noise reduction kernels during the scan, which replays have to match
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.height, self.width, stage, self.kernel_scale = _MASK_RECORDING_HEADER.unpack_from(self._mmap)
+        if magic != _MASK_RECORDING_MAGIC:
+            raise ValueError(f"Not a foreground mask recording: {filename}")
+        self.stage = stage.rstrip(b'\0').decode()
+
+    def chunks(self):
+        # Yields the timestamps and the unpacked masks (as 0's and 1's) of each chunk of frames, as arrays of shape (n,)
+        # and (n, height, width). Stops at the first incomplete chunk, or at the end of the chunks that were written.
+        offset = _MASK_RECORDING_HEADER.size
+        while offset + _MASK_RECORDING_CHUNK_HEADER.size <= len(self._mmap):
+            num_frames, compressed_size = _MASK_RECORDING_CHUNK_HEADER.unpack_from(self._mmap, offset)
+            if num_frames == 0:
+                # Space the recorder had set aside for chunks it never got to write, e.g. if it didn't get closed
+                break
+            offset += _MASK_RECORDING_CHUNK_HEADER.size
+            if offset + 8 * num_frames + compressed_size > len(self._mmap):
+                logging.warning("Mask recording ends with an incomplete chunk; ignoring it")
+                break
+            timestamps_ns = np.frombuffer(self._mmap, 'int64', num_frames, offset)
+            offset += 8 * num_frames
+            packed = np.frombuffer(zlib.decompress(memoryview(self._mmap)[offset:offset + compressed_size]), 'uint8')
+            offset += compressed_size
+            masks = np.unpackbits(packed.reshape(num_frames, -1), axis=1, count=self.height * self.width)
+            yield timestamps_ns, masks.reshape(num_frames, self.height, self.width)
+
+    def close(self):
+        self._mmap.close()
+
+
+# Layout of a checkpoint file: a file header, followed by two slots that checkpoints get written to in turn. Each slot
+# starts with a slot header, followed by the counts (with room for 4 bytes per pixel, whatever their type) and room for
+# the background image, which only gets filled in if the checkpoint has one to hand (see HeatmapGenerator._checkpoint()).
+# Slots start on allocation granularity boundaries so that each one can be flushed on its own.
+_CHECKPOINT_MAGIC = b'HMCKPT02'
+_CHECKPOINT_HEADER = struct.Struct('<8sIII8s16s')  # Magic, height, width, background channels, heatmap_accumulation_mode, source ID (see _get_checkpoint_source_id())
+_CHECKPOINT_SLOT_HEADER = struct.Struct('<QQdq8sII')  # Sequence number, number of frames, seconds captured, timestamp of the last frame, counts dtype, flags, CRC-32
+_CHECKPOINT_COMPLETE = 1  # Flag for the final checkpoint of a scan that ran to completion
+_CHECKPOINT_HAS_BACKGROUND = 2  # Flag for a checkpoint that holds a background image
+_CHECKPOINT_SLOT_DATA_OFFSET = 64  # Offset of the counts within a slot, which keeps them aligned
+
+# A checkpoint read back by _load_checkpoint()
+_Checkpoint = collections.namedtuple('_Checkpoint', ['sequence', 'counts', 'num_frames', 'seconds_captured', 'timestamp_ns', 'background', 'accumulation_mode', 'complete', 'source_id'])
+
+
+def _get_checkpoint_source_id(config):
+    # Returns a digest of the video source a scan reads from, along with the options that decide which of its frames get
+    # sampled, so that a checkpoint only gets resumed by a scan of the same thing. Video files are identified by their
+    # path, size and modification time, since a different recording could well have the same frame size.
+    if config.video_capture_mode == 'FILE':
+        filename = os.path.abspath(config.video_capture_input_filename)
+        stat = os.stat(filename) if os.path.exists(filename) else None
+        source = f"file:{filename}:{stat.st_size}:{stat.st_mtime_ns}" if stat is not None else f"file:{filename}"
+    elif config.video_capture_mode == 'CAMERA_GSTREAMER':
+        source = f"gstreamer:{config.video_capture_gstreamer_pipeline}"
+    else:
+        source = f"camera:{config.video_capture_camera_index}"
+    sampling = f"sampling:{config.frame_sampling_enabled}:{config.frame_sampling_interval_millis}:{config.frame_sampling_file_strategy}"
+    return hashlib.blake2b(f"{source}\n{sampling}".encode(), digest_size=16).digest()
+
+
+def _get_checkpoint_slot_offsets(height, width, channels):
+    # Returns the offsets of the two slots in a checkpoint file, along with the size of each slot
+    slot_size = _CHECKPOINT_SLOT_DATA_OFFSET + height * width * (4 + channels)
+    slot_size = -(-slot_size // mmap.ALLOCATIONGRANULARITY) * mmap.ALLOCATIONGRANULARITY
+    first_slot_offset = mmap.ALLOCATIONGRANULARITY
+    return (first_slot_offset, first_slot_offset + slot_size), slot_size
+
+
+class _CheckpointWriter:
+    # Writes checkpoints of a scan to a memory-mapped file on a background thread. submit() copies the counts into a
+    # pending checkpoint, replacing one that the thread hasn't picked up yet, so the analysis loop never waits on the disk
+    # and a slow disk only means fewer checkpoints. Checkpoints alternate between the file's two slots. A slot's header
+    # only gets written once the rest of the slot has been flushed to disk, and its checksum covers the whole checkpoint,
+    # so a checkpoint that got cut off partway through never passes for a complete one, and the other slot still holds
+    # the one before it.
+    _mmap: mmap.mmap = None
+    _slot_offsets: tuple = None
+    _slot_size = 0
+    _pending_counts: np.ndarray = None
+    _pending: tuple = None  # (num_frames, background, seconds captured, timestamp, complete) of the pending checkpoint
+    _closed = False
+    num_checkpoints = 0  # Number of checkpoints written so far
+
+    def __init__(self, config=config, metrics=None, sequence=0, channels=3):
+        # sequence is that of the latest checkpoint already in the file, if the scan got resumed from it; if it's 0, the
+        # file gets created afresh. channels is the number of channels of the frames, and so of the background.
+        self._config = config
+        self._metrics = metrics if metrics is not None else _Metrics(config)
+        self.sequence = sequence  # Sequence number of the latest checkpoint in the file
+        self._channels = channels
+        self._condition = threading.Condition()
+        self._worker_thread = threading.Thread(target=self._run_worker, name='checkpoint-writer', daemon=True)
+        self._worker_thread.start()
+
+    def submit(self, counts, num_frames, background, seconds_captured, timestamp_ns, complete=False):
+        # The background, if there is one, gets handed over as it is, so it mustn't be modified afterwards
+        with self._condition:
+            if self._pending_counts is None or self._pending_counts.shape != counts.shape or self._pending_counts.dtype != counts.dtype:
+                self._pending_counts = np.empty_like(counts)
+            np.copyto(self._pending_counts, counts)
+            self._pending = (num_frames, background, seconds_captured, timestamp_ns, complete)
+            self._condition.notify()
+
+    def _run_worker(self):
+        # The counts buffers are swapped rather than copied, so the analysis loop can fill in the next checkpoint while
+        # this one is being written
+        counts = None
+        while True:
+            with self._condition:
+                while self._pending is None and not self._closed:
+                    self._condition.wait()
+                if self._pending is None:
+                    return
+                counts, self._pending_counts = self._pending_counts, counts
+                pending, self._pending = self._pending, None
+            start_time_ns = time.perf_counter_ns()
+            try:
+                self._write(counts, *pending)
+            except (OSError, ValueError):
+                logging.exception(f"Failed to write heatmap checkpoint: {self._config.checkpoint_filename}")
+                continue
+            self._metrics.add_time('checkpoint_write', start_time_ns)
+
+    def _open(self, height, width, channels):
+        header = _CHECKPOINT_HEADER.pack(_CHECKPOINT_MAGIC, height, width, channels, self._config.heatmap_accumulation_mode.encode(), _get_checkpoint_source_id(self._config))
+        self._slot_offsets, self._slot_size = _get_checkpoint_slot_offsets(height, width, channels)
+        file_size = self._slot_offsets[1] + self._slot_size
+        filename = self._config.checkpoint_filename
+        if self.sequence > 0:
+            # The file already holds the checkpoint the scan was resumed from, which has to stay intact until the next one
+            # is complete
+            with open(filename, 'r+b') as f:
+                if f.read(len(header)) != header or os.fstat(f.fileno()).st_size != file_size:
+                    raise ValueError(f"Heatmap checkpoint changed since the scan was resumed from it: {filename}")
+                self._mmap = mmap.mmap(f.fileno(), file_size)
+        else:
+            logging.info(f"Checkpointing heatmap to: {filename}")
+            with open(filename, 'w+b') as f:
+                f.truncate(file_size)
+                f.write(header)
+                f.flush()
+                self._mmap = mmap.mmap(f.fileno(), file_size)
+
+    def _write(self, counts, num_frames, background, seconds_captured, timestamp_ns, complete):
+        height, width = counts.shape
+        if self._mmap is None:
+            self._open(height, width, self._channels)
+        self.sequence += 1
+        offset = self._slot_offsets[self.sequence % 2]
+        counts_offset = offset + _CHECKPOINT_SLOT_DATA_OFFSET
+        background_offset = counts_offset + 4 * height * width
+        np.copyto(np.frombuffer(self._mmap, counts.dtype, counts.size, counts_offset).reshape(counts.shape), counts)
+        if background is not None:
+            np.copyto(np.frombuffer(self._mmap, 'uint8', background.size, background_offset).reshape(background.shape), background)
+        self._mmap.flush(offset, self._slot_size)
+
+        flags = (_CHECKPOINT_COMPLETE if complete else 0) | (_CHECKPOINT_HAS_BACKGROUND if background is not None else 0)
+        slot_header = _CHECKPOINT_SLOT_HEADER.pack(self.sequence, num_frames, seconds_captured, timestamp_ns, counts.dtype.str.encode(), flags, 0)
+        crc = zlib.crc32(slot_header[:-4])
+        crc = zlib.crc32(counts, crc)
+        if background is not None:
+            crc = zlib.crc32(np.ascontiguousarray(background), crc)
+        self._mmap[offset:offset + len(slot_header)] = slot_header[:-4] + struct.pack('<I', crc)
+        self._mmap.flush(offset, len(slot_header))
+        self.num_checkpoints += 1
+
+    def close(self):
+        # Waits for the pending checkpoint, if there is one, to be written
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._worker_thread.join()
+        if self._mmap is not None:
+            self._mmap.close()
+            logging.info(f"Wrote {self.num_checkpoints} heatmap checkpoints to: {self._config.checkpoint_filename}")
+
+
+def _load_checkpoint(filename):
+    # Returns the latest complete checkpoint in the file, or None if there isn't one. Slots that were cut off partway
+    # through being written fail their checksum and get passed over.
+    if not os.path.exists(filename) or os.path.getsize(filename) < _CHECKPOINT_HEADER.size:
+        return None
+    with open(filename, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        magic, height, width, channels, accumulation_mode, source_id = _CHECKPOINT_HEADER.unpack_from(data)
+        if magic != _CHECKPOINT_MAGIC:
+            logging.warning(f"Not a heatmap checkpoint: {filename}")
+            return None
+        slot_offsets, slot_size = _get_checkpoint_slot_offsets(height, width, channels)
+        latest = None
+        for offset in slot_offsets:
+            if offset + slot_size > len(data):
+                continue
+            sequence, num_frames, seconds_captured, timestamp_ns, dtype, flags, crc = _CHECKPOINT_SLOT_HEADER.unpack_from(data, offset)
+            if sequence == 0 or (latest is not None and sequence < latest.sequence):
+                continue
+            try:
+                dtype = np.dtype(dtype.rstrip(b'\0').decode())
+            except (TypeError, UnicodeDecodeError):
+                continue
+            counts_offset = offset + _CHECKPOINT_SLOT_DATA_OFFSET
+            background_offset = counts_offset + 4 * height * width
+            counts_nbytes, background_nbytes = height * width * dtype.itemsize, height * width * channels
+            expected_crc = zlib.crc32(data[offset:offset + _CHECKPOINT_SLOT_HEADER.size - 4])
+            expected_crc = zlib.crc32(data[counts_offset:counts_offset + counts_nbytes], expected_crc)
+            if flags & _CHECKPOINT_HAS_BACKGROUND:
+                expected_crc = zlib.crc32(data[background_offset:background_offset + background_nbytes], expected_crc)
+            if dtype.itemsize > 4 or crc != expected_crc:
+                logging.warning(f"Heatmap checkpoint {sequence} in {filename} is incomplete; ignoring it")
+                continue
+            counts = np.frombuffer(data, dtype, height * width, counts_offset).reshape(height, width).copy()
+            background = None
+            if flags & _CHECKPOINT_HAS_BACKGROUND:
+                background = np.frombuffer(data, 'uint8', background_nbytes, background_offset).reshape((height, width, channels) if channels > 1 else (height, width)).copy()
+            latest = _Checkpoint(sequence, counts, num_frames, seconds_captured, timestamp_ns, background, accumulation_mode.rstrip(b'\0').decode(), bool(flags & _CHECKPOINT_COMPLETE), source_id)
+        return latest
+    finally:
+        data.close()
+
+
+def _process_file_chunk(config_values, chunk_start, chunk_end):
+    # Runs in a worker process. Feeds the frames leading up to the chunk into a fresh background model without counting
+    # them, then builds the heatmap for the frames in [chunk_start, chunk_end). The config is passed in as plain values
+    # since worker processes don't necessarily inherit changes made to it at runtime.
+    chunk_config = create_config(**config_values)
+    chunk_config.render_to_screen = False
+    chunk_config.render_to_video = False
+    chunk_config.capture_threaded_enabled = False
+
+    fps = cv2.VideoCapture(chunk_config.video_capture_input_filename).get(cv2.CAP_PROP_FPS)
+    warmup_start = max(0, chunk_start - math.ceil(fps * chunk_config.file_parallel_warmup_seconds))
+    capture_context = _CaptureContext(chunk_config, warmup_start, chunk_end)
+    bg_model = _BackgroundModel(chunk_config)
+    mask_processor = _MaskProcessor(chunk_config, kernel_scale=capture_context.kernel_scale)
+    heatmap = _create_heatmap_accumulator(chunk_config, windowed=False)
+    if isinstance(heatmap, _OccupancyAccumulator):
+        heatmap.set_kernel_scale(capture_context.kernel_scale)
+    capture_context.sleep_until_time_to_read()
     while not capture_context.is_expired():
+        frame_index = capture_context.num_frames_read
         success, frame = capture_context.read()
         if not success:
             break
+        if frame_index < chunk_start:
+            bg_model.apply(frame)
+        else:
+            heatmap.add(mask_processor.process(bg_model, frame), mask_processor.regions)
+        capture_context.sleep_until_time_to_read()
+    capture_context.close()
+    return heatmap, bg_model.background()
 
-        # Down-sample the image to the target dimensions
-        if config.down_sampling_enabled:
-            frame = cv2.resize(frame, config.down_sampling_size, interpolation=cv2.INTER_AREA)
 
-        # Incorporate the current frame into our averaged background and get the updated foreground mask
-        fg_mask = bg_subtractor.apply(frame)
-        fg_mask[fg_mask > 0] = 255  # People often seem to get detected as shadows (i.e. 127), so round up to 255
-        bg = bg_subtractor.getBackgroundImage()
+def _generate_heatmap_parallel(config=config):
+    # Splits the video file into file_parallel_workers chunks holding the same number of sampled frames, and analyses
+    # each chunk in its own process. Each worker starts from a fresh background model that has only seen the
+    # file_parallel_warmup_seconds of video before its chunk, so its foreground masks can differ from a serial run's
+    # until that model has caught up. Both subtractors weight their model over their last H = getHistory() samples
+    # (500 by default), so with W warm-up samples per worker, each of the N - 1 chunk boundaries can only affect the
+    # first max(0, H - W) sampled frames after it. Per pixel, the merged hit count therefore differs from a serial run
+    # by at most (N - 1) * max(0, H - W) frames out of the total; in practice the models settle well within H samples
+    # and the difference is much smaller. Throughput scales with the number of workers, less the warm-up each one does.
+    capture = cv2.VideoCapture(config.video_capture_input_filename)
+    if not capture.isOpened():
+        logging.error("Unable to open video capture")
+        raise IOError
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    cutoff_frame = fps * config.video_capture_time_seconds
+    frame_count = capture.get(cv2.CAP_PROP_FRAME_COUNT)
+    if frame_count > 0:
+        cutoff_frame = min(cutoff_frame, frame_count)
+    capture.release()
 
-        # We do this to reduce noise and merge/emphasize the relevant parts of the foreground mask. See:
-        # https://opencv-python-tutroals.readthedocs.io/en/latest/py_tutorials/py_imgproc/py_morphological_ops/py_morphological_ops.html
-        if config.noise_reduction_enabled:
-            erosion_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, config.noise_reduction_erosion_kernel_size)
-            fg_mask = cv2.erode(fg_mask, erosion_kernel)
-            dilation_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, config.noise_reduction_dilation_kernel_size)
-            fg_mask = cv2.dilate(fg_mask, dilation_kernel)
+    # Chunk boundaries need to be deterministic, which the wall-clock based 'REALTIME' sampling strategy isn't
+    config_values = {name: getattr(config, name) for name in _CONFIG_OPTIONS}
+    if config.frame_sampling_enabled and config.frame_sampling_file_strategy == 'REALTIME':
+        logging.info("Parallel processing samples frames at fixed intervals; using the STRIDE sampling strategy")
+        config_values['frame_sampling_file_strategy'] = 'STRIDE'
+    frames = _get_sample_frames(fps, cutoff_frame, config) if config.frame_sampling_enabled else range(math.ceil(cutoff_frame))
+    if len(frames) == 0:
+        logging.info("Done collecting data from 0 frames")
+        return _create_heatmap_accumulator(config, windowed=False), None
+    num_workers = max(1, min(config.file_parallel_workers, len(frames)))
+    boundaries = [frames[len(frames) * i // num_workers] for i in range(num_workers)] + [math.ceil(cutoff_frame)]
+
+    history = _create_bg_subtractor(config).getHistory()
+    warmup_samples = len([frame for frame in frames if frame < math.ceil(fps * config.file_parallel_warmup_seconds)])
+    logging.info(f"Processing {len(frames)} frames in {num_workers} parallel chunks; per-pixel hit counts may differ from a serial run by at most {min(len(frames), (num_workers - 1) * max(0, history - warmup_samples))} frames")
+    if config.render_to_screen or config.render_to_video:
+        logging.warning("Live rendering isn't supported when processing a file in parallel chunks")
+
+    with concurrent.futures.ProcessPoolExecutor(num_workers) as executor:
+        futures = [executor.submit(_process_file_chunk, config_values, boundaries[i], boundaries[i + 1]) for i in range(num_workers)]
+        results = [future.result() for future in futures]
+
+    # Hit counts simply add up. The backgrounds are averaged, weighted by how many frames went into each chunk.
+    heatmap = _create_heatmap_accumulator(config, windowed=False)
+    bg_sum = None
+    for chunk_heatmap, chunk_bg in results:
+        if chunk_heatmap.num_frames == 0:
+            continue
+        heatmap.merge(chunk_heatmap)
+        bg_sum = chunk_heatmap.num_frames * chunk_bg.astype('float64') if bg_sum is None else bg_sum + chunk_heatmap.num_frames * chunk_bg
+    logging.info(f"Done collecting data from {heatmap.num_frames} frames")
+    if heatmap.num_frames == 0:
+        # Every chunk came up empty, e.g. if the file turned out to be shorter than it claimed; like a serial scan of no
+        # frames, there's no background to return
+        return heatmap, None
+    bg = (bg_sum / heatmap.num_frames).round().astype('uint8')
+    return heatmap, bg
+
+
+def create_config(base=config, **overrides):
+    # Returns a copy of the current values of base (the global config.HeatmapConfig by default) as a HeatmapConfig
+    # instance, with the given overrides applied. Changes to the copy don't affect base, and vice versa.
+    for name in overrides:
+        if name not in _CONFIG_OPTIONS:
+            raise ValueError(f"Unknown heatmap config option: {name}")
+    snapshot = config()
+    for name in _CONFIG_OPTIONS:
+        setattr(snapshot, name, overrides[name] if name in overrides else getattr(base, name))
+    return snapshot
+
+
+class HeatmapGenerator:
+    # Builds a heatmap from a single video stream. Each generator owns a private copy of its config along with its own
+    # capture, background model and accumulator, so several generators can analyse separate streams side by side (see
+    # run_heatmap_generators()). Frames can either be pulled from the configured video stream with run(), or pushed in
+    # by the caller with process_frame().
+    config: config
+    metrics: _Metrics
+    _bg: np.ndarray = None  # Merged background from a parallel file scan, or that of a finished scan restored from its checkpoint
+    _down_sampling: tuple = None  # (size, kernel_scale) for frames fed in with process_frame(), once it's known
+    _checkpoint_writer: _CheckpointWriter = None  # Started on the first checkpoint, if config.checkpoint_enabled is True
+    _checkpoint_sequence = 0  # Sequence number of the latest checkpoint of the scan, including the one it got resumed from
+    _seconds_resumed = 0.0  # Seconds of the scan that were captured before it got resumed from a checkpoint
+    _first_timestamp_ns = None
+    _last_timestamp_ns = None
+    _checkpoint_timestamp_ns = None  # Timestamp of the last frame in the latest checkpoint
+    _checkpoint_complete = False  # Whether the latest checkpoint is the final one of a finished scan
+    _next_checkpoint_ns = 0
+    _frame_interval_ns = 0  # Time between consecutive frames of the video stream, if it's known
+    _frame_channels = 3
+    _warm_up_on_next_frame = False  # Set on resuming from a checkpoint that has no background to seed the model with
+
+    # Number of times the background of a checkpoint (or, failing that, the first frame after resuming) gets fed into a
+    # fresh background model on resuming from it, which is about what KNN needs before it stops flagging the whole frame
+    # as foreground
+    RESUME_WARM_UP_FRAMES = 10
+
+    def __init__(self, config=config, **overrides):
+        self.config = create_config(config, **overrides)
+        self.metrics = _Metrics(self.config)
+        self._bg_model = _BackgroundModel(self.config)
+        self._mask_processor = _MaskProcessor(self.config, self.metrics)
+        self._heatmap = _create_heatmap_accumulator(self.config, self.metrics)
+        self._mask_recorder = _MaskRecorder(self.config, self.metrics) if self.config.mask_recording_enabled else None
+
+    @property
+    def heatmap(self):
+        # Per-pixel hit counts accumulated so far
+        return self._heatmap.counts
+
+    @property
+    def num_frames(self):
+        return self._heatmap.num_frames
+
+    @property
+    def head_counts(self):
+        # Number of people found in each frame, if the heatmap is built out of blobs (see config.heatmap_accumulation_mode)
+        return self._heatmap.head_counts if isinstance(self._heatmap, _OccupancyAccumulator) else None
+
+    def background(self):
+        return self._bg if self._bg is not None else self._bg_model.background()
+
+    def warm_up(self, frame):
+        # Feeds an already down-sampled frame into the background model without counting its foreground, so that the
+        # model has converged by the time the scan proper starts
+        self._bg_model.apply(frame)
+
+    def process_frame(self, frame, timestamp_ns=None):
+        # Incorporates a frame the caller already has into the heatmap, down-sampling it first if configured. The frame's
+        # capture time (from time.time_ns()) only matters for the heatmap window, and defaults to now. Returns the
+        # cleaned-up foreground mask, which is only valid until the next frame gets processed.
+        if self._down_sampling is None:
+            self._down_sampling = _get_down_sampling(self.config, frame.shape[1], frame.shape[0])
+            self._set_kernel_scale(self._down_sampling[1])
+        down_sampling_size = self._down_sampling[0]
+        if down_sampling_size is not None:
+            start_time_ns = time.perf_counter_ns()
+            frame = cv2.resize(frame, down_sampling_size, interpolation=cv2.INTER_AREA)
+            self.metrics.add_time('resize', start_time_ns)
+        return self._process(frame, timestamp_ns if timestamp_ns is not None else time.time_ns())
+
+    def _set_kernel_scale(self, kernel_scale):
+        if kernel_scale != self._mask_processor.kernel_scale:
+            self._mask_processor = _MaskProcessor(self.config, self.metrics, kernel_scale)
+        if isinstance(self._heatmap, _OccupancyAccumulator):
+            self._heatmap.set_kernel_scale(kernel_scale)
+        if self._mask_recorder is not None:
+            self._mask_recorder.kernel_scale = kernel_scale
+
+    def _process(self, frame, timestamp_ns):
+        if self._warm_up_on_next_frame:
+            self._warm_up_on_next_frame = False
+            for _ in range(self.RESUME_WARM_UP_FRAMES):
+                self.warm_up(frame)
+        fg_mask = self._mask_processor.subtract(self._bg_model, frame)
+        if self._mask_recorder is not None and self.config.mask_recording_stage == 'RAW':
+            self._mask_recorder.write(fg_mask, timestamp_ns)
+        fg_mask = self._mask_processor.clean(fg_mask)
+        if self._mask_recorder is not None and self.config.mask_recording_stage == 'CLEANED':
+            self._mask_recorder.write(fg_mask, timestamp_ns)
 
         # Update the heatmap
-        if heatmap is None:
-            heatmap = np.zeros(fg_mask.shape, 'float64')
-        heatmap += fg_mask
+        start_time_ns = time.perf_counter_ns()
+        if isinstance(self._heatmap, _WindowedHeatmapAccumulator):
+            self._heatmap.add(fg_mask, timestamp_ns, self._mask_processor.regions)
+        else:
+            self._heatmap.add(fg_mask, self._mask_processor.regions)
+        self.metrics.add_time('accumulation', start_time_ns)
 
-        # TODO: The erosion/dilation above removes noise but might still yield clusters of circles that represent a single
-        #       person. From here, we can apply that directly to the heatmap, or we can try clustering blobs to recognize
-        #       unique people, then applying their centroid+radius to the heatmap. We might get cleaner results, but it
-        #       would probably be more computationally intensive. This stackoverflow answer shows how the dbscan clustering
-        #       algorithm can be used to achieve this: https://stackoverflow.com/a/23997322/477451
+        if self._first_timestamp_ns is None:
+            self._first_timestamp_ns = timestamp_ns
+            self._next_checkpoint_ns = timestamp_ns + 1e9 * self.config.checkpoint_interval_seconds
+            self._frame_channels = frame.shape[2] if frame.ndim == 3 else 1
+        self._last_timestamp_ns = timestamp_ns
+        if self.config.checkpoint_enabled and timestamp_ns >= self._next_checkpoint_ns:
+            self._checkpoint()
 
-        render_context.render(frame, heatmap)
-        capture_context.sleep_until_time_to_read()
+        return fg_mask
+
+    def _checkpoint(self, complete=False):
+        # Hands the heatmap so far over to the checkpoint writer. Reconstructing the background would hold up the
+        # analysis loop, so checkpoints taken during the scan only include one if the background model already has a
+        # snapshot to hand (see config.bg_snapshot_interval_frames); the final checkpoint of a finished scan always does.
+        start_time_ns = time.perf_counter_ns()
+        self._next_checkpoint_ns = self._last_timestamp_ns + 1e9 * self.config.checkpoint_interval_seconds
+        self._checkpoint_timestamp_ns = self._last_timestamp_ns
+        self._checkpoint_complete = complete
+        if self._checkpoint_writer is None:
+            self._checkpoint_writer = _CheckpointWriter(self.config, self.metrics, self._checkpoint_sequence, self._frame_channels)
+        background = self.background() if complete else self._bg_model.latest_snapshot()
+        # A scan covers its last frame along with the time up to the next one
+        seconds_captured = self._seconds_resumed + 1e-9 * (self._last_timestamp_ns - self._first_timestamp_ns + self._frame_interval_ns)
+        self._checkpoint_writer.submit(self._heatmap.counts, self._heatmap.num_frames, background, seconds_captured, self._last_timestamp_ns, complete)
+        self.metrics.add_time('checkpoint', start_time_ns)
+
+    def _resume(self, frame_size):
+        # Restores the heatmap from the scan's checkpoint, if there's one of the same video source and sampling config
+        # for frames of the given (width, height), and returns it. Unless the background model has already been warmed up, it gets seeded with the checkpoint's
+        # background, or if the checkpoint doesn't have one, with the first frame that gets processed. If the scan had
+        # already finished, the checkpoint's background stands in for the background model's.
+        checkpoint = _load_checkpoint(self.config.checkpoint_filename)
+        if checkpoint is None:
+            return None
+        height, width = checkpoint.counts.shape
+        if (width, height) != tuple(frame_size) or checkpoint.accumulation_mode != self.config.heatmap_accumulation_mode:
+            logging.warning(f"Ignoring heatmap checkpoint {self.config.checkpoint_filename}, which is of a {width}x{height} {checkpoint.accumulation_mode} heatmap "
+                            f"rather than a {frame_size[0]}x{frame_size[1]} {self.config.heatmap_accumulation_mode} one")
+            return None
+        if checkpoint.source_id != _get_checkpoint_source_id(self.config):
+            logging.warning(f"Ignoring heatmap checkpoint {self.config.checkpoint_filename}, which is of a different video source or frame sampling config")
+            return None
+        restored = _create_heatmap_accumulator(self.config, windowed=False)
+        restored.counts, restored.num_frames = checkpoint.counts, checkpoint.num_frames
+        self._heatmap.merge(restored)
+        self._checkpoint_sequence = checkpoint.sequence
+        self._seconds_resumed = checkpoint.seconds_captured
+        if checkpoint.complete:
+            self._bg = checkpoint.background
+            logging.info(f"Heatmap scan already finished according to checkpoint {self.config.checkpoint_filename}: {checkpoint.num_frames} frames over {checkpoint.seconds_captured:.1f} seconds")
+            return checkpoint
+        if self._bg_model.num_frames == 0:
+            if checkpoint.background is not None:
+                for _ in range(self.RESUME_WARM_UP_FRAMES):
+                    self.warm_up(checkpoint.background)
+            else:
+                self._warm_up_on_next_frame = True
+        logging.info(f"Resuming heatmap scan from checkpoint {self.config.checkpoint_filename}: {checkpoint.num_frames} frames over {checkpoint.seconds_captured:.1f} seconds")
+        return checkpoint
+
+    def run(self):
+        # Reads frames from the configured video stream until the scan is over, then returns the rendered heatmap and the
+        # background image
+        self.capture()
+        return self.result()
+
+    def capture(self, capture_context=None):
+        # Reads frames from the configured video stream until the scan is over, leaving the raw heatmap counts in place
+        # for the caller to render, e.g. with render_and_save_images() in a worker process. If given an open capture
+        # context (see HeatmapSession), the scan runs on that instead, and the capture is left open afterwards.
+        config_string = ','.join(f"{name}={getattr(self.config, name)}" for name in _CONFIG_OPTIONS)
+        logging.info(f"Starting heatmap generator with config: {config_string}")
+
+        owns_capture = capture_context is None
+        if owns_capture and self.config.video_capture_mode == 'FILE' and self.config.file_parallel_workers > 1:
+            if self._mask_recorder is not None:
+                logging.warning("Foreground masks can't be recorded when analysing a file in parallel; not recording them")
+            if self.config.checkpoint_enabled:
+                logging.warning("Heatmaps can't be checkpointed when analysing a file in parallel; not checkpointing them")
+            self._heatmap, self._bg = _generate_heatmap_parallel(self.config)
+            return
+
+        if owns_capture:
+            capture_context = _CaptureContext(self.config, metrics=self.metrics)
+        else:
+            capture_context.start_scan(self.metrics, self.config)
+        self._frame_interval_ns = 1e9 / capture_context.fps if capture_context.fps > 0 else 0
+        checkpoint = self._resume(capture_context.frame_size) if self.config.checkpoint_enabled and self.config.checkpoint_resume_enabled else None
+        if checkpoint is not None and checkpoint.complete:
+            if owns_capture:
+                capture_context.close()
+            return
+        if checkpoint is not None:
+            if owns_capture and not capture_context.is_live:
+                # Pick the file up from the first frame due to be sampled after the last one the checkpoint covers
+                capture_context.seek(round(1e-9 * checkpoint.timestamp_ns * capture_context.fps) + 1)
+            capture_context.start_scan(seconds_captured=checkpoint.seconds_captured)
+        self._set_kernel_scale(capture_context.kernel_scale)
+        render_context = _RenderContext(capture_context.frame_size, self.config)
+
+        while not capture_context.is_expired():
+            # Read the next frame, down-sampled to the target dimensions if configured
+            frame_start_time_ns = time.perf_counter_ns()
+            success, frame = capture_context.read()
+            if not success:
+                break
+
+            self._process(frame, capture_context.frame_timestamp_ns)
+
+            start_time_ns = time.perf_counter_ns()
+            render_context.render(frame, self._heatmap, capture_context.frame_timestamp_ns)
+            self.metrics.add_time('rendering', start_time_ns)
+            self.metrics.add_frame(capture_context, frame_start_time_ns)
+            capture_context.sleep_until_time_to_read()
+
+        logging.info(f"Done collecting data; heatmap accumulator holds {self._heatmap.num_frames} frames in {self._heatmap.nbytes} bytes")
+        if self.head_counts:
+            logging.info(f"Counted {min(self.head_counts)} to {max(self.head_counts)} people per frame, {sum(self.head_counts) / len(self.head_counts):.1f} on average")
+        if owns_capture:
+            capture_context.close()
+        render_context.close()
+        self.close()
+
+    def close(self):
+        # Finishes off the mask recording, if there is one, and writes a final checkpoint. Only needs calling when frames
+        # were fed in with process_frame(); capture() does this itself.
+        if self._mask_recorder is not None:
+            self._mask_recorder.close()
+        if self.config.checkpoint_enabled and self._last_timestamp_ns is not None and not self._checkpoint_complete:
+            self._checkpoint(complete=True)
+        if self._checkpoint_writer is not None:
+            self._checkpoint_writer.close()
+            self._checkpoint_sequence = self._checkpoint_writer.sequence
+            self._checkpoint_writer = None
+
+    def discard_checkpoint(self):
+        # Deletes the scan's checkpoint, e.g. once its results have been saved, so that the next scan with the same
+        # checkpoint_filename starts over rather than resuming this one
+        if self.config.checkpoint_enabled and os.path.exists(self.config.checkpoint_filename):
+            os.remove(self.config.checkpoint_filename)
+
+    def value_range(self):
+        # Smallest and largest hit counts in the heatmap so far
+        return self._heatmap.value_range()
+
+    def window(self, seconds=None):
+        # Returns the heatmap over the most recent window of the scan (see config.heatmap_window_mode), scaled and
+        # coloured in for rendering. Can be called from another thread while the scan is running. Returns None if the
+        # heatmap isn't windowed (which is always the case for parallel file scans) or nothing has been captured yet.
+        if not isinstance(self._heatmap, _WindowedHeatmapAccumulator):
+            return None
+        counts = self._heatmap.window(seconds)
+        return _scale_heatmap_for_rendering(counts, config=self.config) if counts is not None else None
+
+    def result(self):
+        # Returns the heatmap so far, scaled and coloured in for rendering, along with the background image
+        start_time_ns = time.perf_counter_ns()
+        rendered_heatmap = _scale_heatmap_for_rendering(self._heatmap.counts, self._heatmap.value_range(), self.config)
+        self.metrics.add_time('rendering', start_time_ns)
+        self.metrics.emit()
+        return rendered_heatmap, self.background()
+
+
+class HeatmapSession:
+    # Keeps the video stream open across several heatmap scans, e.g. one per waypoint of a mission, so that the camera or
+    # gstreamer pipeline only gets started once. Live streams are always read on the capture reader thread with the
+    # DROP_OLDEST policy, so the camera keeps streaming between scans without building up a backlog of stale frames.
+    # Rather than waiting a fixed amount of time for the drone to settle before a scan, wait_until_stable() watches the
+    # stream until the camera stops moving, and feeds the steady frames it sees into the next scan's background model so
+    # that the scan starts out with a converged model. A video file stands in for what the camera sees at each waypoint,
+    # so it gets read from the start again for each one: wait_until_stable() rewinds it, as does scan() if it wasn't
+    # preceded by wait_until_stable().
+    config: config
+    _next_generator: HeatmapGenerator = None  # Generator for the next scan, warmed up by wait_until_stable()
+    _hanning_window: np.ndarray = None
+
+    # Options that the background model warmed up by wait_until_stable() depends on, either directly or through the size
+    # of the frames it was fed
+    _BACKGROUND_MODEL_OPTIONS = ('bg_subtraction_algo', 'bg_snapshot_interval_frames', 'roi_polygon', 'down_sampling_enabled', 'down_sampling_mode', 'down_sampling_size',
+                                 'down_sampling_target_pixels_per_metre', 'camera_altitude_meters', 'camera_horizontal_fov_degrees')
+
+    def __init__(self, config=config, **overrides):
+        self.config = create_config(config, **overrides)
+        if self.config.video_capture_mode != 'FILE' and not (self.config.capture_threaded_enabled and self.config.capture_buffer_drop_policy == 'DROP_OLDEST'):
+            logging.info("Reading the live stream on a DROP_OLDEST capture reader thread so that it keeps streaming between scans")
+            self.config.capture_threaded_enabled = True
+            self.config.capture_buffer_drop_policy = 'DROP_OLDEST'
+        self._capture_context = _CaptureContext(self.config, persistent=True)
+
+    def _stability_frame(self, frame):
+        # Scales the frame down to a small grayscale float image for phase correlation
+        width = self.config.session_stability_frame_width
+        height = max(1, round(width * frame.shape[0] / frame.shape[1]))
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        small = cv2.resize(gray, (width, height), interpolation=cv2.INTER_AREA).astype(np.float32)
+        if self._hanning_window is None or self._hanning_window.shape != small.shape:
+            self._hanning_window = cv2.createHanningWindow((width, height), cv2.CV_32F)
+        return small
+
+    def wait_until_stable(self, **overrides):
+        # Reads frames until the global shift between consecutive ones (as estimated by phase correlation, which ignores
+        # the odd pedestrian) has stayed within session_stability_max_shift_pixels for session_stability_duration_millis.
+        # Returns whether the camera settled down before session_stability_timeout_seconds ran out; either way, the next
+        # scan can go ahead. Overrides apply to the next scan, and since frames already get read at that scan's
+        # resolution, anything that affects down-sampling (e.g. camera_altitude_meters) should be given here. Frames
+        # are read through the scan's sampling strategy, and a video file never gets read past the point where there's
+        # only enough of it left for the scan.
+        generator = HeatmapGenerator(self.config, **overrides)
+        self._capture_context.set_config(generator.config)
+        self._rewind()
+        previous_frame = None
+        start_timestamp_ns = None
+        stable_since_ns = None
+        while True:
+            if self._capture_context.seconds_left <= generator.config.video_capture_time_seconds:
+                logging.warning("Only enough of the video file left for the scan; scanning without waiting for the camera to stabilize")
+                break
+            success, frame = self._capture_context.read()
+            if not success:
+                logging.warning("Video stream ended while waiting for the camera to stabilize")
+                break
+            timestamp_ns = self._capture_context.frame_timestamp_ns
+            if start_timestamp_ns is None:
+                start_timestamp_ns = timestamp_ns
+            stability_frame = self._stability_frame(frame)
+            if previous_frame is not None:
+                (shift_x, shift_y), _ = cv2.phaseCorrelate(previous_frame, stability_frame, self._hanning_window)
+                if math.hypot(shift_x, shift_y) > generator.config.session_stability_max_shift_pixels:
+                    if stable_since_ns is not None:
+                        generator = HeatmapGenerator(self.config, **overrides)
+                    stable_since_ns = None
+                else:
+                    if stable_since_ns is None:
+                        stable_since_ns = timestamp_ns
+                    generator.warm_up(frame)
+                    if timestamp_ns - stable_since_ns >= 1e6 * generator.config.session_stability_duration_millis:
+                        logging.info(f"Camera stabilized after {1e-9 * (timestamp_ns - start_timestamp_ns):.2f} seconds")
+                        self._next_generator = generator
+                        return True
+            previous_frame = stability_frame
+            self._capture_context.sleep_until_time_to_read()
+            if timestamp_ns - start_timestamp_ns >= 1e9 * generator.config.session_stability_timeout_seconds:
+                logging.warning(f"Camera still not stable after {generator.config.session_stability_timeout_seconds} seconds; scanning anyway")
+                break
+        self._next_generator = generator
+        return False
+
+    def scan(self, **overrides):
+        # Runs a heatmap scan on the open stream and returns its generator, with the raw heatmap counts in place (see
+        # HeatmapGenerator.capture()). Overrides only apply to this scan, and can't change anything about the capture
+        # itself, e.g. they can give each scan its own mask_recording_filename. The scan gets a generator of its own,
+        # built with the overrides, which takes over the background model warmed up by wait_until_stable() unless the
+        # overrides change what that model was built for.
+        warmed_up = self._next_generator
+        self._next_generator = None
+        if warmed_up is None:
+            self._rewind()
+            generator = HeatmapGenerator(self.config, **overrides)
+        else:
+            generator = HeatmapGenerator(warmed_up.config, **overrides)
+            changed = [name for name in self._BACKGROUND_MODEL_OPTIONS if getattr(generator.config, name) != getattr(warmed_up.config, name)]
+            if changed:
+                logging.warning(f"Scan overrides change {', '.join(changed)}; starting the scan with a fresh background model rather than the warmed up one")
+            else:
+                generator._bg_model = warmed_up._bg_model
+        generator.capture(self._capture_context)
+        return generator
+
+    def _rewind(self):
+        if not self._capture_context.is_live:
+            self._capture_context.seek(0)
+
+    def close(self):
+        self._capture_context.close()
+
+
+def run_heatmap_generators(generators):
+    # Runs each of the generators on its own thread and returns their results in the same order. OpenCV releases the GIL
+    # while it decodes and processes frames, so the generators really do run in parallel.
+    with concurrent.futures.ThreadPoolExecutor(len(generators), thread_name_prefix='heatmap-generator') as executor:
+        return list(executor.map(HeatmapGenerator.run, generators))
+
+
+def generate_heatmap():
+    # Generates a heatmap using the global config.HeatmapConfig; see HeatmapGenerator for more control
+    global _latest_metrics
+    generator = HeatmapGenerator()
+    _latest_metrics = generator.metrics
+    return generator.run()
+
+
+def save_images(bg_out_file, heatmap_out_file, heatmap, bg, metrics=None):
+    # Writes the background and the heatmap overlaid onto it as images, adding the time it took to the metrics of the
+    # scan that generated them (the most recent generate_heatmap() call, unless given)
+    metrics = metrics if metrics is not None else _latest_metrics
+    start_time_ns = time.perf_counter_ns()
+    cv2.imwrite(bg_out_file, bg)
+    cv2.imwrite(heatmap_out_file, cv2.add(heatmap, bg))
+    if metrics is not None:
+        metrics.add_time('image_write', start_time_ns)
+        metrics.emit()
 
-    logging.info("Done collecting data")
-    capture_context.close()
-    render_context.close()
 
-    rendered_heatmap = _scale_heatmap_for_rendering(heatmap)
-    return rendered_heatmap, bg
+def render_and_save_images(bg_out_file, heatmap_out_file, counts, value_range, bg, config=config):
+    # Scales and colours in raw heatmap counts (see HeatmapGenerator.capture()) and saves them along with the background.
+    # Everything it needs gets passed in, so it can be handed off to a worker process while the caller moves on. Returns
+    # the names of the files it wrote. Raises ValueError if either the counts or the background are missing.
+    if bg is None or bg.size == 0:
+        raise ValueError("No background image to save; was anything captured?")
+    heatmap = _scale_heatmap_for_rendering(counts, value_range, config)
+    save_images(bg_out_file, heatmap_out_file, heatmap, bg)
+    return bg_out_file, heatmap_out_file
 
 
 if __name__ == "__main__":
@@ -206,22 +2159,24 @@ if __name__ == "__main__":
 
     bg_out_file = 'bg.png'
     heatmap_out_file = 'heatmap.png'
+    overrides = {}
 
     if len(sys.argv) > 1:
         logging.info(f"Overriding config to read video stream from file: {sys.argv[1]}")
-        config.video_capture_mode = 'FILE'
-        config.video_capture_input_filename = sys.argv[1]
+        overrides['video_capture_mode'] = 'FILE'
+        overrides['video_capture_input_filename'] = sys.argv[1]
     if len(sys.argv) > 2:
         logging.info(f"Overriding config to write output video stream from file: {sys.argv[1]}")
-        config.render_to_video = True
-        config.render_video_filename = sys.argv[2]
+        overrides['render_to_video'] = True
+        overrides['render_video_filename'] = sys.argv[2]
         out_dir, out_video_filename = os.path.split(os.path.abspath(sys.argv[2]))
         out_basename, _ = os.path.splitext(out_video_filename)
         bg_out_file = os.path.join(out_dir, f'{out_basename}_bg.png')
         heatmap_out_file = os.path.join(out_dir, f'{out_basename}_heatmap.png')
 
-    generated_heatmap, generated_bg = generate_heatmap()
+    generator = HeatmapGenerator(**overrides)
+    generated_heatmap, generated_bg = generator.run()
     
     logging.info(f"Saving images: {bg_out_file}, {heatmap_out_file}")
-    cv2.imwrite(bg_out_file, generated_bg)
-    cv2.imwrite(heatmap_out_file, cv2.add(generated_heatmap, generated_bg))
+    save_images(bg_out_file, heatmap_out_file, generated_heatmap, generated_bg, generator.metrics)
+    generator.discard_checkpoint()
@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+import fake_drone
+import heatmap as hm
+from config import HeatmapConfig as config
+from telemetry_hub import TelemetryHub
+
+"""
+heatmap_benchmark.py
+
+This script benchmarks parts of the heatmap pipeline against deterministic,
+synthetic aerial scenes, so that it can be run on any machine without a camera,
+a drone, or sample footage. Each benchmark logs its results; see the --help
+output for the benchmarks that are available.
+
+The pipeline benchmark runs generate_heatmap() end to end over a matrix of
+configs and records throughput, per-frame latency percentiles and peak memory.
+If a baseline file is given, each run is compared against it, and the script
+exits with an error if a run regressed by more than the threshold or its
+heatmap drifted from the baseline's reference heatmap.
+"""
+
+
+def generate_synthetic_scene(width=640, height=480, num_frames=300, num_blobs=10, seed=0):
+    # Generates frames showing a static, textured background with pedestrian-sized blobs moving across it. The same
+    # arguments always produce the same frames.
+    rng = np.random.default_rng(seed)
+    background = cv2.GaussianBlur(rng.integers(0, 256, (height, width, 3), dtype='uint8'), (0, 0), 3)
+    positions = rng.uniform((0, 0), (width, height), (num_blobs, 2))
+    velocities = rng.uniform(-3, 3, (num_blobs, 2))
+    colors = rng.integers(0, 256, (num_blobs, 3))
+    radius = max(2, min(width, height) // 60)
+    for i in range(num_frames):
+        frame = background.copy()
+        for position, velocity, color in zip(positions, velocities, colors):
+            x, y = (position + i * velocity) % (width, height)
+            cv2.circle(frame, (int(x), int(y)), radius, color.tolist(), -1)
+        yield frame
+
+
+def write_synthetic_video(filename, width, height, fps, duration_seconds, num_blobs, seed=0):
+    # Writes a synthetic scene to a video file. MJPG is used since it's available in every OpenCV build, including the
+    # headless ones.
+    output = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'MJPG'), fps, (width, height))
+    if not output.isOpened():
+        raise IOError(f"Unable to open video file for writing: {filename}")
+    for frame in generate_synthetic_scene(width, height, round(fps * duration_seconds), num_blobs, seed):
+        output.write(frame)
+    output.release()
+
+
+def benchmark_bg_snapshots(args):
+    # Compares reconstructing the background image after every frame (as generate_heatmap() used to) against only
+    # reconstructing it once the scan is done
+    num_frames = args.frames
+    frames = list(generate_synthetic_scene(num_frames=num_frames))
+    for algo in ('KNN', 'MOG2'):
+        bench_config = hm.create_config(bg_subtraction_algo=algo, bg_snapshot_interval_frames=0)
+
+        bg_subtractor = hm._create_bg_subtractor(bench_config)
+        start_time = time.perf_counter()
+        for frame in frames:
+            bg_subtractor.apply(frame)
+            bg_subtractor.getBackgroundImage()
+        eager_millis = 1e3 * (time.perf_counter() - start_time) / num_frames
+
+        bg_model = hm._BackgroundModel(bench_config)
+        start_time = time.perf_counter()
+        for frame in frames:
+            bg_model.apply(frame)
+        bg_model.background()
+        lazy_millis = 1e3 * (time.perf_counter() - start_time) / num_frames
+
+        logging.info(f"[bg_snapshots] {algo}: {eager_millis:.2f}ms per frame with a snapshot every frame, {lazy_millis:.2f}ms per frame with a lazy snapshot; saved {eager_millis - lazy_millis:.2f}ms per frame")
+
+
+def benchmark_mask_processing(args):
+    # Times each dilation mode of the mask processing stage against the original per-frame code, and checks that the
+    # stage doesn't allocate anything once it has processed its first frame
+    num_frames = args.frames
+    frames = list(generate_synthetic_scene(num_frames=num_frames))
+    bench_config = hm.create_config(noise_reduction_enabled=True)
+
+    bg_model = hm._BackgroundModel(bench_config)
+    masks = [bg_model.apply(frame).copy() for frame in frames]
+    start_time = time.perf_counter()
+    for fg_mask in masks:
+        fg_mask[fg_mask > 0] = 255
+        erosion_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, bench_config.noise_reduction_erosion_kernel_size)
+        fg_mask = cv2.erode(fg_mask, erosion_kernel)
+        dilation_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, bench_config.noise_reduction_dilation_kernel_size)
+        cv2.dilate(fg_mask, dilation_kernel)
+    logging.info(f"[mask_processing] original: {1e3 * (time.perf_counter() - start_time) / num_frames:.3f}ms per frame")
+
+    # Time only the post-processing by replaying the masks computed above through a stand-in background model
+    class _ReplayModel:
+        def __init__(self):
+            self._masks = iter(masks)
+
+        def apply(self, frame, fg_mask):
+            np.copyto(fg_mask, next(self._masks))
+            return fg_mask
+
+    for mode in ('ELLIPSE', 'SEPARABLE', 'ITERATED'):
+        mask_processor = hm._MaskProcessor(hm.create_config(bench_config, noise_reduction_dilation_mode=mode))
+        replay_model = _ReplayModel()
+        mask_processor.process(replay_model, frames[0])
+        tracemalloc.start()
+        start_time = time.perf_counter()
+        for frame in frames[1:]:
+            mask_processor.process(replay_model, frame)
+        millis = 1e3 * (time.perf_counter() - start_time) / (num_frames - 1)
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        logging.info(f"[mask_processing] {mode}: {millis:.3f}ms per frame, {peak_bytes} bytes allocated at peak in steady state")
+        if peak_bytes >= masks[0].nbytes:
+            logging.error(f"[mask_processing] {mode}: frame-sized allocations detected in steady state")
+            return False
+    return True
+
+
+def benchmark_occupancy(args):
+    # Compares building the heatmap out of blobs (heatmap_accumulation_mode = 'BLOBS') against summing foreground
+    # pixels, over synthetic scenes of a couple of sizes and crowd densities, so that the cost per frame can be seen to
+    # grow linearly with the number of pixels and blobs. Also reports how close the head counts come to the number of
+    # blobs actually in the scene, which overlapping blobs bring down.
+    for (width, height), num_blobs in itertools.product(((640, 480), (1280, 960)), (10, 40)):
+        frames = generate_synthetic_scene(width, height, args.frames, num_blobs)
+        bg_model = hm._BackgroundModel()
+        mask_processor = hm._MaskProcessor()
+        masks = [mask_processor.process(bg_model, frame).copy() for frame in frames]
+
+        pixel_heatmap = hm._HeatmapAccumulator()
+        start_time = time.perf_counter()
+        for fg_mask in masks:
+            pixel_heatmap.add(fg_mask)
+        pixel_millis = 1e3 * (time.perf_counter() - start_time) / len(masks)
+
+        occupancy_heatmap = hm._OccupancyAccumulator(hm.create_config(heatmap_accumulation_mode='BLOBS'))
+        start_time = time.perf_counter()
+        for fg_mask in masks:
+            occupancy_heatmap.add(fg_mask)
+        blob_millis = 1e3 * (time.perf_counter() - start_time) / len(masks)
+
+        # The background model needs a few frames before it picks out the blobs
+        head_counts = np.array(occupancy_heatmap.head_counts[len(masks) // 10:])
+        logging.info(f"[occupancy] {width}x{height}, {num_blobs} blobs: pixels {pixel_millis:.3f}ms per frame, blobs {blob_millis:.3f}ms per frame "
+                     f"({1e6 * blob_millis / (width * height):.2f}ns per pixel), {head_counts.mean():.1f} people counted per frame on average "
+                     f"(mean absolute error {np.abs(head_counts - num_blobs).mean():.1f})")
+
+
+def benchmark_analysis_regions(args):
+    # Compares analysing the whole frame against only analysing an ROI (the bottom half of the frame), skipping idle
+    # tiles, and both. Reports the fraction of pixels skipped by noise reduction and accumulation, the speedup of all the
+    # analysis stages and of just the ones after background subtraction (which tile skipping leaves alone), and how far
+    # the bottom half of each heatmap ends up from the full-frame one. Runs on a sparse synthetic scene, or on real
+    # footage if a video is given, since how much can be skipped depends entirely on how much of the scene moves.
+    if args.scene_video:
+        capture = cv2.VideoCapture(args.scene_video)
+        frames = []
+        while len(frames) < args.frames:
+            success, frame = capture.read()
+            if not success:
+                break
+            frames.append(frame)
+        capture.release()
+        if not frames:
+            logging.error(f"[analysis_regions] Unable to read any frames from: {args.scene_video}")
+            return False
+    else:
+        frames = list(generate_synthetic_scene(args.width, args.height, args.frames, num_blobs=4))
+
+    runs = {
+        'full_frame': {},
+        'roi': {'roi_polygon': [(0, 0.5), (1, 0.5), (1, 1), (0, 1)]},
+        'tile_skipping': {'tile_skipping_enabled': True},
+        'roi_and_tile_skipping': {'roi_polygon': [(0, 0.5), (1, 0.5), (1, 1), (0, 1)], 'tile_skipping_enabled': True},
+    }
+    frame_interval_ns = round(1e9 / args.fps)
+    baseline_millis = None
+    for name, overrides in runs.items():
+        generator = hm.HeatmapGenerator(metrics_enabled=True, metrics_interval_seconds=math.inf, metrics_output_file=None, down_sampling_enabled=False, **overrides)
+        for i, frame in enumerate(frames):
+            generator.process_frame(frame, i * frame_interval_ns)
+        snapshot = generator.metrics.snapshot()
+        stage_millis = {stage: stats['mean_millis'] for stage, stats in snapshot['stages'].items() if stage in ('bg_subtraction', 'morphology', 'accumulation')}
+        millis = sum(stage_millis.values())
+        post_subtraction_millis = millis - stage_millis['bg_subtraction']
+        heatmap = generator.heatmap[generator.heatmap.shape[0] // 2:].astype('float64')
+        if baseline_millis is None:
+            baseline_millis, baseline_post_subtraction_millis, baseline_heatmap = millis, post_subtraction_millis, heatmap
+        heatmap_error = np.abs(heatmap - baseline_heatmap).mean() / max(1.0, baseline_heatmap.max())
+        stages = ', '.join(f"{stage} {stage_millis[stage]:.3f}ms" for stage in stage_millis)
+        logging.info(f"[analysis_regions] {name}: {snapshot['pixels_skipped_fraction']:.1%} of pixels skipped, {millis:.3f}ms per frame ({stages}), "
+                     f"{baseline_millis / millis:.2f}x speedup overall, {baseline_post_subtraction_millis / post_subtraction_millis:.2f}x after background subtraction, "
+                     f"heatmap differs by {heatmap_error:.4f} of its peak on average")
+
+
+def benchmark_mission_telemetry(args):
+    # Flies the single point mission's climbs and descent on a simulated drone (see fake_drone.py), waiting for each
+    # altitude the way the mission scripts used to (a new position subscription every second, taking one sample) and
+    # through a TelemetryHub, and reports how long each one took to notice the drone had arrived, beyond the time it took
+    # to get within the threshold, along with the number of subscriptions opened. Times are in simulated seconds, with the
+    # simulation running args.time_scale times faster than real time.
+    threshold_meters = 0.25
+    # Climbs that don't take a whole number of seconds, so that polling doesn't happen to line up with the arrivals
+    altitudes = (fake_drone.FakeSystem.TAKEOFF_ALTITUDE_METERS, 13.3, 31.7, 0.0)
+
+    async def poll(drone, altitude):
+        while True:
+            async for position in drone.telemetry.position():
+                break
+            if abs(position.relative_altitude_m - altitude) < threshold_meters:
+                return
+            await asyncio.sleep(1 / drone.time_scale)
+
+    async def fly(wait):
+        drone = fake_drone.FakeSystem(time_scale=args.time_scale)
+        await drone.connect()
+        await drone.action.arm()
+        lag_seconds = []
+        for altitude in altitudes:
+            if altitude == altitudes[0]:
+                await drone.action.takeoff()
+            elif altitude == 0:
+                await drone.action.land()
+            else:
+                await drone.action.goto_location(drone.home.latitude_deg, drone.home.longitude_deg, drone.home.absolute_altitude_m + altitude, 0)
+            climb_seconds = (abs(altitude - drone.relative_altitude_m) - threshold_meters) / drone.climb_rate_m_s
+            start_time = time.perf_counter()
+            await wait(drone, altitude)
+            lag_seconds.append((time.perf_counter() - start_time) * drone.time_scale - climb_seconds)
+        return lag_seconds, drone.num_subscriptions
+
+    async def run():
+        polling_lag_seconds, polling_subscriptions = await fly(poll)
+        hubs = []
+
+        async def wait_for(drone, altitude):
+            if not hubs:
+                hubs.append(TelemetryHub(drone))
+            await hubs[0].wait_for('telemetry.position', lambda position: abs(position.relative_altitude_m - altitude) < threshold_meters)
+
+        hub_lag_seconds, hub_subscriptions = await fly(wait_for)
+        hubs[0].close()
+        return (polling_lag_seconds, polling_subscriptions), (hub_lag_seconds, hub_subscriptions)
+
+    for name, (lag_seconds, num_subscriptions) in zip(('polling', 'hub'), asyncio.run(run())):
+        lags = ', '.join(f"{lag:.2f}s" for lag in lag_seconds)
+        logging.info(f"[mission_telemetry] {name}: arrivals noticed {np.mean(lag_seconds):.2f}s late on average (max {np.max(lag_seconds):.2f}s; {lags}), "
+                     f"{num_subscriptions} position subscriptions")
+
+
+def benchmark_session(args):
+    # Flies a synthetic video file over several waypoints the way heatmap_multi_point.py does, with a HeatmapSession
+    # that waits for the camera to stabilize before each scan, and reports how long each waypoint took. Then checks that
+    # every scan got a whole video_capture_time_seconds worth of frames, with and without the capture reader thread.
+    num_waypoints = 4
+    scan_seconds = 2
+    video_file = os.path.join(args.video_dir or tempfile.gettempdir(), f'heatmap_benchmark_session_{args.fps}fps.avi')
+    if not os.path.exists(video_file):
+        write_synthetic_video(video_file, 320, 240, args.fps, 2 * scan_seconds, 5)
+    passed = True
+    for threaded in (False, True):
+        session = hm.HeatmapSession(video_capture_mode='FILE', video_capture_input_filename=video_file, video_capture_time_seconds=scan_seconds, frame_sampling_enabled=False,
+                                    capture_threaded_enabled=threaded, session_stability_duration_millis=500, session_stability_timeout_seconds=1, render_to_screen=False,
+                                    render_to_video=False, metrics_enabled=False, checkpoint_enabled=False, mask_recording_enabled=False)
+        num_frames = []
+        start_time = time.perf_counter()
+        for _ in range(num_waypoints):
+            session.wait_until_stable()
+            num_frames.append(session.scan().num_frames)
+        millis = 1e3 * (time.perf_counter() - start_time) / num_waypoints
+        session.close()
+        name = 'threaded' if threaded else 'unthreaded'
+        logging.info(f"[session] {name}: {millis:.1f}ms per waypoint, frames per scan: {num_frames}")
+        if num_frames != [round(args.fps * scan_seconds)] * num_waypoints:
+            logging.error(f"[session] {name}: expected {round(args.fps * scan_seconds)} frames at every waypoint")
+            passed = False
+    return passed
+
+
+def benchmark_checkpointing(args):
+    # Measures what checkpointing costs the analysis loop (copying the counts once a second of video, plus reconstructing
+    # the background for the final checkpoint) and how long the background thread takes to write each checkpoint, over a
+    # synthetic scene. Then checks that the checkpoint file holds the final heatmap and background, and that if its latest
+    # checkpoint gets cut off partway through, the one before it gets loaded instead.
+    frames = list(generate_synthetic_scene(640, 480, args.frames))
+    frame_interval_ns = round(1e9 / args.fps)
+    checkpoint_filename = os.path.join(args.video_dir or tempfile.gettempdir(), 'heatmap_benchmark.ckpt')
+    for checkpoint_enabled in (False, True):
+        generator = hm.HeatmapGenerator(metrics_enabled=True, metrics_interval_seconds=math.inf, metrics_output_file=None, down_sampling_enabled=False,
+                                        checkpoint_enabled=checkpoint_enabled, checkpoint_filename=checkpoint_filename, checkpoint_interval_seconds=1, checkpoint_resume_enabled=False)
+        start_time = time.perf_counter()
+        for i, frame in enumerate(frames):
+            generator.process_frame(frame, i * frame_interval_ns)
+        millis = 1e3 * (time.perf_counter() - start_time) / len(frames)
+        generator.close()
+        if not checkpoint_enabled:
+            logging.info(f"[checkpointing] off: {millis:.3f}ms per frame")
+            continue
+        stages = generator.metrics.snapshot()['stages']
+        logging.info(f"[checkpointing] on: {millis:.3f}ms per frame, {stages['checkpoint']['count']} checkpoints taking {stages['checkpoint']['mean_millis']:.3f}ms each "
+                     f"in the analysis loop ({stages['checkpoint']['seconds_total'] * 1e3 / len(frames):.3f}ms per frame) and {stages['checkpoint_write']['mean_millis']:.3f}ms "
+                     f"each to write, {os.path.getsize(checkpoint_filename)} byte file")
+
+    checkpoint = hm._load_checkpoint(checkpoint_filename)
+    if checkpoint is None or not checkpoint.complete or checkpoint.num_frames != generator.num_frames or not np.array_equal(checkpoint.counts, generator.heatmap) or not np.array_equal(checkpoint.background, generator.background()):
+        logging.error("[checkpointing] Checkpoint doesn't hold the final heatmap and background")
+        return False
+    slot_offsets, _ = hm._get_checkpoint_slot_offsets(*checkpoint.counts.shape, checkpoint.background.shape[2])
+    with open(checkpoint_filename, 'r+b') as f:
+        f.seek(slot_offsets[checkpoint.sequence % 2] + hm._CHECKPOINT_SLOT_DATA_OFFSET)
+        f.write(b'\xff' * 4096)
+    previous_checkpoint = hm._load_checkpoint(checkpoint_filename)
+    os.remove(checkpoint_filename)
+    if previous_checkpoint is None or previous_checkpoint.sequence != checkpoint.sequence - 1:
+        logging.error("[checkpointing] Cut-off checkpoint didn't fall back to the previous one")
+        return False
+    logging.info(f"[checkpointing] Final checkpoint holds the heatmap and background; cutting it off falls back to checkpoint {previous_checkpoint.sequence} of {previous_checkpoint.num_frames} frames")
+
+
+def _pipeline_configs(sampling_intervals):
+    # Yields a name and a set of config overrides for each combination in the benchmark matrix. A sampling interval of
+    # 0 disables frame sampling.
+    for algo, down_sampling, noise_reduction, interval in itertools.product(('KNN', 'MOG2'), (False, True), (True, False), sampling_intervals):
+        name = f"{algo}_downsample{int(down_sampling)}_noise{int(noise_reduction)}_interval{interval}"
+        yield name, {
+            'bg_subtraction_algo': algo,
+            'down_sampling_enabled': down_sampling,
+            'noise_reduction_enabled': noise_reduction,
+            'frame_sampling_enabled': interval > 0,
+            'frame_sampling_interval_millis': interval if interval > 0 else config.frame_sampling_interval_millis,
+        }
+
+
+def benchmark_pipeline(args):
+    # Runs generate_heatmap() over a synthetic video for each config in the matrix, then checks the results against the
+    # baseline, if there is one
+    video_dir = args.video_dir or tempfile.gettempdir()
+    video_file = os.path.join(video_dir, f'heatmap_benchmark_{args.width}x{args.height}_{args.fps}fps_{args.duration}s_{args.blobs}blobs.avi')
+    if not os.path.exists(video_file):
+        logging.info(f"[pipeline] Writing synthetic video: {video_file}")
+        write_synthetic_video(video_file, args.width, args.height, args.fps, args.duration, args.blobs)
+
+    default_config = {name: value for name, value in vars(config).items() if not name.startswith('__')}
+    results = {}
+    heatmaps = {}
+    for name, overrides in _pipeline_configs(args.intervals):
+        for option, value in default_config.items():
+            setattr(config, option, value)
+        config.video_capture_mode = 'FILE'
+        config.video_capture_input_filename = video_file
+        config.video_capture_time_seconds = args.duration
+        config.frame_sampling_file_strategy = 'STRIDE'  # The wall-clock based default would make results machine-dependent
+        config.down_sampling_size = (args.width // 2, args.height // 2)
+        config.render_to_screen = False
+        config.render_to_video = False
+        config.metrics_enabled = True
+        config.metrics_interval_seconds = math.inf
+        config.metrics_output_file = None
+        for option, value in overrides.items():
+            setattr(config, option, value)
+
+        # Keep the fastest of the repeated runs, since slower ones are mostly down to noise from the rest of the machine
+        for _ in range(args.repeats):
+            tracemalloc.start()
+            start_time = time.perf_counter()
+            heatmaps[name], _ = hm.generate_heatmap()
+            elapsed_seconds = time.perf_counter() - start_time
+            _, peak_memory_bytes = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            snapshot = hm._latest_metrics.snapshot()
+            result = {
+                'frames_per_second': snapshot['frames_processed'] / elapsed_seconds,
+                'frame_latency_millis': snapshot['frame_latency_millis'],
+                'peak_memory_bytes': peak_memory_bytes,
+            }
+            if name not in results or result['frames_per_second'] > results[name]['frames_per_second']:
+                results[name] = result
+        logging.info(f"[pipeline] {name}: {json.dumps(results[name])}")
+    for option, value in default_config.items():
+        setattr(config, option, value)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if not args.baseline:
+        return True
+    reference_file = f'{os.path.splitext(args.baseline)[0]}_heatmaps.npz'
+    if args.update_baseline or not os.path.exists(args.baseline):
+        logging.info(f"[pipeline] Writing baseline: {args.baseline}, {reference_file}")
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        np.savez_compressed(reference_file, **heatmaps)
+        return True
+    return _compare_to_baseline(args, results, heatmaps, reference_file)
+
+
+def _compare_to_baseline(args, results, heatmaps, reference_file):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    references = np.load(reference_file)
+    passed = True
+    for name, result in results.items():
+        if name not in baseline:
+            logging.warning(f"[pipeline] {name}: not in the baseline; skipping comparison")
+            continue
+        failures = []
+        if result['frames_per_second'] < (1 - args.threshold) * baseline[name]['frames_per_second']:
+            failures.append(f"throughput dropped from {baseline[name]['frames_per_second']:.1f} to {result['frames_per_second']:.1f} frames/sec")
+        baseline_latency = baseline[name]['frame_latency_millis']['p90']
+        if baseline_latency is not None and result['frame_latency_millis']['p90'] > (1 + args.threshold) * baseline_latency:
+            failures.append(f"p90 latency rose from {baseline_latency:.2f}ms to {result['frame_latency_millis']['p90']:.2f}ms")
+        if result['peak_memory_bytes'] > (1 + args.threshold) * baseline[name]['peak_memory_bytes']:
+            failures.append(f"peak memory rose from {baseline[name]['peak_memory_bytes']} to {result['peak_memory_bytes']} bytes")
+        if name in references:
+            heatmap_error = np.abs(heatmaps[name].astype('float64') - references[name]).mean() / 255
+            if heatmap_error > args.heatmap_tolerance:
+                failures.append(f"heatmap differs from the reference by {heatmap_error:.4f} on average")
+        for failure in failures:
+            logging.error(f"[pipeline] {name}: {failure}")
+        passed = passed and not failures
+    logging.info(f"[pipeline] {'No regressions' if passed else 'Regressions'} found against baseline: {args.baseline}")
+    return passed
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s", handlers=[logging.StreamHandler(sys.stdout)])
+
+    benchmarks = {
+        'bg_snapshots': benchmark_bg_snapshots,
+        'mask_processing': benchmark_mask_processing,
+        'analysis_regions': benchmark_analysis_regions,
+        'occupancy': benchmark_occupancy,
+        'mission_telemetry': benchmark_mission_telemetry,
+        'session': benchmark_session,
+        'checkpointing': benchmark_checkpointing,
+        'pipeline': benchmark_pipeline,
+    }
+    parser = argparse.ArgumentParser(description="Benchmarks for the heatmap pipeline")
+    parser.add_argument('benchmarks', nargs='*', help=f"Benchmarks to run, out of: {', '.join(benchmarks)}; runs all of them by default")
+    parser.add_argument('--frames', type=int, default=300, help="Number of synthetic frames for the stage benchmarks")
+    parser.add_argument('--width', type=int, default=1280, help="Width of the synthetic video for the pipeline benchmark")
+    parser.add_argument('--height', type=int, default=720, help="Height of the synthetic video for the pipeline benchmark")
+    parser.add_argument('--fps', type=int, default=30, help="Frame rate of the synthetic video for the pipeline benchmark")
+    parser.add_argument('--duration', type=float, default=10, help="Duration in seconds of the synthetic video for the pipeline benchmark")
+    parser.add_argument('--blobs', type=int, default=20, help="Number of moving blobs in the synthetic video for the pipeline benchmark")
+    parser.add_argument('--intervals', type=int, nargs='+', default=[0, 200], help="Frame sampling intervals in milliseconds to benchmark; 0 disables sampling")
+    parser.add_argument('--repeats', type=int, default=3, help="Number of times to run each pipeline config, keeping the fastest run")
+    parser.add_argument('--scene-video', help="Video to run the analysis_regions benchmark on, e.g. an aerial clip from the Stanford Drone Dataset; defaults to a sparse synthetic scene")
+    parser.add_argument('--time-scale', type=float, default=10, help="How many times faster than real time to fly the simulated drone in the mission_telemetry benchmark")
+    parser.add_argument('--video-dir', help="Directory to keep synthetic videos in; defaults to the system temp directory")
+    parser.add_argument('--output', help="File to write the pipeline results to as JSON")
+    parser.add_argument('--baseline', help="Baseline JSON file to compare the pipeline results against; written if it doesn't exist")
+    parser.add_argument('--update-baseline', action='store_true', help="Overwrite the baseline with the results of this run")
+    parser.add_argument('--threshold', type=float, default=0.2, help="Relative regression in throughput, latency or memory that fails the run")
+    parser.add_argument('--heatmap-tolerance', type=float, default=0.01, help="Mean absolute difference (as a fraction of 255) from the reference heatmap that fails the run")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in benchmarks:
+            parser.error(f"unknown benchmark: {name}")
+
+    passed = True
+    for name in args.benchmarks or benchmarks:
+        passed = benchmarks[name](args) is not False and passed
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import math
+
+import cv2
+import numpy as np
+
+import heatmap as hm
+from heatmap_mosaic import EARTH_RADIUS_METERS
+
+"""
+heatmap_hotspots.py
+
+This module finds the busiest zones of a heatmap, e.g. the 10 busiest 5x5 m
+squares, so that they can be reported as a list rather than only shown in an
+image. It's built on a summed-area table (integral image) of the heatmap's hit
+counts, which gives the total over any rectangle from four lookups, so that any
+number of regions can be queried without going back over the heatmap.
+
+Hotspots get saved as JSON, in heatmap pixels, and as GeoJSON polygons if the
+drone's location and heading are known. The camera is assumed to point
+straight down, with the top of the image facing the front of the drone (see
+config.HeatmapConfig.camera_horizontal_fov_degrees).
+"""
+
+
+class HotspotIndex:
+    # The table has an extra row and column of zeros at the top and left, so that the sum over the rectangle
+    # [x0, x1) x [y0, y1) is always table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]. It's kept in float64,
+    # which holds integer hit counts exactly for any heatmap that fits in memory.
+
+    def __init__(self, counts, num_frames=1):
+        self.height, self.width = counts.shape
+        self.num_frames = max(1, num_frames)
+        # OpenCV can't take the integral of int32's, which is what long scans' hit counts get promoted to
+        self._table = cv2.integral(counts if counts.dtype != np.int32 else counts.astype('float64'), sdepth=cv2.CV_64F)
+
+    def sum(self, x0, y0, x1, y1):
+        # Returns the total hit count over the rectangle [x0, x1) x [y0, y1), clipped to the heatmap
+        x0, x1 = min(max(0, x0), self.width), min(max(0, x1), self.width)
+        y0, y1 = min(max(0, y0), self.height), min(max(0, y1), self.height)
+        if x1 <= x0 or y1 <= y0:
+            return 0.0
+        table = self._table
+        return float(table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0])
+
+    def mean_hit_rate(self, x0, y0, x1, y1):
+        # Returns the fraction of frames in which the average pixel of the rectangle was part of the foreground
+        area = (min(x1, self.width) - max(0, x0)) * (min(y1, self.height) - max(0, y0))
+        return self.sum(x0, y0, x1, y1) / area / self.num_frames if area > 0 else 0.0
+
+    def window_sums(self, window_width, window_height):
+        # Returns the total over every window of the given size, indexed by the window's top left corner, as an array of
+        # shape (height - window_height + 1, width - window_width + 1). Takes a single pass over the table.
+        table = self._table
+        return table[window_height:, window_width:] - table[:-window_height, window_width:] - table[window_height:, :-window_width] + table[:-window_height, :-window_width]
+
+    def top_k(self, k, window_width, window_height):
+        # Returns up to k non-overlapping windows with the highest totals, busiest first, as dicts of their rectangle,
+        # total and mean hit rate. Windows get picked greedily: the busiest window is taken, every window overlapping it
+        # is ruled out, and so on, which takes k passes over the window totals. Windows with nothing in them are left out.
+        window_width, window_height = min(window_width, self.width), min(window_height, self.height)
+        sums = self.window_sums(window_width, window_height)
+        hotspots = []
+        while len(hotspots) < k:
+            y, x = np.unravel_index(np.argmax(sums), sums.shape)
+            score = float(sums[y, x])
+            if score <= 0:
+                break
+            hotspots.append({
+                'rank': len(hotspots) + 1,
+                'x': int(x),
+                'y': int(y),
+                'width': window_width,
+                'height': window_height,
+                'score': score,
+                'mean_hit_rate': score / (window_width * window_height) / self.num_frames,
+            })
+            sums[max(0, y - window_height + 1):y + window_height, max(0, x - window_width + 1):x + window_width] = -np.inf
+        return hotspots
+
+
+def get_metres_per_pixel(heatmap_width, config=hm.config):
+    # Returns how much ground each heatmap pixel covers, or None if the camera's altitude isn't known
+    if not config.camera_altitude_meters:
+        return None
+    return 2 * config.camera_altitude_meters * math.tan(math.radians(config.camera_horizontal_fov_degrees) / 2) / heatmap_width
+
+
+def find_hotspots(counts, num_frames, config=hm.config):
+    # Returns the config.hotspot_count busiest non-overlapping square zones of hotspot_window_meters (or
+    # hotspot_window_pixels, if the camera's altitude isn't known) in the heatmap
+    metres_per_pixel = get_metres_per_pixel(counts.shape[1], config)
+    window_size = max(1, round(config.hotspot_window_meters / metres_per_pixel)) if metres_per_pixel else config.hotspot_window_pixels
+    return HotspotIndex(counts, num_frames).top_k(config.hotspot_count, window_size, window_size)
+
+
+def _to_location(x, y, width, height, metres_per_pixel, latitude_deg, longitude_deg, heading_deg):
+    # Returns the [longitude, latitude] of a heatmap pixel, given where the drone was and which way it was facing (in
+    # degrees clockwise from north). The image's right points at heading + 90 degrees, and its top at the heading.
+    right_meters, down_meters = (x - width / 2) * metres_per_pixel, (y - height / 2) * metres_per_pixel
+    cos_heading, sin_heading = math.cos(math.radians(heading_deg)), math.sin(math.radians(heading_deg))
+    east_meters = right_meters * cos_heading - down_meters * sin_heading
+    north_meters = -right_meters * sin_heading - down_meters * cos_heading
+    return [
+        longitude_deg + math.degrees(east_meters / (EARTH_RADIUS_METERS * math.cos(math.radians(latitude_deg)))),
+        latitude_deg + math.degrees(north_meters / EARTH_RADIUS_METERS),
+    ]
+
+
+def save_hotspots(out_file_prefix, counts, num_frames, config=hm.config, latitude_deg=None, longitude_deg=None, heading_deg=0):
+    # Finds the heatmap's hotspots and saves them to <out_file_prefix>.json, and to <out_file_prefix>.geojson if the
+    # drone's location and the camera's altitude are known. Returns the hotspots.
+    hotspots = find_hotspots(counts, num_frames, config)
+    height, width = counts.shape
+    metres_per_pixel = get_metres_per_pixel(width, config)
+    with open(f'{out_file_prefix}.json', 'w') as f:
+        json.dump({'width': width, 'height': height, 'num_frames': num_frames, 'metres_per_pixel': metres_per_pixel, 'hotspots': hotspots}, f, indent=2)
+    logging.info(f"Saved {len(hotspots)} hotspots: {out_file_prefix}.json")
+
+    if metres_per_pixel is None or latitude_deg is None or longitude_deg is None:
+        return hotspots
+    features = []
+    for hotspot in hotspots:
+        x0, y0 = hotspot['x'], hotspot['y']
+        x1, y1 = x0 + hotspot['width'], y0 + hotspot['height']
+        # GeoJSON wants the corners counter-clockwise with north up, i.e. down, across, then back up the image
+        ring = [_to_location(x, y, width, height, metres_per_pixel, latitude_deg, longitude_deg, heading_deg) for x, y in ((x0, y0), (x0, y1), (x1, y1), (x1, y0), (x0, y0))]
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'Polygon', 'coordinates': [ring]},
+            'properties': {name: hotspot[name] for name in ('rank', 'score', 'mean_hit_rate')},
+        })
+    with open(f'{out_file_prefix}.geojson', 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f, indent=2)
+    logging.info(f"Saved {len(hotspots)} hotspots: {out_file_prefix}.geojson")
+    return hotspots
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import math
+import os
+import sys
+import tempfile
+
+import cv2
+import numpy as np
+
+import heatmap as hm
+
+"""
+heatmap_mosaic.py
+
+This module lines up the heatmaps generated at each waypoint of a mission by
+projecting them onto a shared ground plane, so that a survey of a whole area
+can be viewed as one map. The camera is assumed to point straight down, with
+the top of the image facing the front of the drone; its altitude and field of
+view (see config.HeatmapConfig.camera_horizontal_fov_degrees) determine how
+much ground each heatmap pixel covers.
+
+The mosaic is stored as a directory of fixed-size tiles, each of which is a
+memory-mapped .npy file, so that adding a heatmap only ever touches the tiles
+it overlaps and the full mosaic never has to fit in memory. It can be exported
+as a pyramid of PNG tiles for viewing at any zoom level:
+
+    python heatmap_mosaic.py mosaic_dir pyramid_dir
+"""
+
+EARTH_RADIUS_METERS = 6378137
+
+
+class HeatmapMosaic:
+    # Each tile holds two layers: the sum of the heatmap values projected onto each of its pixels, weighted by how close
+    # to the centre of their heatmap they were, and the sum of those weights. The mosaic's value at a pixel is their
+    # ratio, so overlapping heatmaps blend into each other rather than adding up, and seams between them get feathered.
+    # Heatmap values are hit rates (i.e. hit counts divided by the number of frames), so that heatmaps from scans of
+    # different lengths are comparable.
+    METADATA_FILENAME = 'mosaic.json'
+
+    def __init__(self, directory, origin_latitude_deg=None, origin_longitude_deg=None, metres_per_pixel=0.1, tile_size=256):
+        # Opens the mosaic in the given directory, or creates a new one centred on the given origin if there isn't one
+        # there yet. The origin, resolution and tile size of an existing mosaic always take precedence.
+        self.directory = directory
+        self._tiles_directory = os.path.join(directory, 'tiles')
+        metadata_file = os.path.join(directory, self.METADATA_FILENAME)
+        if os.path.exists(metadata_file):
+            with open(metadata_file) as f:
+                metadata = json.load(f)
+            logging.info(f"Opened heatmap mosaic: {directory}")
+        else:
+            if origin_latitude_deg is None or origin_longitude_deg is None:
+                raise ValueError(f"No heatmap mosaic in {directory}, and no origin to create one with")
+            metadata = {
+                'origin_latitude_deg': origin_latitude_deg,
+                'origin_longitude_deg': origin_longitude_deg,
+                'metres_per_pixel': metres_per_pixel,
+                'tile_size': tile_size,
+            }
+            os.makedirs(self._tiles_directory, exist_ok=True)
+            with open(metadata_file, 'w') as f:
+                json.dump(metadata, f, indent=2)
+            logging.info(f"Created heatmap mosaic: {directory}")
+        self.origin_latitude_deg = metadata['origin_latitude_deg']
+        self.origin_longitude_deg = metadata['origin_longitude_deg']
+        self.metres_per_pixel = metadata['metres_per_pixel']
+        self.tile_size = metadata['tile_size']
+
+    def to_pixel(self, latitude_deg, longitude_deg):
+        # Returns the (column, row) of a location in the mosaic, with north facing up. An equirectangular projection
+        # around the origin is accurate to well within a pixel over the few kilometres a survey would cover.
+        east_meters = EARTH_RADIUS_METERS * math.radians(longitude_deg - self.origin_longitude_deg) * math.cos(math.radians(self.origin_latitude_deg))
+        north_meters = EARTH_RADIUS_METERS * math.radians(latitude_deg - self.origin_latitude_deg)
+        return east_meters / self.metres_per_pixel, -north_meters / self.metres_per_pixel
+
+    def _tile_path(self, tile_x, tile_y):
+        return os.path.join(self._tiles_directory, f'{tile_x}_{tile_y}.npy')
+
+    def _open_tile(self, tile_x, tile_y):
+        path = self._tile_path(tile_x, tile_y)
+        if os.path.exists(path):
+            return np.load(path, mmap_mode='r+')
+        tile = np.lib.format.open_memmap(path, mode='w+', dtype='float32', shape=(2, self.tile_size, self.tile_size))
+        tile[:] = 0
+        return tile
+
+    def tiles(self):
+        # Returns the (x, y) indices of every tile in the mosaic
+        indices = []
+        for filename in os.listdir(self._tiles_directory):
+            name, extension = os.path.splitext(filename)
+            if extension == '.npy':
+                tile_x, tile_y = name.split('_')
+                indices.append((int(tile_x), int(tile_y)))
+        return sorted(indices)
+
+    def add(self, counts, num_frames, latitude_deg, longitude_deg, altitude_meters, heading_deg=0, config=hm.config):
+        # Projects a heatmap's hit counts onto the mosaic, given where the drone was hovering when it captured them and
+        # which way it was facing (in degrees clockwise from north)
+        height, width = counts.shape
+        ground_width_meters = 2 * altitude_meters * math.tan(math.radians(config.camera_horizontal_fov_degrees) / 2)
+        scale = ground_width_meters / width / self.metres_per_pixel
+        rates = counts.astype('float32') / max(1, num_frames)
+
+        # Weights fall off linearly towards the edges of the heatmap, without quite reaching zero
+        weights = np.outer(self._feather(height), self._feather(width)).astype('float32')
+
+        # Shrink the heatmap to about the mosaic's resolution first, since warpAffine doesn't filter when it scales down
+        if scale < 1:
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            rates = cv2.resize(rates, size, interpolation=cv2.INTER_AREA)
+            weights = cv2.resize(weights, size, interpolation=cv2.INTER_AREA)
+            scale *= width / size[0]
+            height, width = rates.shape
+        weighted_rates = rates * weights
+
+        # Maps heatmap pixels to mosaic pixels: rotate by the heading about the heatmap's centre, scale, then move the
+        # centre to the drone's location
+        centre_x, centre_y = self.to_pixel(latitude_deg, longitude_deg)
+        cos_heading, sin_heading = math.cos(math.radians(heading_deg)), math.sin(math.radians(heading_deg))
+        transform = np.array([[scale * cos_heading, -scale * sin_heading, 0], [scale * sin_heading, scale * cos_heading, 0]])
+        transform[:, 2] = (centre_x, centre_y) - transform[:, :2] @ ((width - 1) / 2, (height - 1) / 2)
+
+        # Only warp into the tiles the heatmap's footprint overlaps
+        corners = np.array([(0, 0, 1), (width, 0, 1), (0, height, 1), (width, height, 1)]) @ transform.T
+        first_tile_x, first_tile_y = np.floor(corners.min(axis=0) / self.tile_size).astype(int)
+        last_tile_x, last_tile_y = np.floor(corners.max(axis=0) / self.tile_size).astype(int)
+        tile_size = (self.tile_size, self.tile_size)
+        for tile_y in range(first_tile_y, last_tile_y + 1):
+            for tile_x in range(first_tile_x, last_tile_x + 1):
+                tile_transform = transform - ((0, 0, tile_x * self.tile_size), (0, 0, tile_y * self.tile_size))
+                tile_weights = cv2.warpAffine(weights, tile_transform, tile_size, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+                if not tile_weights.any():
+                    continue
+                tile = self._open_tile(tile_x, tile_y)
+                tile[0] += cv2.warpAffine(weighted_rates, tile_transform, tile_size, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+                tile[1] += tile_weights
+                tile.flush()
+                del tile
+        logging.info(f"Added heatmap at ({latitude_deg}, {longitude_deg}) to mosaic across tiles ({first_tile_x}, {first_tile_y}) to ({last_tile_x}, {last_tile_y})")
+
+    @staticmethod
+    def _feather(length):
+        return np.maximum(0.05, 1 - np.abs(np.linspace(-1, 1, length)))
+
+    def export_pyramid(self, output_directory, config=hm.config):
+        # Writes the mosaic out as a pyramid of PNG tiles in the usual {z}/{x}/{y}.png layout, where the highest zoom
+        # level holds the mosaic at full resolution and each level below it halves the resolution, down to a single
+        # tile. Tiles get coloured in like any other heatmap, scaled to the mosaic's highest value, and are transparent
+        # wherever no heatmap covers them. Only a handful of tiles are held in memory at any one time.
+        indices = self.tiles()
+        if not indices:
+            raise ValueError(f"Heatmap mosaic is empty: {self.directory}")
+        min_tile_x = min(tile_x for tile_x, _ in indices)
+        min_tile_y = min(tile_y for _, tile_y in indices)
+        num_tiles = max(max(tile_x - min_tile_x, tile_y - min_tile_y) for tile_x, tile_y in indices) + 1
+        max_zoom = math.ceil(math.log2(num_tiles))
+
+        max_value = 0
+        for tile_x, tile_y in indices:
+            max_value = max(max_value, float(self._values(np.load(self._tile_path(tile_x, tile_y), mmap_mode='r')).max()))
+        lut = hm._create_render_lut(config.render_cutoff_percent, config.render_brighten_threshold)
+
+        # Each level gets built out of the layers of the level above it, which are kept in a scratch directory
+        with tempfile.TemporaryDirectory() as scratch_directory:
+            level = {(tile_x - min_tile_x, tile_y - min_tile_y): self._tile_path(tile_x, tile_y) for tile_x, tile_y in indices}
+            for zoom in range(max_zoom, -1, -1):
+                for (x, y), path in level.items():
+                    self._write_tile_image(output_directory, zoom, x, y, np.load(path, mmap_mode='r'), max_value, lut)
+                if zoom > 0:
+                    level = self._build_parent_level(level, os.path.join(scratch_directory, str(zoom - 1)))
+
+        metadata = {
+            'origin_latitude_deg': self.origin_latitude_deg,
+            'origin_longitude_deg': self.origin_longitude_deg,
+            'metres_per_pixel': self.metres_per_pixel,
+            'tile_size': self.tile_size,
+            'max_zoom': max_zoom,
+            'first_tile': [min_tile_x, min_tile_y],  # Mosaic tile index of tile (0, 0) at max_zoom
+            'max_value': max_value,
+        }
+        with open(os.path.join(output_directory, 'pyramid.json'), 'w') as f:
+            json.dump(metadata, f, indent=2)
+        logging.info(f"Exported heatmap mosaic to tile pyramid with zoom levels 0-{max_zoom}: {output_directory}")
+
+    @staticmethod
+    def _values(tile):
+        return np.divide(tile[0], tile[1], out=np.zeros(tile.shape[1:], 'float32'), where=tile[1] > 0)
+
+    def _build_parent_level(self, level, directory):
+        # Averages each 2x2 block of tiles down into a single tile. Both layers get averaged the same way, so their ratio
+        # stays a weighted average of the heatmaps underneath.
+        os.makedirs(directory)
+        parents = {}
+        for x, y in level:
+            parents.setdefault((x // 2, y // 2), []).append((x, y))
+        parent_level = {}
+        for (parent_x, parent_y), children in parents.items():
+            combined = np.zeros((2, 2 * self.tile_size, 2 * self.tile_size), 'float32')
+            for x, y in children:
+                offset_x, offset_y = (x % 2) * self.tile_size, (y % 2) * self.tile_size
+                combined[:, offset_y:offset_y + self.tile_size, offset_x:offset_x + self.tile_size] = np.load(level[(x, y)], mmap_mode='r')
+            parent = np.stack([cv2.resize(layer, (self.tile_size, self.tile_size), interpolation=cv2.INTER_AREA) for layer in combined])
+            path = os.path.join(directory, f'{parent_x}_{parent_y}.npy')
+            np.save(path, parent)
+            parent_level[(parent_x, parent_y)] = path
+        return parent_level
+
+    def _write_tile_image(self, output_directory, zoom, x, y, tile, max_value, lut):
+        scaled = cv2.convertScaleAbs(self._values(tile), alpha=255 / max_value if max_value > 0 else 0)
+        image = cv2.cvtColor(cv2.applyColorMap(scaled, lut), cv2.COLOR_BGR2BGRA)
+        image[:, :, 3] = np.where(tile[1] > 0, 255, 0)
+        tile_directory = os.path.join(output_directory, str(zoom), str(x))
+        os.makedirs(tile_directory, exist_ok=True)
+        cv2.imwrite(os.path.join(tile_directory, f'{y}.png'), image)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s", handlers=[logging.StreamHandler(sys.stdout)])
+
+    parser = argparse.ArgumentParser(description="Exports a heatmap mosaic as a pyramid of PNG tiles")
+    parser.add_argument('mosaic', help="Directory holding the heatmap mosaic")
+    parser.add_argument('output', help="Directory to write the tile pyramid to")
+    args = parser.parse_args()
+
+    HeatmapMosaic(args.mosaic).export_pyramid(args.output)
@@ -1,17 +1,18 @@
 #!/usr/bin/env python3
 
 import asyncio
+import concurrent.futures
+import functools
 import logging
 import math
 import sys
-import time
-
-import cv2
-from mavsdk import System
-from mavsdk.mission import MissionError
-from mavsdk.mission import MissionPlan
+import threading
 
+import fake_drone
 import heatmap as hm
+import heatmap_hotspots
+import heatmap_mosaic
+from telemetry_hub import TelemetryHub
 from config import MultiPointMissionConfig as config
 
 """
@@ -30,16 +31,24 @@ Configurations relating to the heatmap generation component of this workflow
 can be found in config.HeatmapGenerator.
 """
 
+# Held while a heatmap gets added to the mosaic; see postprocess_heatmap()
+mosaic_lock = threading.Lock()
+
 
 async def run():
-    drone = System()
+    if config.system_address.startswith('fake://'):
+        drone, mission_error = fake_drone.FakeSystem(), fake_drone.MissionError
+    else:
+        # Only imported for a real drone, so that the fake one can be flown without MAVSDK installed
+        from mavsdk import System
+        from mavsdk.mission import MissionError
+        drone, mission_error = System(), MissionError
+    telemetry = TelemetryHub(drone)
 
     logging.info(f"Waiting for drone connection on {config.system_address}")
     await drone.connect(system_address=config.system_address)
-    async for state in drone.core.connection_state():
-        if state.is_connected:
-            logging.info(f"Drone discovered with UUID: {state.uuid}")
-            break
+    state = await telemetry.wait_for('core.connection_state', lambda state: state.is_connected)
+    logging.info(f"Drone discovered with UUID: {state.uuid}")
 
     logging.info("Waiting for valid mission plan")
     mission = None
@@ -51,34 +60,53 @@ async def run():
                 break
             else:
                 logging.debug(f"Got invalid mission; waiting for a valid mission to be uploaded")
-        except MissionError:
+        except mission_error:
             logging.error("Failed to get mission")
         await asyncio.sleep(5)
     mission_string = '\n'.join([str(item) for item in mission.mission_items])
     logging.info(f"Successfully retrieved mission plan:\n{mission_string}")
 
     logging.info("Waiting for drone to have a global position estimate")
-    async for health in drone.telemetry.health():
-        if health.is_global_position_ok:
-            logging.info("Global position estimate ok")
-            break
+    await telemetry.wait_for('telemetry.health', lambda health: health.is_global_position_ok)
+    logging.info("Global position estimate ok")
 
     logging.info("Fetching launch point")
-    async for launch_point in drone.telemetry.home():
-        break
+    launch_point = await telemetry.latest('telemetry.home')
     logging.info(f"Launch point: {launch_point}")
 
+    logging.info("Opening video stream")
+    session = await loop.run_in_executor(None, functools.partial(hm.HeatmapSession, checkpoint_enabled=config.checkpoint_enabled))
+    mosaic = heatmap_mosaic.HeatmapMosaic(config.mosaic_directory, launch_point.latitude_deg, launch_point.longitude_deg, config.mosaic_metres_per_pixel, config.mosaic_tile_size) if config.mosaic_enabled else None
+
     logging.info("-- ARMING")
     await drone.action.arm()
 
     logging.info("-- STARTING MISSION")
     await drone.mission.start_mission()
 
-    async for mission_progress in drone.mission.mission_progress():
+    # Heatmaps get rendered and saved in the background while the drone heads to the next waypoint, so only capturing the
+    # data holds up the mission. Each waypoint's postprocessing is driven from a thread, since reconstructing the
+    # background needs the generator's background model, and that thread hands the rest off to worker processes.
+    postprocessing_executor = concurrent.futures.ProcessPoolExecutor(config.postprocessing_workers)
+    postprocessing_threads = concurrent.futures.ThreadPoolExecutor(config.postprocessing_workers, thread_name_prefix='postprocessing')
+    postprocessing_futures = []
+
+    # Each progress update gets handled once; pausing and restarting the mission can repeat the one it's already at
+    mission_progress = None
+    while True:
+        last_progress = mission_progress
+        mission_progress = await telemetry.wait_for('mission.mission_progress', lambda progress: last_progress is None or progress.current != last_progress.current)
         if mission_progress.current > 0:
             logging.info(f"Reached waypoint {mission_progress.current} of {mission_progress.total}; pausing mission to capture heatmap data")
             await drone.mission.pause_mission()
-            await loop.run_in_executor(None, lambda: generate_heatmap(mission_progress, mission.mission_items[mission_progress.current - 1]))
+            waypoint = mission.mission_items[mission_progress.current - 1]
+            heading_deg = (await telemetry.latest('telemetry.attitude_euler')).yaw_deg
+            await loop.run_in_executor(None, wait_for_postprocessing_capacity, postprocessing_futures)
+            generator = await loop.run_in_executor(None, generate_heatmap, session, mission_progress, waypoint)
+            if generator.num_frames == 0:
+                logging.warning(f"No frames captured at waypoint {mission_progress.current} of {mission_progress.total}; skipping its heatmap")
+            else:
+                postprocessing_futures.append(postprocessing_threads.submit(postprocess_heatmap, generator, mission_progress, waypoint, heading_deg, postprocessing_executor, mosaic))
         if mission_progress.current < mission_progress.total:
             logging.info(f"Heading to waypoint {mission_progress.current + 1} of {mission_progress.total}: {mission.mission_items[mission_progress.current]}")
             await drone.mission.start_mission()
@@ -88,19 +116,26 @@ async def run():
 
     logging.info("-- RETURNING TO LAUNCH POINT")
     await drone.action.return_to_launch()
-    async for in_air in drone.telemetry.in_air():
-        if not in_air:
-            async for landing_point in drone.telemetry.position():
-                break
-            logging.info(f"Landed at {landing_point}")
-            break
+    await telemetry.wait_for('telemetry.in_air', lambda in_air: not in_air)
+    landing_point = await telemetry.latest('telemetry.position')
+    logging.info(f"Landed at {landing_point}")
+
+    session.close()
+    logging.info(f"Waiting for {len(postprocessing_futures)} heatmaps to finish saving")
+    await loop.run_in_executor(None, flush_postprocessing, postprocessing_futures)
+    postprocessing_threads.shutdown()
+    postprocessing_executor.shutdown()
+    if mosaic is not None:
+        logging.info(f"Heatmap mosaic saved to {config.mosaic_directory}; run heatmap_mosaic.py to export it for viewing")
 
     logging.info("-- TERMINATING")
     await drone.action.terminate()
+    telemetry.close()
     sys.exit()
 
 
-def is_mission_plan_valid(mission_plan: MissionPlan):
+def is_mission_plan_valid(mission_plan):
+    # mission_plan is a mavsdk.mission.MissionPlan, or a fake_drone.MissionPlan when flying the fake drone
     if mission_plan is None:
         return False
     if len(mission_plan.mission_items) == 0:
@@ -111,17 +146,60 @@ def is_mission_plan_valid(mission_plan: MissionPlan):
     return True
 
 
-def generate_heatmap(mission_progress, waypoint):
-    if config.waypoint_stabilization_time_seconds > 0:
-        logging.debug(f"Waiting {config.waypoint_stabilization_time_seconds} seconds for drone to stabilize")
-        time.sleep(config.waypoint_stabilization_time_seconds)
+def generate_heatmap(session, mission_progress, waypoint):
+    # Captures the heatmap data for a waypoint and returns its generator, leaving everything else to postprocess_heatmap()
+    logging.debug("Waiting for drone to stabilize")
+    stability_overrides = {'session_stability_timeout_seconds': config.waypoint_stabilization_time_seconds} if config.waypoint_stabilization_time_seconds is not None else {}
+    session.wait_until_stable(camera_altitude_meters=waypoint.relative_altitude_m, **stability_overrides)
     logging.info(f"Generating heatmap {mission_progress.current} of {mission_progress.total} at waypoint: {waypoint}")
-    generated_heatmap, generated_bg = hm.generate_heatmap()
+    generator = session.scan(mask_recording_filename=f"masks_{mission_progress.current}_of_{mission_progress.total}.hmm",
+                             checkpoint_filename=f"checkpoint_{mission_progress.current}_of_{mission_progress.total}.ckpt")
+    logging.info(f"Done capturing heatmap {mission_progress.current} of {mission_progress.total}; saving it in the background")
+    return generator
+
+
+def postprocess_heatmap(generator, mission_progress, waypoint, heading_deg, postprocessing_executor, mosaic):
+    # Runs on a postprocessing thread while the drone heads to the next waypoint: reconstructs the background, then
+    # renders and saves the images, saves the hotspots and adds the heatmap to the mosaic in worker processes. The
+    # output file names are fixed here, so they stay tied to this waypoint no matter when they actually get written.
+    # Returns the names of the images once everything is saved, at which point the waypoint's checkpoint gets deleted;
+    # if anything failed, the checkpoint is kept around so that the heatmap can still be recovered.
     bg_out_file = f"bg_{mission_progress.current}_of_{mission_progress.total}.png"
     heatmap_out_file = f"heatmap_{mission_progress.current}_of_{mission_progress.total}.png"
-    logging.info(f"Done generating heatmap {mission_progress.current} of {mission_progress.total}; saving images: {bg_out_file}, {heatmap_out_file}")
-    cv2.imwrite(bg_out_file, generated_bg)
-    cv2.imwrite(heatmap_out_file, cv2.add(generated_heatmap, generated_bg))
+    futures = [postprocessing_executor.submit(hm.render_and_save_images, bg_out_file, heatmap_out_file, generator.heatmap, generator.value_range(), generator.background(), generator.config)]
+    if generator.config.hotspots_enabled:
+        futures.append(postprocessing_executor.submit(heatmap_hotspots.save_hotspots, f"hotspots_{mission_progress.current}_of_{mission_progress.total}", generator.heatmap, generator.num_frames,
+                                                      generator.config, waypoint.latitude_deg, waypoint.longitude_deg, heading_deg))
+    if mosaic is not None:
+        # Heatmaps that overlap would add to the same tiles, so only one gets added to the mosaic at a time
+        with mosaic_lock:
+            postprocessing_executor.submit(mosaic.add, generator.heatmap, generator.num_frames, waypoint.latitude_deg, waypoint.longitude_deg, waypoint.relative_altitude_m,
+                                           heading_deg, generator.config).result()
+    concurrent.futures.wait(futures)
+    for future in futures:
+        future.result()
+    generator.discard_checkpoint()
+    return bg_out_file, heatmap_out_file
+
+
+def wait_for_postprocessing_capacity(postprocessing_futures):
+    # Blocks until fewer than postprocessing_max_pending heatmaps are still waiting to be saved, so that a slow disk can't
+    # make the backlog (and the memory it holds onto) grow without bound over a long mission
+    pending_futures = [future for future in postprocessing_futures if not future.done()]
+    while len(pending_futures) >= config.postprocessing_max_pending:
+        logging.warning(f"{len(pending_futures)} heatmaps are still waiting to be saved; holding at waypoint until one is done")
+        concurrent.futures.wait(pending_futures, return_when=concurrent.futures.FIRST_COMPLETED)
+        pending_futures = [future for future in pending_futures if not future.done()]
+
+
+def flush_postprocessing(postprocessing_futures):
+    # Waits for every heatmap to finish saving, logging any that failed rather than giving up on the rest
+    for future in postprocessing_futures:
+        try:
+            bg_out_file, heatmap_out_file = future.result()
+            logging.info(f"Saved images: {bg_out_file}, {heatmap_out_file}")
+        except Exception:
+            logging.exception("Failed to save heatmap images")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import argparse
+import ast
+import logging
+import sys
+import time
+
+import cv2
+
+import heatmap as hm
+
+"""
+heatmap_replay.py
+
+This script rebuilds a heatmap from the foreground masks recorded during a
+heatmap scan (see the mask_recording_* configs in config.HeatmapConfig), so
+that rendering and noise reduction configs can be tuned without rerunning
+background subtraction over the whole video. It can also rebuild the heatmap
+over just part of the scan, or the heatmap window as of a point in the scan.
+
+Config overrides are given as name=value pairs, for example:
+
+    python heatmap_replay.py masks.hmm render_cutoff_percent=0.2 --bg bg.png
+
+Noise reduction configs only have an effect on recordings of raw masks.
+"""
+
+
+def replay(recording, config=hm.config, start_seconds=0, end_seconds=None):
+    # Rebuilds the heatmap out of the frames between start_seconds and end_seconds into the recording. If the masks
+    # need cleaning up, or a heatmap window is configured, frames get added one by one. Otherwise, each chunk of frames
+    # gets summed in one go, which only takes a pass over the unpacked masks. Blob occupancy heatmaps also get built up
+    # frame by frame. Noise reduction kernels and blob sizes get scaled the same way they were during the scan, e.g.
+    # for GSD-based down-sampling.
+    clean_masks = recording.stage == 'RAW' and config.noise_reduction_enabled
+    mask_processor = hm._MaskProcessor(config, kernel_scale=recording.kernel_scale)
+    heatmap = hm._create_heatmap_accumulator(config)
+    if isinstance(heatmap, hm._OccupancyAccumulator):
+        heatmap.set_kernel_scale(recording.kernel_scale)
+    windowed = isinstance(heatmap, hm._WindowedHeatmapAccumulator)
+    first_timestamp_ns = None
+    for timestamps_ns, masks in recording.chunks():
+        if first_timestamp_ns is None:
+            first_timestamp_ns = timestamps_ns[0]
+        offsets_seconds = 1e-9 * (timestamps_ns - first_timestamp_ns)
+        selected = offsets_seconds >= start_seconds
+        if end_seconds is not None:
+            selected &= offsets_seconds < end_seconds
+        if not selected.any():
+            if end_seconds is not None and offsets_seconds[0] >= end_seconds:
+                break
+            continue
+
+        if clean_masks or windowed or isinstance(heatmap, hm._OccupancyAccumulator):
+            for timestamp_ns, mask in zip(timestamps_ns[selected], masks[selected]):
+                mask = mask_processor.clean(mask) if clean_masks else mask
+                if windowed:
+                    heatmap.add(mask, int(timestamp_ns))
+                else:
+                    heatmap.add(mask)
+        else:
+            chunk = hm._HeatmapAccumulator()
+            chunk.counts = masks[selected].sum(axis=0, dtype='uint16')
+            chunk.num_frames = int(selected.sum())
+            heatmap.merge(chunk)
+    return heatmap
+
+
+def _parse_override(value):
+    name, _, value = value.partition('=')
+    try:
+        return name, ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return name, value
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s", handlers=[logging.StreamHandler(sys.stdout)])
+
+    parser = argparse.ArgumentParser(description="Rebuilds a heatmap from recorded foreground masks")
+    parser.add_argument('recording', help="Mask recording written by the heatmap generator")
+    parser.add_argument('overrides', nargs='*', help="Config overrides, as name=value pairs")
+    parser.add_argument('--output', default='heatmap_replay.png', help="File to write the heatmap to")
+    parser.add_argument('--bg', help="Background image to overlay the heatmap onto, e.g. the one saved alongside the recording")
+    parser.add_argument('--start', type=float, default=0, help="Seconds into the recording to start counting frames from")
+    parser.add_argument('--end', type=float, help="Seconds into the recording to stop counting frames at")
+    parser.add_argument('--window', type=float, help="Write the heatmap over this many seconds leading up to --end, rather than the whole heatmap")
+    args = parser.parse_args()
+
+    overrides = dict(_parse_override(value) for value in args.overrides)
+    if args.window is not None:
+        overrides.setdefault('heatmap_window_mode', 'SLIDING')
+        overrides['heatmap_window_seconds'] = args.window
+    try:
+        replay_config = hm.create_config(**overrides)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.window is not None and replay_config.heatmap_accumulation_mode == 'BLOBS':
+        parser.error("--window isn't supported with blob occupancy heatmaps")
+
+    recording = hm._MaskRecording(args.recording)
+    logging.info(f"Replaying {recording.stage.lower()} {recording.width}x{recording.height} foreground masks (kernels scaled by {recording.kernel_scale:.2f}) from: {args.recording}")
+    start_time = time.perf_counter()
+    replayed_heatmap = replay(recording, replay_config, args.start, args.end)
+    elapsed_seconds = time.perf_counter() - start_time
+    recording.close()
+    if replayed_heatmap.num_frames == 0:
+        logging.error("No frames to replay")
+        sys.exit(1)
+    logging.info(f"Replayed {replayed_heatmap.num_frames} frames in {elapsed_seconds:.2f} seconds ({replayed_heatmap.num_frames / elapsed_seconds:.0f} frames per second)")
+
+    if args.window is not None:
+        counts = replayed_heatmap.window()
+        rendered_heatmap = hm._scale_heatmap_for_rendering(counts, config=replay_config)
+    else:
+        rendered_heatmap = hm._scale_heatmap_for_rendering(replayed_heatmap.counts, replayed_heatmap.value_range(), replay_config)
+    if args.bg is not None:
+        rendered_heatmap = cv2.add(rendered_heatmap, cv2.imread(args.bg))
+    logging.info(f"Saving heatmap: {args.output}")
+    cv2.imwrite(args.output, rendered_heatmap)
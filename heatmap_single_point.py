@@ -1,15 +1,16 @@
 #!/usr/bin/env python3
 
 import asyncio
+import functools
 import logging
 import math
 import sys
 import time
 
-import cv2
-from mavsdk import System
-
+import fake_drone
 import heatmap as hm
+import heatmap_hotspots
+from telemetry_hub import TelemetryHub
 from config import SinglePointMissionConfig as config
 
 """
@@ -28,83 +29,93 @@ can be found in config.HeatmapGenerator.
 
 
 async def run():
-    drone = System()
+    if config.system_address.startswith('fake://'):
+        drone = fake_drone.FakeSystem()
+    else:
+        # Only imported for a real drone, so that the fake one can be flown without MAVSDK installed
+        from mavsdk import System
+        drone = System()
+    telemetry = TelemetryHub(drone)
 
     logging.info(f"Waiting for drone connection on {config.system_address}")
     await drone.connect(system_address=config.system_address)
-    async for state in drone.core.connection_state():
-        if state.is_connected:
-            logging.info(f"Drone discovered with UUID: {state.uuid}")
-            break
+    state = await telemetry.wait_for('core.connection_state', lambda state: state.is_connected)
+    logging.info(f"Drone discovered with UUID: {state.uuid}")
 
     logging.info("Waiting for drone to have a global position estimate")
-    async for health in drone.telemetry.health():
-        if health.is_global_position_ok:
-            logging.info("Global position estimate ok")
-            break
+    await telemetry.wait_for('telemetry.health', lambda health: health.is_global_position_ok)
+    logging.info("Global position estimate ok")
 
     logging.info("Fetching amsl altitude at home location")
-    async for home_position in drone.telemetry.home():
-        break
+    home_position = await telemetry.latest('telemetry.home')
     logging.info(f"Home position: {home_position}")
 
+    logging.info("Opening video stream")
+    session = await loop.run_in_executor(None, functools.partial(hm.HeatmapSession, camera_altitude_meters=config.target_altitude_meters, checkpoint_enabled=config.checkpoint_enabled, checkpoint_filename=config.checkpoint_filename))
+
     logging.info("-- ARMING")
     await drone.action.arm()
 
     logging.info("-- TAKING OFF")
     takeoff_altitude = await drone.action.get_takeoff_altitude()
     await drone.action.takeoff()
-    success = await arrive_at_target_altitude(drone, takeoff_altitude)
+    success = await arrive_at_target_altitude(telemetry, takeoff_altitude)
     if not success:
         logging.error(f"Failed to takeoff to relative altitude of {takeoff_altitude}m; aborting...")
-        await land_and_exit(drone)
+        await land_and_exit(drone, telemetry, session)
 
     logging.info(f"Flying to altitude of {config.target_altitude_meters}m")
     target_absolute_altitude = home_position.absolute_altitude_m + config.target_altitude_meters
     await drone.action.goto_location(home_position.latitude_deg, home_position.longitude_deg, target_absolute_altitude, 0)
-    success = await arrive_at_target_altitude(drone, config.target_altitude_meters)
+    success = await arrive_at_target_altitude(telemetry, config.target_altitude_meters)
     if not success:
         logging.error(f"Failed to fly to relative altitude of {config.target_altitude_meters}m; aborting...")
-        await land_and_exit(drone)
+        await land_and_exit(drone, telemetry, session)
 
     logging.info("Arrived at target altitude")
-    await loop.run_in_executor(None, generate_heatmap)
-    await land_and_exit(drone)
+    await loop.run_in_executor(None, generate_heatmap, session, home_position)
+    await land_and_exit(drone, telemetry, session)
 
 
-async def arrive_at_target_altitude(drone, target_relative_altitude):
+async def arrive_at_target_altitude(telemetry, target_relative_altitude):
+    # Returns as soon as a position update puts the drone within the threshold of the target altitude, rather than
+    # checking once a second, or False if it doesn't get there within altitude_arrival_timeout_seconds
     logging.info(f"Waiting to arrive at relative altitude of {target_relative_altitude}m")
     altitude_error_threshold = config.altitude_error_threshold_meters / 2
-    in_position = False
-    start_time_ns = time.time_ns()
-    while not in_position:
-        async for position in drone.telemetry.position():
-            logging.info(position)
-            break
-        in_position = target_relative_altitude - altitude_error_threshold < position.relative_altitude_m < target_relative_altitude + altitude_error_threshold
-        timed_out = time.time_ns() - start_time_ns > 1e9 * config.altitude_arrival_timeout_seconds
-        if in_position or timed_out:
-            break
-        await asyncio.sleep(1)
-    return in_position
-
-
-async def land_and_exit(drone):
+    try:
+        position = await telemetry.wait_for('telemetry.position', lambda position: abs(position.relative_altitude_m - target_relative_altitude) < altitude_error_threshold,
+                                            timeout=config.altitude_arrival_timeout_seconds)
+    except asyncio.TimeoutError:
+        logging.info(await telemetry.latest('telemetry.position'))
+        return False
+    logging.info(position)
+    return True
+
+
+async def land_and_exit(drone, telemetry, session):
+    session.close()
     logging.info("-- LANDING")
     await drone.action.land()
-    await arrive_at_target_altitude(drone, 0)
+    await arrive_at_target_altitude(telemetry, 0)
     logging.info("-- TERMINATING")
     await drone.action.terminate()
+    telemetry.close()
     sys.exit()
 
 
-def generate_heatmap():
+def generate_heatmap(session, home_position):
+    logging.info("Waiting for drone to stabilize")
+    session.wait_until_stable()
     logging.info("Generating heatmap")
-    generated_heatmap, generated_bg = hm.generate_heatmap()
+    generator = session.scan()
+    generated_heatmap, generated_bg = generator.result()
     ts_millis = math.floor(1e3 * time.time())
     logging.info(f"Done generating heatmap; saving images: bg_{ts_millis}.png, heatmap_{ts_millis}.png")
-    cv2.imwrite(f'bg_{ts_millis}.png', generated_bg)
-    cv2.imwrite(f'heatmap_{ts_millis}.png', cv2.add(generated_heatmap, generated_bg))
+    hm.save_images(f'bg_{ts_millis}.png', f'heatmap_{ts_millis}.png', generated_heatmap, generated_bg, generator.metrics)
+    if generator.config.hotspots_enabled:
+        # The drone hovers over its launch point, facing north
+        heatmap_hotspots.save_hotspots(f'hotspots_{ts_millis}', generator.heatmap, generator.num_frames, generator.config, home_position.latitude_deg, home_position.longitude_deg)
+    generator.discard_checkpoint()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+
+"""
+telemetry_hub.py
+
+This module shares the drone's telemetry streams between everything in a
+mission script that needs them. Rather than each wait opening its own MAVSDK
+subscription, taking one sample and sleeping, the hub keeps a single
+long-lived subscription per stream, remembers the latest value, and wakes up
+anyone waiting on a condition (e.g. "altitude within threshold") as soon as a
+value satisfying it arrives.
+
+Streams are named after the MAVSDK plugin and the method that subscribes to
+them, e.g. 'telemetry.position' or 'core.connection_state', and each one gets
+subscribed to the first time something asks for it. It works the same with a
+real mavsdk.System or with fake_drone.FakeSystem.
+"""
+
+
+class TelemetryHub:
+    def __init__(self, drone):
+        self._drone = drone
+        self._subscriptions = {}
+
+    def _subscribe(self, stream):
+        subscription = self._subscriptions.get(stream)
+        if subscription is None:
+            plugin, method = stream.split('.')
+            subscription = _Subscription(stream, getattr(getattr(self._drone, plugin), method))
+            self._subscriptions[stream] = subscription
+        return subscription
+
+    async def latest(self, stream, timeout=None):
+        # Returns the most recent value of the stream, waiting for the first one if nothing has arrived yet. Raises
+        # asyncio.TimeoutError if nothing arrives within timeout seconds.
+        return await self.wait_for(stream, lambda value: True, timeout)
+
+    async def wait_for(self, stream, condition, timeout=None):
+        # Returns the first value of the stream, starting with the latest one, for which condition(value) is true. Raises
+        # asyncio.TimeoutError if there isn't one within timeout seconds, or whatever the stream raised if it failed.
+        return await asyncio.wait_for(self._subscribe(stream).wait_for(condition), timeout)
+
+    def close(self):
+        # Cancels every subscription; any waits still pending get cancelled along with them
+        for subscription in self._subscriptions.values():
+            subscription.close()
+        self._subscriptions.clear()
+
+
+class _Subscription:
+    # A single subscription to a stream, read on its own task. Each waiter is a future along with the condition it's
+    # waiting on, and gets resolved by the first value that satisfies it, so that checking waiters costs nothing
+    # between values. If the stream fails or ends, every pending waiter gets the error, and the next wait resubscribes.
+    _has_value = False
+    latest = None
+
+    def __init__(self, name, subscribe):
+        self.name = name
+        self._subscribe = subscribe
+        self._waiters = []
+        self._task = None
+        self._error = None
+
+    async def wait_for(self, condition):
+        if self._has_value and condition(self.latest):
+            return self.latest
+        if self._task is None or self._task.done():
+            self._error = None
+            self._task = asyncio.ensure_future(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((condition, future))
+        return await future
+
+    async def _run(self):
+        try:
+            async for value in self._subscribe():
+                self.latest = value
+                self._has_value = True
+                self._notify(value)
+            self._error = EOFError(f"Telemetry stream {self.name} ended")
+        except asyncio.CancelledError:
+            self._error = asyncio.CancelledError()
+            raise
+        except Exception as e:
+            logging.warning(f"Telemetry stream {self.name} failed: {e!r}")
+            self._error = e
+        finally:
+            for _, future in self._waiters:
+                if future.done():
+                    continue
+                if isinstance(self._error, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(self._error)
+            self._waiters.clear()
+
+    def _notify(self, value):
+        # Resolves every waiter whose condition the new value satisfies, and drops those that were cancelled (e.g. after
+        # timing out)
+        pending = []
+        for condition, future in self._waiters:
+            if future.done():
+                continue
+            try:
+                satisfied = condition(value)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            if satisfied:
+                future.set_result(value)
+            else:
+                pending.append((condition, future))
+        self._waiters = pending
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()